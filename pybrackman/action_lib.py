@@ -0,0 +1,212 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import time
+
+import discord
+
+import deadline_lib
+import metrics_lib
+
+# Action priorities - lower goes first.  Channels have to exist before anyone
+# can be moved into them, and the person who asked for the sort should see it
+# working straight away.
+PRIORITY_CREATE = 0
+PRIORITY_ISSUER = 1
+PRIORITY_MOVE = 2
+PRIORITY_CLEANUP = 3
+
+# Our own limits on each kind of action, as (calls, per seconds), within a
+# guild and across all guilds.  discord.py follows the rate limit headers
+# Discord sends, but only once it has hit a bucket; staying under these means
+# we rarely do, and that a big sort in one guild can't starve the others.
+DEFAULT_LIMITS = {
+    'create': (5, 5.0),
+    'edit': (5, 5.0),
+    'move': (10, 10.0),
+    'delete': (5, 5.0),
+    'global': (40, 1.0),
+}
+
+# Kinds of action that mustn't be retried when Discord fails on its side,
+# since it may have done them anyway - a retried create could make a second
+# channel.
+NOT_RETRIED = ('create',)
+
+
+class RateLimit:
+    """
+    A token bucket allowing calls at a steady rate, with bursts of up to the
+    full number of calls.
+    """
+    def __init__(self, calls, per):
+        self.calls = calls
+        self.per = per
+        self.tokens = float(calls)
+        self.updated = time.monotonic()
+
+    def full(self, now):
+        """
+        Has the bucket had time to fill up again since it was last used?
+        """
+        return now - self.updated >= self.per
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.calls, self.tokens + (now - self.updated) * self.calls / self.per)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) * self.per / self.calls)
+
+
+class GuildActions:
+    """
+    The queue of actions waiting to be done in one guild, the rate limits for
+    each kind of action there, and how many workers are draining the queue.
+    """
+    def __init__(self, limits):
+        self.queue = []  # heap of (priority, seq, kind, func, args, kwargs, future, deadline)
+        self.limits = {kind: RateLimit(*limit) for kind, limit in limits.items() if kind != 'global'}
+        self.workers = 0
+
+    def idle(self, now):
+        """
+        Is there nothing to do here, and have the rate limits all reset - so
+        forgetting the guild's limits changes nothing?
+        """
+        return (
+            not self.workers and not self.queue
+            and all(limit.full(now) for limit in self.limits.values())
+        )
+
+
+class ActionScheduler:
+    """
+    Do Discord API calls for each guild in order of priority, a few at a time
+    and within our rate limits, and retry the ones that Discord fails on its
+    side - except those in NOT_RETRIED.  discord.py itself waits out and
+    retries the calls Discord rate limits.
+
+    Each guild's rate limits are kept while they still hold anything back,
+    so they carry over from one burst of actions to the next; guilds that
+    have been idle for long enough for them to reset are forgotten.
+
+    Callers await run(), which queues the call and returns its result once
+    it's been done - or raises its exception once it's failed for good.
+    Within a priority, calls are done in the order they were queued.  A
+    call made under a command's deadline isn't started or retried once the
+    deadline has passed, and if the caller gives up waiting it's dropped.
+    """
+    def __init__(self, concurrency=4, max_retries=3, retry_delay=1.0, jitter=0.5, limits=None):
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.jitter = jitter
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+        self._guilds = dict()  # guild_id: GuildActions
+        self._global = RateLimit(*self.limits['global'])
+        self._seq = itertools.count()
+        # The event loop only keeps weak references to tasks, so we keep the
+        # workers here until they finish.
+        self._workers = set()
+
+    def configure(self, concurrency=None, max_retries=None, retry_delay=None, jitter=None, limits=None):
+        """
+        Change the settings.  New limits apply to guilds that haven't had any
+        actions yet, and to all guilds for the global limit.
+        """
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if retry_delay is not None:
+            self.retry_delay = retry_delay
+        if jitter is not None:
+            self.jitter = jitter
+        if limits:
+            self.limits.update({kind: tuple(limit) for kind, limit in limits.items()})
+            self._global = RateLimit(*self.limits['global'])
+
+    async def run(self, guild_id, kind, priority, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs), which must return an awaitable, as a
+        kind of action in this guild, and return its result when it's done.
+        """
+        guild = self._guilds.get(guild_id)
+        if guild is None:
+            guild = self._guilds[guild_id] = GuildActions(self.limits)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(guild.queue, (
+            priority, next(self._seq), kind, func, args, kwargs, future,
+            deadline_lib.current_deadline.get()
+        ))
+        if guild.workers < self.concurrency:
+            guild.workers += 1
+            task = asyncio.create_task(self._work(guild_id, guild))
+            self._workers.add(task)
+            task.add_done_callback(self._workers.discard)
+        return await future
+
+    async def _work(self, guild_id, guild):
+        try:
+            while guild.queue:
+                _, _, kind, func, args, kwargs, future, deadline = heapq.heappop(guild.queue)
+                if future.done():  # the caller was cancelled
+                    continue
+                try:
+                    result = await self._attempt(guild, kind, func, args, kwargs, deadline)
+                except Exception as e:
+                    metrics_lib.incr('action_failures')
+                    logging.error("%s action in guild %s failed: %r", kind, guild_id, e)
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+        finally:
+            guild.workers -= 1
+            now = time.monotonic()
+            for idle_id in [idle_id for idle_id, g in self._guilds.items() if g.idle(now)]:
+                del self._guilds[idle_id]
+
+    async def _attempt(self, guild, kind, func, args, kwargs, deadline=None):
+        """
+        Do the action, retrying it if Discord has a server error and it's
+        safe to do again, after an increasing delay plus some jitter so
+        retries from different guilds don't bunch up.
+        """
+        limit = guild.limits.get(kind)
+        attempt = 0
+        while True:
+            if limit is not None:
+                await limit.acquire()
+            await self._global.acquire()
+            if deadline is not None and deadline.expired():
+                raise deadline_lib.exceeded(kind)
+            start = time.monotonic()
+            try:
+                result = await func(*args, **kwargs)
+            except discord.HTTPException as e:
+                metrics_lib.incr('discord_errors', kind=kind, status=e.status)
+                retryable = kind not in NOT_RETRIED and e.status in (500, 502, 503, 504)
+                if not retryable or attempt >= self.max_retries:
+                    raise
+                delay = self.retry_delay * 2 ** attempt * random.uniform(1, 1 + self.jitter)
+                if deadline is not None and deadline.remaining() <= delay:
+                    raise
+                attempt += 1
+                metrics_lib.incr('action_retries')
+                logging.warning("%s action hit %r, retry %d in %.1fs", kind, e, attempt, delay)
+                await asyncio.sleep(delay)
+                continue
+            metrics_lib.observe('action_seconds', time.monotonic() - start, kind=kind)
+            return result
+
+
+actions = ActionScheduler()
@@ -0,0 +1,200 @@
+import gzip
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+import metrics_lib
+
+
+class ResponseArchive:
+    """
+    A bounded archive of raw API responses, indexed by the IDs of the games
+    in them - for looking at later, and as a corpus of real documents for
+    the benchmarks.
+
+    Each response is compressed as its own gzip member and appended to the
+    current segment file, so any one response can be read back by seeking
+    to it.  When a segment reaches segment_bytes a new one is started, and
+    when all the segments add up to more than max_bytes the oldest are
+    deleted.  The index - game ID to segment, offset and length - is kept in
+    memory and appended to index.jsonl, which is rewritten without the
+    deleted segments' entries whenever one goes.
+
+    Responses are written by a background thread, so append() never waits
+    on the disk.
+    """
+    def __init__(self, directory, segment_bytes=8 * 1024 * 1024, max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self._index = dict()  # game_id: (segment, offset, length)
+        self._segments = []  # segment numbers, oldest first
+        self._lock = threading.Lock()  # around the index and the segment list
+        self._queue = queue.Queue()
+        self._thread = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _segment_path(self, segment):
+        return os.path.join(self.directory, f"segment_{segment:06d}.gz")
+
+    def _index_path(self):
+        return os.path.join(self.directory, 'index.jsonl')
+
+    def _load(self):
+        """
+        Find the segments and read the index.  Entries for segments that are
+        gone, or that point past the end of their segment because we stopped
+        mid-write, are skipped.
+        """
+        self._segments = sorted(
+            int(name[len('segment_'):-len('.gz')])
+            for name in os.listdir(self.directory)
+            if name.startswith('segment_') and name.endswith('.gz')
+        )
+        sizes = {segment: os.path.getsize(self._segment_path(segment)) for segment in self._segments}
+        if not os.path.exists(self._index_path()):
+            return
+        with open(self._index_path(), 'r') as fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                segment, offset, length = entry['segment'], entry['offset'], entry['length']
+                if offset + length <= sizes.get(segment, 0):
+                    for game_id in entry['game_ids']:
+                        self._index[game_id] = (segment, offset, length)
+        logging.info(
+            "Archive %s has %d games in %d segments",
+            self.directory, len(self._index), len(self._segments)
+        )
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, game_id):
+        return game_id in self._index
+
+    def append(self, game_ids, body):
+        """
+        Queue the raw response body, holding the games with these IDs, to be
+        archived.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(
+                target=self._run, name='archive-writer', daemon=True
+            )
+            self._thread.start()
+        self._queue.put((list(game_ids), body, time.time()))
+
+    def close(self):
+        """
+        Write everything queued so far and stop the writer thread.
+        """
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            try:
+                self._write(*item)
+            except Exception:
+                logging.exception("Could not archive response")
+
+    def _write(self, game_ids, body, fetched_at):
+        record = gzip.compress(
+            json.dumps({'game_ids': game_ids, 'fetched_at': fetched_at, 'body': body}).encode()
+        )
+        if not self._segments or os.path.getsize(self._segment_path(self._segments[-1])) >= self.segment_bytes:
+            with self._lock:
+                self._segments.append(self._segments[-1] + 1 if self._segments else 1)
+        segment = self._segments[-1]
+        with open(self._segment_path(segment), 'ab') as fh:
+            offset = fh.tell()
+            fh.write(record)
+        with open(self._index_path(), 'a') as fh:
+            fh.write(json.dumps({
+                'game_ids': game_ids, 'segment': segment, 'offset': offset, 'length': len(record)
+            }) + '\n')
+        with self._lock:
+            for game_id in game_ids:
+                self._index[game_id] = (segment, offset, len(record))
+        metrics_lib.incr('archive_responses')
+        metrics_lib.incr('archive_bytes', len(record))
+        self._rotate()
+
+    def _rotate(self):
+        """
+        Delete the oldest segments while we're over max_bytes, and rewrite
+        the index without them.
+        """
+        sizes = [os.path.getsize(self._segment_path(segment)) for segment in self._segments]
+        dropped = set()
+        while len(self._segments) > 1 and sum(sizes) > self.max_bytes:
+            dropped.add(self._segments[0])
+            os.remove(self._segment_path(self._segments[0]))
+            with self._lock:
+                del self._segments[0]
+            del sizes[0]
+        if not dropped:
+            return
+        with self._lock:
+            self._index = {
+                game_id: location for game_id, location in self._index.items()
+                if location[0] not in dropped
+            }
+            entries = dict()  # (segment, offset, length): [game_id]
+            for game_id, location in self._index.items():
+                entries.setdefault(location, []).append(game_id)
+        tmp_path = self._index_path() + '.tmp'
+        with open(tmp_path, 'w') as fh:
+            for (segment, offset, length), game_ids in sorted(entries.items()):
+                fh.write(json.dumps({
+                    'game_ids': game_ids, 'segment': segment, 'offset': offset, 'length': length
+                }) + '\n')
+        os.replace(tmp_path, self._index_path())
+        logging.info("Archive dropped segments %s", sorted(dropped))
+
+    def _read(self, location):
+        segment, offset, length = location
+        with open(self._segment_path(segment), 'rb') as fh:
+            fh.seek(offset)
+            return json.loads(gzip.decompress(fh.read(length)))
+
+    def get(self, game_id):
+        """
+        Return the raw body of the last response archived with this game in
+        it, or None.  This reads from disk, so call it from a worker thread
+        in the bot.
+        """
+        with self._lock:
+            location = self._index.get(game_id)
+        if location is None:
+            return None
+        try:
+            return self._read(location)['body']
+        except FileNotFoundError:  # rotated away since we looked
+            return None
+
+    def records(self):
+        """
+        Yield the archived responses that are the latest for at least one
+        game, oldest first, as dicts with the game_ids, fetched_at time and
+        body.
+        """
+        with self._lock:
+            locations = sorted(set(self._index.values()))
+        for location in locations:
+            try:
+                yield self._read(location)
+            except FileNotFoundError:
+                continue
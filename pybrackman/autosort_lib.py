@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import random
+import time
+
+from db_lib import (
+    db_get_watched_channels_async, db_watch_channel_async, db_unwatch_channel_async
+)
+from faf_lib import faf_get_last_games_for_faf_ids_async
+from roster_lib import rosters
+
+
+class AutoSorter:
+    """
+    Watch voice channels and sort the games of the people in them without
+    anyone having to ask.
+
+    On every tick we find the FAF IDs of everyone in every watched channel,
+    across all guilds, and ask FAF for their last games in one batched
+    request.  Each of those games that's still running and that we haven't
+    sorted yet in that guild is handed to sort_fn(guild, channel, game,
+    members).  A game counts as sorted once sort_fn returns something true,
+    so a sort that fails is tried again on the next tick.  Sorted games are
+    remembered until FAF says they've ended, or for sorted_ttl seconds, so
+    players who come back to the channel mid-game aren't sorted again.
+
+    When nothing changes from one tick to the next the interval doubles, up to
+    max_interval, and it drops back to interval when something does - or when
+    someone joins a watched channel.  Each sleep is varied by up to the jitter
+    fraction so that we don't tick in lockstep with anything else.
+    """
+    def __init__(self, bot, sort_fn, interval=30, max_interval=120, jitter=0.2,
+                 sorted_ttl=4 * 3600):
+        self.bot = bot
+        self.sort_fn = sort_fn
+        self.interval = interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.sorted_ttl = sorted_ttl
+        self.current_interval = interval
+        self.watched = set()  # (guild_id, channel_id)
+        self.sorted_games = dict()  # (guild_id, game_id): time.monotonic() when sorted
+        self._last_state = None
+        self._wake = asyncio.Event()
+        self._task = None
+
+    async def load(self):
+        """
+        Load the watched channels from the database.
+        """
+        self.watched = set(await db_get_watched_channels_async())
+        logging.info("Auto-sort watching %d channels", len(self.watched))
+
+    async def watch(self, channel):
+        self.watched.add((channel.guild.id, channel.id))
+        await db_watch_channel_async(channel.guild.id, channel.id)
+        self.poke()
+
+    async def unwatch(self, channel):
+        """
+        Stop watching this channel.  Returns True if it was being watched.
+        """
+        self.watched.discard((channel.guild.id, channel.id))
+        return await db_unwatch_channel_async(channel.guild.id, channel.id)
+
+    def is_watched(self, channel):
+        return (channel.guild.id, channel.id) in self.watched
+
+    def poke(self):
+        """
+        Something's happened in a watched channel - if we've backed off,
+        check it now and go back to the normal interval.
+        """
+        if self.current_interval > self.interval:
+            self.current_interval = self.interval
+            self._wake.set()
+
+    async def watched_players(self):
+        """
+        Return a list of (guild, channel, member, faf_id) for everyone in the
+        watched channels that we know the FAF ID of.
+        """
+        placed_in_guild = dict()  # guild: {discord_id: (channel, member)}
+        for guild_id, channel_id in self.watched:
+            channel = self.bot.get_channel(channel_id)
+            if channel is None or channel.guild.id != guild_id:
+                continue
+            placed = placed_in_guild.setdefault(channel.guild, dict())
+            for member in channel.members:
+                if not member.bot:
+                    placed[member.id] = (channel, member)
+        players = []
+        for guild, placed in placed_in_guild.items():
+            if not placed:
+                continue
+            roster = await rosters.get(guild)
+            for discord_id, faf_id in roster.faf_ids_of_discord_ids(placed).items():
+                channel, member = placed[discord_id]
+                players.append((guild, channel, member, faf_id))
+        return players
+
+    async def tick(self):
+        """
+        Look for new games in the watched channels and sort them.  Returns
+        True if anything has changed since the last tick.
+        """
+        players = await self.watched_players()
+        game_of_player = dict()
+        if players:
+            game_of_player = await faf_get_last_games_for_faf_ids_async(
+                {faf_id for _, _, _, faf_id in players}
+            )
+        # Forget the games sorted too long ago to still be running
+        now = time.monotonic()
+        for key, sorted_at in list(self.sorted_games.items()):
+            if now - sorted_at > self.sorted_ttl:
+                del self.sorted_games[key]
+        # Group the players by guild and game, so each is sorted once
+        to_sort = dict()  # (guild_id, game_id): (guild, channel, game, members)
+        running = set()
+        for guild, channel, member, faf_id in players:
+            game = game_of_player.get(faf_id)
+            if not game:
+                continue
+            key = (guild.id, game.id)
+            if game.end_time:
+                self.sorted_games.pop(key, None)
+                continue
+            running.add(key)
+            if key in self.sorted_games:
+                continue
+            if key not in to_sort:
+                to_sort[key] = (guild, channel, game, [])
+            to_sort[key][3].append(member)
+
+        state = (
+            frozenset((guild.id, member.id, faf_id) for guild, _, member, faf_id in players),
+            frozenset(running),
+        )
+        changed = state != self._last_state
+        self._last_state = state
+
+        results = await asyncio.gather(*[
+            self.sort_fn(guild, channel, game, members)
+            for guild, channel, game, members in to_sort.values()
+        ], return_exceptions=True)
+        for (guild_id, game_id), result in zip(to_sort, results):
+            if isinstance(result, Exception):
+                logging.error(
+                    "Auto-sort of game %s in guild %s failed: %r",
+                    game_id, guild_id, result
+                )
+            elif result:
+                self.sorted_games[(guild_id, game_id)] = time.monotonic()
+            else:
+                logging.info(
+                    "Auto-sort of game %s in guild %s failed - will try again",
+                    game_id, guild_id
+                )
+        return changed
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        await self.load()
+        while not self.bot.is_closed():
+            try:
+                changed = await self.tick()
+            except Exception:
+                logging.exception("Auto-sort tick failed")
+                changed = False
+            if changed:
+                self.current_interval = self.interval
+            else:
+                self.current_interval = min(self.current_interval * 2, self.max_interval)
+            delay = self.current_interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        """
+        Start watching in the background.  Must be called from within the
+        running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
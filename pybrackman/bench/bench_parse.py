@@ -0,0 +1,120 @@
+"""
+Compare the size and parse time of game documents before and after asking
+for sparse fieldsets, and the old two-pass parser with the indexed one.
+
+    python bench/bench_parse.py [game_1234.json | archive_dir ...]
+
+With no files, a generated 8v8 game is used.  On that, the payload goes
+from 51009 bytes (2863 gzipped) to 4692 (473 gzipped), and a typical run
+gives legacy/full 558us, indexed/full 590us and indexed/sparse 140us.  So
+the time saved comes from the sparse fieldsets: on the full payload the
+indexed parser is no faster than the old one.
+"""
+import argparse
+import gzip
+import json
+import logging
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from payloads import load_game_docs, make_game_doc, sparse_game_doc  # noqa: E402
+from faf_lib import faf_data_to_game_data  # noqa: E402
+
+
+def legacy_faf_data_to_game_data(faf_data):
+    """
+    The parser as it was before the included objects were indexed: a scan of
+    'included' for the host's name, then another for the players.
+    """
+    gamedata = faf_data['data'][0]
+    host_name = 'someone'
+    host_id = gamedata['relationships']['host']['data']['id']
+    for inc in faf_data['included']:
+        if inc['type'] == 'player' and inc['id'] == host_id:
+            host_name = inc['attributes']['login']
+    game = {
+        'name': gamedata['attributes']['name'],
+        'id': gamedata['id'],
+        'end_time': gamedata['attributes'].get('endTime'),
+        'start_time': gamedata['attributes']['startTime'],
+        'host_faf_id': host_id,
+        'host_faf_name': host_name,
+    }
+    players = dict()
+    max_team = 0
+    for include in faf_data['included']:
+        key = ''
+        if include['type'] == 'player':
+            faf_id = include['id']
+            key = 'name'
+            value = include['attributes']['login']
+        elif include['type'] == 'gamePlayerStats':
+            faf_id = include['relationships']['player']['data']['id']
+            key = 'team'
+            value = include['attributes']['team'] - 1
+            if value > max_team:
+                max_team = value
+        if key in ('name', 'team'):
+            if faf_id not in players:
+                players[faf_id] = dict()
+            players[faf_id][key] = value
+    game['players'] = players
+    game['teams'] = max_team
+    return game
+
+
+def time_parse(parser, body, number):
+    """
+    Mean seconds to decode and parse the body.
+    """
+    return timeit.timeit(lambda: parser(json.loads(body)), number=number) / number
+
+
+def bench_doc(doc, number):
+    full_body = json.dumps(doc)
+    sparse_body = json.dumps(sparse_game_doc(doc))
+    return {
+        'game_id': doc['data'][0]['id'],
+        'players': sum(1 for inc in doc['included'] if inc['type'] == 'gamePlayerStats'),
+        'full_bytes': len(full_body),
+        'full_gzip_bytes': len(gzip.compress(full_body.encode())),
+        'sparse_bytes': len(sparse_body),
+        'sparse_gzip_bytes': len(gzip.compress(sparse_body.encode())),
+        'legacy_full_parse_us': time_parse(legacy_faf_data_to_game_data, full_body, number) * 1e6,
+        'indexed_full_parse_us': time_parse(faf_data_to_game_data, full_body, number) * 1e6,
+        'indexed_sparse_parse_us': time_parse(faf_data_to_game_data, sparse_body, number) * 1e6,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('files', nargs='*', help='recorded game documents')
+    parser.add_argument('--number', type=int, default=2000, help='parses per measurement')
+    parser.add_argument('--json', action='store_true', help='print results as JSON')
+    args = parser.parse_args()
+    # The parser logs every game at INFO, which would swamp the timings.
+    logging.disable(logging.INFO)
+
+    docs = load_game_docs(args.files) if args.files else [make_game_doc()]
+    results = [bench_doc(doc, args.number) for doc in docs]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+    for result in results:
+        print(f"game {result['game_id']} ({result['players']} players)")
+        print(
+            f"  bytes: full {result['full_bytes']} ({result['full_gzip_bytes']} gzipped), "
+            f"sparse {result['sparse_bytes']} ({result['sparse_gzip_bytes']} gzipped)"
+        )
+        print(
+            f"  parse: legacy/full {result['legacy_full_parse_us']:.1f}us, "
+            f"indexed/full {result['indexed_full_parse_us']:.1f}us, "
+            f"indexed/sparse {result['indexed_sparse_parse_us']:.1f}us"
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,296 @@
+"""
+Benchmark the stages of the sort pipeline offline, against a local stand-in
+for the FAF API and fake Discord objects.
+
+    python bench/bench_sort.py [--players 2,4,8,16] [--rows 1000,1000000]
+        [--iterations 200] [--output results.json] [--compare old.json]
+        [game_1234.json | archive_dir ...]
+
+The stages are:
+    parse        faf_data_to_game_data() on a sparse game document
+    fetch        a last-game lookup through faf_lib, over HTTP, uncached
+    db_*         the players table queries, with the table at each size
+    resolve      resolve_players() with the guild's roster loaded...
+    resolve_cold ...and having to load it first
+    sort         sort_game_players() for a new game: channels and moves
+    resort       sort_game_players() again for a game that's sorted
+
+Each is timed over the iterations and summarised as percentiles, then run
+again with tracemalloc to measure the memory it allocates; the sorts also
+count the Discord calls each makes.  Recorded game documents, if given, are
+parsed as well as the generated ones.  Our own rate limits on Discord calls
+are lifted, as the fake Discord doesn't need them and they'd hide the cost
+of everything else.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_lib  # noqa: E402
+
+from fakes import FakeFAF, FakeGuild, FakeTokenManager  # noqa: E402
+from payloads import load_game_docs, make_game_doc, sparse_game_doc  # noqa: E402
+import results as results_lib  # noqa: E402
+
+ROWS_PER_GUILD = 1000
+BENCH_GUILD_ID = 1
+
+
+def int_list(text):
+    return [int(value) for value in text.split(',')]
+
+
+async def measure(func, iterations, setup=None):
+    """
+    Time iterations of func() - which may be a coroutine function - and
+    then measure the peak memory each allocates.  setup(), if given, is run
+    before each call, untimed.  Returns the summary.
+    """
+    async def call():
+        result = func()
+        if asyncio.iscoroutine(result):
+            await result
+
+    times = []
+    for _ in range(iterations):
+        if setup:
+            await setup()
+        start = time.perf_counter()
+        await call()
+        times.append(time.perf_counter() - start)
+    summary = results_lib.summarise(times)
+
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(min(iterations, 20)):
+            if setup:
+                await setup()
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            await call()
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    finally:
+        tracemalloc.stop()
+    summary['alloc_peak_bytes'] = sum(peaks) / len(peaks)
+    return summary
+
+
+def fill_players(target_rows, have_rows):
+    """
+    Grow the players table to target_rows, in guilds of ROWS_PER_GUILD.  The
+    benchmark's own guild is the first.  Returns the new row count.
+    """
+    chunk = []
+    for row in range(have_rows, target_rows):
+        guild_id = BENCH_GUILD_ID + row // ROWS_PER_GUILD
+        chunk.append((row + 1, f"player{row + 1}", guild_id, 10**9 + row, f"Member{row + 1}"))
+        if len(chunk) == 10000:
+            db_lib.db_set_users(chunk)
+            chunk = []
+    if chunk:
+        db_lib.db_set_users(chunk)
+    return max(target_rows, have_rows)
+
+
+async def bench_parse(args, results):
+    from faf_lib import faf_data_to_game_data
+    docs = [('generated', players, sparse_game_doc(make_game_doc(per_team=max(players // 2, 1))))
+            for players in args.players]
+    docs += [('recorded', None, sparse_game_doc(doc)) for doc in load_game_docs(args.files)]
+    for source, players, doc in docs:
+        body = json.dumps(doc)
+        results.append({
+            'stage': 'parse', 'source': source,
+            'players': players or sum(1 for inc in doc['included'] if inc['type'] == 'gamePlayerStats'),
+            **await measure(lambda: faf_data_to_game_data(json.loads(body)), args.iterations),
+        })
+
+
+async def bench_fetch(args, results, faf):
+    import faf_lib
+    for players in args.players:
+        game_id = 500000 + players
+        first_faf_id = 100000 * players
+        faf.add_lobby(game_id, players, first_faf_id)
+        results.append({
+            'stage': 'fetch', 'players': players,
+            **await measure(lambda: faf_lib.faf_get_last_game_for_faf_id_async(first_faf_id), args.iterations),
+        })
+
+
+async def bench_db(args, results):
+    rows = 0
+    lobby_ids = list(range(1, 17))
+    for target in args.rows:
+        rows = fill_players(target, rows)
+        for players in args.players:
+            faf_ids = lobby_ids[:players]
+            users = [(faf_id, f"player{faf_id}", BENCH_GUILD_ID, 10**9 + faf_id - 1, f"Member{faf_id}")
+                     for faf_id in faf_ids]
+            for stage, func in (
+                ('db_get_users', lambda: db_lib.db_get_users(faf_ids, BENCH_GUILD_ID)),
+                ('db_set_users', lambda: db_lib.db_set_users(users)),
+            ):
+                results.append({'stage': stage, 'rows': rows, 'players': players,
+                                **await measure(func, args.iterations)})
+        for stage, func in (
+            ('db_get_user', lambda: db_lib.db_get_user(faf_username='PLAYER7')),
+            ('db_get_guild_users', lambda: db_lib.db_get_guild_users(BENCH_GUILD_ID)),
+        ):
+            results.append({'stage': stage, 'rows': rows, **await measure(func, args.iterations)})
+
+
+def make_lobby(guild, faf, game_id, players):
+    """
+    Add a game to FAF and its players to the guild's lobby, all known to the
+    guild's roster.  Returns the game's members.
+    """
+    first_faf_id = 1000000 + game_id * 100
+    faf.add_lobby(game_id, players, first_faf_id)
+    members = [
+        guild.add_member(f"player{first_faf_id + slot}", guild.lobby)
+        for slot in range(players)
+    ]
+    db_lib.db_set_users([
+        (first_faf_id + slot, member.display_name, guild.id, member.id, member.display_name)
+        for slot, member in enumerate(members)
+    ])
+    return first_faf_id, members
+
+
+async def bench_sort(args, results, faf):
+    import brackman
+    import faf_lib
+    from roster_lib import rosters
+    for players in args.players:
+        guild = FakeGuild(1000 + players)
+        game_id = 600000 + players * 1000
+        first_faf_id, members = make_lobby(guild, faf, game_id, players)
+        game = await faf_lib.faf_get_game_async(game_id)
+
+        await rosters.get(guild)
+        results.append({'stage': 'resolve', 'players': players, **await measure(
+            lambda: brackman.resolve_players(guild, game.copy().players, [guild.lobby]),
+            args.iterations,
+        )})
+
+        async def evict():
+            rosters._rosters.pop(guild.id, None)
+        results.append({'stage': 'resolve_cold', 'players': players, **await measure(
+            lambda: brackman.resolve_players(guild, game.copy().players, [guild.lobby]),
+            args.iterations, setup=evict,
+        )})
+
+        # Each sort is of a new game, as the previous one's channels would be
+        # found rather than made; its channels are deleted and its players
+        # put back in the lobby first.
+        games = iter(range(game_id + 1, game_id + 1000))
+        current = dict()
+
+        async def new_game():
+            for channel in guild.voice_channels:
+                if channel is not guild.lobby:
+                    brackman.temp_channels.forget(channel.id)
+                    guild.remove_channel(channel)
+            for member in members:
+                guild.place(member, guild.lobby)
+            current['game'] = (await faf_lib.faf_get_game_async(game_id)).copy()
+            current['game'].id = next(games)
+
+        def sort():
+            return brackman.sort_game_players(
+                guild, guild.lobby, members[0].display_name, current['game'], guild.lobby, members[0].id
+            )
+
+        async def same_game():
+            current['game'] = current['game'].copy()
+
+        # Discord calls are counted per sort, as they're what a sort costs
+        # against the real rate limits.
+        runs = args.iterations + min(args.iterations, 20)
+        for stage, setup in (('sort', new_game), ('resort', same_game)):
+            guild.api.calls.clear()
+            results.append({'stage': stage, 'players': players, **await measure(
+                sort, args.iterations, setup=setup
+            )})
+            results[-1]['discord_calls'] = {
+                kind: count / runs for kind, count in sorted(guild.api.calls.items())
+            }
+
+
+async def run(args):
+    import faf_lib
+    from action_lib import actions
+    actions.configure(limits={
+        kind: (10**6, 1.0) for kind in ('create', 'edit', 'move', 'delete', 'global')
+    })
+    faf = FakeFAF()
+    await faf.start()
+    faf_lib.api_root = faf.api_root
+    faf_lib.token_manager = FakeTokenManager()
+    # Every lookup goes to the stand-in rather than a cache
+    faf_lib.session_config['last_game_ttl'] = 0
+    faf_lib.last_game_cache.configure(ttl=0)
+    results = []
+    try:
+        for stage, bench in (
+            ('parse', lambda: bench_parse(args, results)),
+            ('fetch', lambda: bench_fetch(args, results, faf)),
+            ('db', lambda: bench_db(args, results)),
+            ('sort', lambda: bench_sort(args, results, faf)),
+        ):
+            if stage in args.stages:
+                print(f"Running {stage} stages...", file=sys.stderr)
+                await bench()
+    finally:
+        await faf_lib.faf_close()
+        await faf.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('files', nargs='*', help='recorded game documents or archive directories')
+    parser.add_argument('--players', type=int_list, default=[2, 4, 8, 12, 16], help='lobby sizes')
+    parser.add_argument('--rows', type=int_list, default=[1000, 10000, 100000, 1000000],
+                        help='players table sizes')
+    parser.add_argument('--iterations', type=int, default=200, help='timed calls per measurement')
+    parser.add_argument('--stages', type=lambda text: text.split(','),
+                        default=['parse', 'fetch', 'db', 'sort'], help='stages to run')
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='compare with results saved earlier')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_lib.db_config['path'] = os.path.join(tmp_dir, 'bench.db')
+        results = asyncio.run(run(args))
+        db_lib.db_close()
+
+    params = ['stage', 'source', 'rows', 'players']
+    for result in results:
+        label = ' '.join(f"{param}={result[param]}" for param in params[1:] if result.get(param) is not None)
+        print(
+            f"{result['stage']:<18} {label:<28} p50 {result['p50_us']:>9.1f}us  "
+            f"p90 {result['p90_us']:>9.1f}us  p99 {result['p99_us']:>9.1f}us  "
+            f"alloc {result['alloc_peak_bytes'] / 1024:>8.1f}KiB"
+        )
+    if args.output:
+        options = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+        results_lib.save(args.output, results_lib.run_meta(options), results)
+    if args.compare:
+        results_lib.compare(args.compare, results, params)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,294 @@
+"""
+Stand-ins for FAF and Discord, for the benchmarks.
+
+FakeFAF is a local HTTP server answering the game queries faf_lib makes,
+from game documents it's given, with optional added latency and errors.
+FakeGuild, FakeVoiceChannel and FakeMember have the parts of discord.py's
+objects that the sort pipeline uses; their API calls take a configurable
+time and can be made to fail.
+"""
+import asyncio
+import json
+import os
+import random
+import re
+import sys
+
+from aiohttp import web
+import discord
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from payloads import make_game_doc, sparse_game_doc  # noqa: E402
+
+
+class FakeTokenManager:
+    """
+    Stands in for oauth_lib.TokenManager when talking to FakeFAF.
+    """
+    async def get_token(self):
+        return 'bench-token'
+
+    async def stop(self):
+        pass
+
+
+class FakeFAF:
+    """
+    A local FAF API serving the games it's given.  Each request waits for
+    latency seconds - a number, or a (low, high) range to pick from - and
+    fails with a 503 with probability error_rate.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0, port=0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.port = port
+        self.requests = 0
+        self.errors = 0
+        self._docs = dict()  # game_id: document
+        self._game_of_player = dict()  # faf_id: game_id, the newest
+        self._runner = None
+
+    @property
+    def api_root(self):
+        return f"http://127.0.0.1:{self.port}/data/"
+
+    def add_game(self, doc):
+        """
+        Add a game document - full or sparse; it's served sparse, as FAF
+        would for faf_lib's queries.
+        """
+        doc = sparse_game_doc(doc)
+        game = doc['data'][0]
+        game_id = int(game['id'])
+        self._docs[game_id] = doc
+        for inc in doc['included']:
+            if inc['type'] == 'gamePlayerStats':
+                faf_id = int(inc['relationships']['player']['data']['id'])
+                if game_id >= self._game_of_player.get(faf_id, 0):
+                    self._game_of_player[faf_id] = game_id
+        return game_id
+
+    def add_lobby(self, game_id, players, first_faf_id, teams=2, ended=False, name=None):
+        """
+        Make up and add a game of this many players.
+        """
+        return self.add_game(make_game_doc(
+            game_id=game_id, teams=teams, per_team=max(players // teams, 1),
+            ended=ended, first_faf_id=first_faf_id, name=name,
+        ))
+
+    def _games_doc(self, game_ids):
+        data = []
+        included = dict()
+        for game_id in sorted(set(game_ids), reverse=True):
+            doc = self._docs[game_id]
+            data.extend(doc['data'])
+            for inc in doc['included']:
+                included[(inc['type'], inc['id'])] = inc
+        return {'data': data, 'included': list(included.values())}
+
+    async def _game(self, request):
+        self.requests += 1
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = random.uniform(*latency)
+        if latency:
+            await asyncio.sleep(latency)
+        if self.error_rate and random.random() < self.error_rate:
+            self.errors += 1
+            return web.Response(status=503, text='{"errors": [{"title": "Service Unavailable"}]}')
+        rsql = request.query.get('filter', '')
+        if match := re.match(r'id==(\d+)', rsql):
+            game_ids = [int(match.group(1))] if int(match.group(1)) in self._docs else []
+        elif match := re.match(r'playerStats\.player\.id==(\d+)', rsql):
+            game_id = self._game_of_player.get(int(match.group(1)))
+            game_ids = [game_id] if game_id else []
+        elif match := re.match(r'playerStats\.player\.id=in=\(([\d,]+)\)', rsql):
+            game_ids = [
+                self._game_of_player[faf_id] for faf_id in map(int, match.group(1).split(','))
+                if faf_id in self._game_of_player
+            ]
+        else:
+            return web.Response(status=400, text='{"errors": [{"title": "Bad filter"}]}')
+        if int(request.query.get('page[number]', 1)) > 1:
+            game_ids = []
+        return web.Response(text=json.dumps(self._games_doc(game_ids)), content_type='application/vnd.api+json')
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get('/data/game', self._game)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+
+class FakeAPI:
+    """
+    The cost of Discord API calls: each takes latency seconds - a number, or
+    a (low, high) range - and fails with probability error_rate, as a 503
+    would.  Calls are counted by kind.
+    """
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.calls = dict()
+
+    async def call(self, kind):
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        latency = self.latency
+        if isinstance(latency, (tuple, list)):
+            latency = random.uniform(*latency)
+        if latency:
+            await asyncio.sleep(latency)
+        if self.error_rate and random.random() < self.error_rate:
+            raise discord.DiscordServerError(FakeResponse(503), 'Service Unavailable')
+
+
+class FakeResponse:
+    """
+    Just enough of an aiohttp response for discord.HTTPException.
+    """
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'Fake'
+
+
+class FakeVoiceState:
+    __slots__ = ('channel',)
+
+    def __init__(self, channel):
+        self.channel = channel
+
+
+class FakeMember:
+    def __init__(self, guild, member_id, display_name, bot=False):
+        self.guild = guild
+        self.id = member_id
+        self.display_name = display_name
+        self.bot = bot
+        self.voice = None
+
+    async def move_to(self, channel):
+        await self.guild.api.call('move')
+        self.guild.place(self, channel)
+
+
+class FakeVoiceChannel:
+    def __init__(self, guild, channel_id, name, category=None):
+        self.guild = guild
+        self.id = channel_id
+        self.name = name
+        self.category = category
+        self.members = []
+
+    @property
+    def category_id(self):
+        return self.category.id if self.category else None
+
+    async def edit(self, name=None, position=None, reason=None):
+        await self.guild.api.call('edit')
+        if name is not None:
+            self.name = name
+
+    async def delete(self, reason=None):
+        await self.guild.api.call('delete')
+        self.guild.remove_channel(self)
+
+    async def send(self, content):
+        await self.guild.api.call('send')
+
+    def __repr__(self):
+        return f"<FakeVoiceChannel {self.name}>"
+
+
+class FakeCategory:
+    def __init__(self, category_id):
+        self.id = category_id
+
+
+class FakeGuild:
+    """
+    A guild with one category and a lobby voice channel.  IDs are made up
+    from the guild ID so several guilds never share one.
+
+    If on_voice_state is given, it's called as the gateway would call
+    on_voice_state_update(member, before, after) for each move, as a task.
+    """
+    def __init__(self, guild_id, api=None, on_voice_state=None):
+        self.id = guild_id
+        self.api = api or FakeAPI()
+        self.on_voice_state = on_voice_state
+        self._events = set()  # the event tasks still running
+        self.members = []
+        self._channels = dict()
+        self._next_id = guild_id * 1000000
+        self.category = FakeCategory(self._new_id())
+        self.lobby = self.add_channel('Lobby')
+
+    def _new_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    @property
+    def voice_channels(self):
+        return list(self._channels.values())
+
+    def get_channel(self, channel_id):
+        return self._channels.get(channel_id)
+
+    def add_channel(self, name):
+        channel = FakeVoiceChannel(self, self._new_id(), name, self.category)
+        self._channels[channel.id] = channel
+        return channel
+
+    def remove_channel(self, channel):
+        self._channels.pop(channel.id, None)
+
+    def add_member(self, display_name, channel=None):
+        member = FakeMember(self, self._new_id(), display_name)
+        self.members.append(member)
+        if channel is not None:
+            self.place(member, channel)
+        return member
+
+    def place(self, member, channel):
+        before = member.voice
+        if before is not None:
+            before.channel.members.remove(member)
+        channel.members.append(member)
+        member.voice = FakeVoiceState(channel)
+        if self.on_voice_state is not None:
+            task = asyncio.create_task(
+                self.on_voice_state(member, before or FakeVoiceState(None), member.voice)
+            )
+            self._events.add(task)
+            task.add_done_callback(self._events.discard)
+
+    async def create_voice_channel(self, name, reason=None, position=None, category=None):
+        await self.api.call('create')
+        return self.add_channel(name)
+
+
+class FakeContext:
+    """
+    Enough of a commands.Context to call a command's callback directly.
+    """
+    def __init__(self, guild, author):
+        self.guild = guild
+        self.author = author
+        self.replies = []
+
+    async def send(self, content):
+        await self.guild.api.call('send')
+        self.replies.append(content)
+
+    async def reply(self, content):
+        await self.send(content)
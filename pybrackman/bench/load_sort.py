@@ -0,0 +1,267 @@
+"""
+Load test f/sort: many guilds issuing sorts at once, against a local
+stand-in for the FAF API and fake Discord guilds, to find how many one bot
+process can handle before latency degrades.
+
+    python bench/load_sort.py [--guilds 20] [--rates 0.05,0.1,0.2,0.5]
+        [--duration 30] [--players 8] [--faf-latency 0.05,0.3]
+        [--faf-errors 0.01] [--discord-latency 0.05,0.2] [--discord-errors 0]
+        [--output results.json] [--compare old.json]
+
+For each rate - sorts per second in each guild - every guild starts new
+games at random (Poisson) times for the duration.  Each game's players are
+waiting in a lobby channel of their own, all known to the bot, and one of
+them issues f/sort; with --join some fraction of games get a second f/sort
+from another player, as happens when two people ask at once.  The command
+is run as the bot would run it, with the Discord calls queued under the
+usual rate limits, and moves are fed back as voice state events.  Arrivals
+don't wait for earlier sorts to finish, so past capacity the backlog - and
+the latency - grows.
+
+Each step reports the throughput, the latency of the sorts as percentiles,
+how many failed, and the event loop's lag: how late a timer firing every
+10ms actually ran.  Latencies in seconds can be given as a number or a
+low,high range to pick from.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import db_lib  # noqa: E402
+
+from fakes import FakeAPI, FakeContext, FakeFAF, FakeGuild, FakeTokenManager  # noqa: E402
+import results as results_lib  # noqa: E402
+
+LAG_INTERVAL = 0.01
+# Each game's players get FAF IDs in a block of this many
+FAF_IDS_PER_GAME = 32
+
+
+def float_list(text):
+    return [float(value) for value in text.split(',')]
+
+
+def latency(text):
+    values = float_list(text)
+    return values[0] if len(values) == 1 else tuple(values)
+
+
+class LoadTest:
+    """
+    The guilds, the FAF stand-in and the record of one step's sorts.
+    """
+    def __init__(self, args, faf):
+        import brackman
+        self.args = args
+        self.faf = faf
+        self.brackman = brackman
+        self.guilds = [
+            FakeGuild(
+                guild_no + 1,
+                FakeAPI(args.discord_latency, args.discord_errors),
+                on_voice_state=brackman.on_voice_state_update,
+            )
+            for guild_no in range(args.guilds)
+        ]
+        self._next_game = 700000
+        self.latencies = []
+        self.failed = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._tasks = set()
+
+    async def new_game(self, guild):
+        """
+        Make up a running game, put its players in a new lobby channel in the
+        guild and tell the bot who they are.  Returns the game's members.
+        """
+        self._next_game += 1
+        game_id = self._next_game
+        first_faf_id = game_id * FAF_IDS_PER_GAME
+        self.faf.add_lobby(
+            game_id, self.args.players, first_faf_id, name=f"Load test game {game_id}"
+        )
+        lobby = guild.add_channel(f"Lobby {game_id}")
+        members = [
+            guild.add_member(f"player{first_faf_id + slot}", lobby)
+            for slot in range(self.args.players)
+        ]
+        await self.brackman.rosters.set_users([
+            (first_faf_id + slot, member.display_name, guild.id, member.id, member.display_name)
+            for slot, member in enumerate(members)
+        ])
+        return members
+
+    async def sort(self, guild, member):
+        ctx = FakeContext(guild, member)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        start = time.perf_counter()
+        try:
+            await self.brackman.sort.callback(ctx, None)
+            ok = member.voice.channel.name.endswith('(temp)')
+        except Exception as e:
+            logging.error("Sort failed: %r", e)
+            ok = False
+        finally:
+            self.in_flight -= 1
+        self.latencies.append(time.perf_counter() - start)
+        if not ok:
+            self.failed += 1
+
+    def start(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def guild_load(self, guild, rate, until, games):
+        """
+        Start games in the guild at this rate until the given time, from the
+        list of games made ready, or new ones if they run out.
+        """
+        while True:
+            await asyncio.sleep(random.expovariate(rate))
+            if time.perf_counter() >= until:
+                return
+            members = games.pop() if games else await self.new_game(guild)
+            self.start(self.sort(guild, members[0]))
+            if len(members) > 1 and random.random() < self.args.join:
+                self.start(self.sort(guild, members[-1]))
+
+    async def step(self, rate):
+        """
+        Run the load at this rate for the duration, then wait for the sorts
+        still running.  Returns the step's results.
+        """
+        self.latencies = []
+        self.failed = 0
+        self.max_in_flight = 0
+        lags = []
+        monitoring = True
+
+        async def monitor():
+            while monitoring:
+                start = time.perf_counter()
+                await asyncio.sleep(LAG_INTERVAL)
+                lags.append(max(0.0, time.perf_counter() - start - LAG_INTERVAL))
+
+        # Set the games up beforehand, so that isn't part of the load
+        games_of_guild = dict()
+        for guild in self.guilds:
+            games_of_guild[guild] = [
+                await self.new_game(guild)
+                for _ in range(int(rate * self.args.duration * 1.5) + 2)
+            ]
+        await asyncio.sleep(0.1)  # for their voice state events
+
+        monitor_task = asyncio.create_task(monitor())
+        faf_requests, faf_errors = self.faf.requests, self.faf.errors
+        start = time.perf_counter()
+        until = start + self.args.duration
+        await asyncio.gather(*[
+            self.guild_load(guild, rate, until, games_of_guild[guild]) for guild in self.guilds
+        ])
+        drained = True
+        if self._tasks:
+            _, pending = await asyncio.wait(set(self._tasks), timeout=self.args.drain)
+            drained = not pending
+        elapsed = time.perf_counter() - start
+        monitoring = False
+        await monitor_task
+
+        latency = results_lib.summarise(self.latencies)
+        lag = results_lib.summarise(lags)
+        return {
+            'guilds': len(self.guilds),
+            'rate': rate,
+            'offered_per_s': rate * len(self.guilds),
+            'completed': len(self.latencies),
+            'failed': self.failed,
+            'throughput_per_s': (len(self.latencies) - self.failed) / elapsed,
+            'max_in_flight': self.max_in_flight,
+            'drained': drained,
+            'faf_requests': self.faf.requests - faf_requests,
+            'faf_errors': self.faf.errors - faf_errors,
+            **latency,
+            'lag_p50_ms': lag['p50_us'] / 1000 if lags else None,
+            'lag_p99_ms': lag['p99_us'] / 1000 if lags else None,
+            'lag_max_ms': lag['max_us'] / 1000 if lags else None,
+        }
+
+
+async def run(args):
+    import faf_lib
+    from action_lib import actions
+    if args.no_limits:
+        actions.configure(limits={
+            kind: (10**6, 1.0) for kind in ('create', 'edit', 'move', 'delete', 'global')
+        })
+    faf = FakeFAF(args.faf_latency, args.faf_errors)
+    await faf.start()
+    faf_lib.api_root = faf.api_root
+    faf_lib.token_manager = FakeTokenManager()
+    load = LoadTest(args, faf)
+    results = []
+    try:
+        for rate in args.rates:
+            print(f"Running {rate}/s in each of {args.guilds} guilds...", file=sys.stderr)
+            results.append(await load.step(rate))
+    finally:
+        await faf_lib.faf_close()
+        await faf.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--guilds', type=int, default=20, help='number of guilds')
+    parser.add_argument('--rates', type=float_list, default=[0.05, 0.1, 0.2, 0.5],
+                        help='sorts per second in each guild, one step for each')
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run each step')
+    parser.add_argument('--drain', type=float, default=60,
+                        help='seconds to wait for the sorts still running after each step')
+    parser.add_argument('--players', type=int, default=8, help='players in each game')
+    parser.add_argument('--join', type=float, default=0.1,
+                        help='fraction of games a second player also sorts')
+    parser.add_argument('--faf-latency', type=latency, default=(0.05, 0.3), help='seconds')
+    parser.add_argument('--faf-errors', type=float, default=0.0, help='fraction of FAF requests failing')
+    parser.add_argument('--discord-latency', type=latency, default=(0.05, 0.2), help='seconds')
+    parser.add_argument('--discord-errors', type=float, default=0.0,
+                        help='fraction of Discord calls failing')
+    parser.add_argument('--no-limits', action='store_true', help="lift our own Discord rate limits")
+    parser.add_argument('--output', help='save the results as JSON')
+    parser.add_argument('--compare', help='compare with results saved earlier')
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_lib.db_config['path'] = os.path.join(tmp_dir, 'load.db')
+        results = asyncio.run(run(args))
+        db_lib.db_close()
+
+    for result in results:
+        print(
+            f"{result['rate']:>6}/s x {result['guilds']} guilds: "
+            f"{result['throughput_per_s']:6.2f} sorts/s, {result['failed']} failed of {result['completed']}  "
+            f"p50 {result['p50_us'] / 1e6:6.3f}s  p99 {result['p99_us'] / 1e6:6.3f}s  "
+            f"lag p99 {result['lag_p99_ms']:6.1f}ms max {result['lag_max_ms']:6.1f}ms"
+            f"{'' if result['drained'] else '  (not drained)'}"
+            if result['completed'] else f"{result['rate']:>6}/s: no sorts"
+        )
+    if args.output:
+        options = {key: value for key, value in vars(args).items() if key not in ('output', 'compare')}
+        results_lib.save(args.output, results_lib.run_meta(options), results)
+    if args.compare:
+        results_lib.compare(args.compare, results, ['guilds', 'rate'], measure='p99_us')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""
+Game documents for the benchmarks.
+
+Recorded documents - files holding one game document each, or the
+responses in the bot's archive - can be loaded with load_game_docs().  When there aren't any to hand,
+make_game_doc() builds one shaped like what the FAF API returns for a game
+with include=host,playerStats.player,mapVersion,mapVersion.map and no sparse
+fieldsets: every attribute and relationship of every object.
+sparse_game_doc() cuts a full document down to what the API returns when
+asked with faf_lib's GAME_FIELDS and GAME_INCLUDES.
+"""
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from faf_lib import GAME_FIELDS, GAME_INCLUDES  # noqa: E402
+
+PLAYER_RELATIONSHIPS = [
+    'names', 'avatarAssignments', 'bans', 'clanMemberships', 'userNotes',
+    'reporterOnModerationReports', 'lobbyGroup', 'socialNotes',
+]
+
+
+def relationship(obj_type, obj_id, base, name):
+    return {
+        'links': {
+            'self': f"{base}/relationships/{name}",
+            'related': f"{base}/{name}",
+        },
+        'data': {'type': obj_type, 'id': str(obj_id)} if obj_id is not None else [],
+    }
+
+
+def make_player(faf_id):
+    base = f"https://api.faforever.com/data/player/{faf_id}"
+    return {
+        'type': 'player',
+        'id': str(faf_id),
+        'attributes': {
+            'login': f"player{faf_id}",
+            'createTime': '2019-05-17T10:45:36Z',
+            'updateTime': '2024-01-02T08:11:02Z',
+            'userAgent': 'faf-client',
+            'recentIpAddress': None,
+            'lastLogin': '2024-01-02T08:11:02Z',
+        },
+        'relationships': {
+            name: relationship(name, None, base, name)
+            for name in PLAYER_RELATIONSHIPS
+        },
+        'links': {'self': base},
+    }
+
+
+def make_player_stats(stats_id, faf_id, game_id, team, slot):
+    base = f"https://api.faforever.com/data/gamePlayerStats/{stats_id}"
+    return {
+        'type': 'gamePlayerStats',
+        'id': str(stats_id),
+        'attributes': {
+            'afterDeviation': 72.3, 'afterMean': 1423.9,
+            'ai': False, 'beforeDeviation': 73.1, 'beforeMean': 1410.2,
+            'color': slot + 1, 'faction': 1 + slot % 4, 'result': 'UNKNOWN',
+            'score': 0, 'scoreTime': None, 'startSpot': slot + 1, 'team': team,
+        },
+        'relationships': {
+            'game': relationship('game', game_id, base, 'game'),
+            'player': relationship('player', faf_id, base, 'player'),
+            'ratingChanges': relationship('leaderboardRatingJournal', None, base, 'ratingChanges'),
+        },
+        'links': {'self': base},
+    }
+
+
+def make_game_doc(game_id=21000000, teams=2, per_team=8, ended=False, first_faf_id=100000, name=None):
+    """
+    Build a full game document with the given number of teams of players.
+    """
+    base = f"https://api.faforever.com/data/game/{game_id}"
+    included = []
+    stats_refs = []
+    for slot in range(teams * per_team):
+        faf_id = first_faf_id + slot
+        stats_id = game_id * 100 + slot
+        included.append(make_player(faf_id))
+        included.append(make_player_stats(stats_id, faf_id, game_id, 2 + slot % teams, slot))
+        stats_refs.append({'type': 'gamePlayerStats', 'id': str(stats_id)})
+    included.append({
+        'type': 'mapVersion', 'id': '23001',
+        'attributes': {
+            'description': 'A map generated by the map generator. ' * 4,
+            'maxPlayers': teams * per_team, 'width': 1024, 'height': 1024,
+            'version': 1, 'folderName': 'neroxis_map_generator_1.10.2',
+            'ranked': True, 'hidden': False,
+            'createTime': '2023-07-01T00:00:00Z', 'updateTime': '2023-07-01T00:00:00Z',
+            'downloadUrl': 'https://content.faforever.com/maps/neroxis_map_generator_1.10.2.zip',
+            'thumbnailUrlSmall': 'https://content.faforever.com/maps/previews/small/neroxis.png',
+            'thumbnailUrlLarge': 'https://content.faforever.com/maps/previews/large/neroxis.png',
+        },
+        'relationships': {
+            'map': relationship('map', 9001, 'https://api.faforever.com/data/mapVersion/23001', 'map'),
+        },
+    })
+    included.append({
+        'type': 'map', 'id': '9001',
+        'attributes': {
+            'displayName': 'Neroxis Map Generator', 'gamesPlayed': 123456,
+            'recommended': False, 'createTime': '2020-01-01T00:00:00Z',
+            'updateTime': '2023-07-01T00:00:00Z',
+        },
+    })
+    doc = {
+        'data': [{
+            'type': 'game',
+            'id': str(game_id),
+            'attributes': {
+                'name': name or 'ANZ FAF 8v8 MapGen',
+                'replayUrl': f"https://replay.faforever.com/{game_id}",
+                'startTime': '2024-01-02T08:00:00Z',
+                'endTime': '2024-01-02T08:45:00Z' if ended else None,
+                'validity': 'VALID', 'victoryCondition': 'DEMORALIZATION',
+                'replayTicks': None, 'replayAvailable': False,
+            },
+            'relationships': {
+                'host': relationship('player', first_faf_id, base, 'host'),
+                'playerStats': {
+                    'links': {'self': f"{base}/relationships/playerStats"},
+                    'data': stats_refs,
+                },
+                'mapVersion': relationship('mapVersion', 23001, base, 'mapVersion'),
+                'featuredMod': relationship('featuredMod', 0, base, 'featuredMod'),
+                'reviews': relationship('gameReview', None, base, 'reviews'),
+                'reviewsSummary': relationship('gameReviewsSummary', None, base, 'reviewsSummary'),
+            },
+            'links': {'self': base},
+        }],
+        'included': included,
+        'meta': {'page': {'number': 1, 'limit': 1}},
+    }
+    return doc
+
+
+def sparse_game_doc(doc):
+    """
+    Cut a full game document down to the fields and included types we ask
+    for, as the API would have returned it.
+    """
+    wanted_types = {'game'}
+    type_of_include = {'host': 'player', 'playerStats': 'gamePlayerStats', 'player': 'player'}
+    for path in GAME_INCLUDES.split(','):
+        for name in path.split('.'):
+            wanted_types.add(type_of_include.get(name, name))
+
+    def trim(obj):
+        fields = GAME_FIELDS.get(obj['type'], '').split(',')
+        trimmed = {'type': obj['type'], 'id': obj['id']}
+        attributes = {k: v for k, v in obj.get('attributes', {}).items() if k in fields}
+        if attributes:
+            trimmed['attributes'] = attributes
+        relationships = {
+            k: {'data': v['data']}
+            for k, v in obj.get('relationships', {}).items() if k in fields
+        }
+        if relationships:
+            trimmed['relationships'] = relationships
+        return trimmed
+
+    return {
+        'data': [trim(obj) for obj in doc['data']],
+        'included': [trim(obj) for obj in doc.get('included', []) if obj['type'] in wanted_types],
+    }
+
+
+def load_game_docs(filenames):
+    """
+    Load recorded game documents, one per file - or, for a directory, every
+    response in the response archive there.
+    """
+    docs = []
+    for filename in filenames:
+        if os.path.isdir(filename):
+            docs.extend(load_archive_docs(filename))
+            continue
+        with open(filename, 'r') as fh:
+            docs.append(json.load(fh))
+    return docs
+
+
+def load_archive_docs(directory):
+    """
+    Load the game documents from a response archive.
+    """
+    from archive_lib import ResponseArchive
+    return [json.loads(record['body']) for record in ResponseArchive(directory).records()]
@@ -0,0 +1,87 @@
+"""
+Summarising, saving and comparing benchmark results.
+
+Results are saved as JSON: a 'meta' dict describing the run - commit,
+Python version, time and options - and a list of 'results', each a dict of
+the parameters of one measurement and its summary.
+"""
+import json
+import os
+import platform
+import subprocess
+import time
+
+
+def percentile(ordered, fraction):
+    """
+    The value at this fraction of the way through an ordered list, by the
+    nearest rank.
+    """
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarise(seconds):
+    """
+    Summarise a list of durations in seconds as microseconds.
+    """
+    ordered = sorted(seconds)
+    return {
+        'count': len(ordered),
+        'mean_us': sum(ordered) / len(ordered) * 1e6 if ordered else None,
+        'p50_us': percentile(ordered, 0.5) * 1e6 if ordered else None,
+        'p90_us': percentile(ordered, 0.9) * 1e6 if ordered else None,
+        'p99_us': percentile(ordered, 0.99) * 1e6 if ordered else None,
+        'max_us': ordered[-1] * 1e6 if ordered else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_meta(options):
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'options': options,
+    }
+
+
+def save(filename, meta, results):
+    with open(filename, 'w') as fh:
+        json.dump({'meta': meta, 'results': results}, fh, indent=2)
+        fh.write('\n')
+
+
+def result_key(result, params):
+    return tuple(result.get(param) for param in params)
+
+
+def compare(old_filename, results, params, measure='p50_us'):
+    """
+    Print how each result's measure compares with the same result - by the
+    given parameters - in an earlier results file.
+    """
+    with open(old_filename, 'r') as fh:
+        old = json.load(fh)
+    old_of_key = {result_key(result, params): result for result in old['results']}
+    print(f"\nCompared with {old['meta'].get('commit') or old_filename} ({measure}):")
+    for result in results:
+        before = old_of_key.get(result_key(result, params), {}).get(measure)
+        after = result.get(measure)
+        label = ' '.join(f"{param}={result.get(param)}" for param in params if result.get(param) is not None)
+        if before and after:
+            print(f"  {label}: {before:.1f} -> {after:.1f} ({(after - before) / before:+.0%})")
+        else:
+            print(f"  {label}: no earlier result")
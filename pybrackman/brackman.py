@@ -5,14 +5,27 @@ from discord.ext import commands
 import logging
 import pytz
 from random import choice
-from typing import Optional
+import time
+from typing import Literal, Optional
 import yaml
 
 from faf_lib import (
-    faf_get_player_for_user, faf_get_id_for_user, faf_get_last_game_for_faf_id,
-    init_oauth_config
+    faf_get_player_for_user_async, faf_get_id_for_user_async,
+    faf_get_last_game_for_faf_id_async, faf_get_game_async, faf_start, faf_close, init_oauth_config,
+    breaker as faf_breaker,
 )
-from db_lib import db_get_user, db_get_users, db_set_user
+from db_lib import db_get_user_async, db_init, db_close
+from cache_lib import TTLCache
+from autosort_lib import AutoSorter
+from log_lib import log_context, log_init, set_log_fields
+from roster_lib import rosters
+from sortjob_lib import sort_jobs, SortJob
+from action_lib import actions, PRIORITY_ISSUER, PRIORITY_MOVE
+from channel_lib import TempChannelPool
+from deadline_lib import (
+    DeadlineExceeded, deadline_for, deadline_init, no_deadline, set_deadline, wait_within, within
+)
+import metrics_lib
 
 logging.basicConfig(level=logging.INFO)
 
@@ -34,13 +47,25 @@ privileged_players = ['PaulWay', 'Millenwise', 'Angelofd347h']
 
 sydney_tz = pytz.timezone('Australia/Sydney')
 
-# A dictionary to record who's sorting which game - key is game ID, value is
-# the Discord display_name of the user that issued that command.  While we tidy
-# this up at the end of the sort function, it's not a big problem if every game
-# doesn't get removed because people don't sort old games...
+# Everyone who asks to sort a game while it's being sorted in their guild
+# is told how that sort is going and joins it, rather than starting their
+# own - see sort_jobs.  Players in games being sorted don't even need to ask
+# FAF for the game.
+
+# Channels still being created after their sort ran out of time - kept here
+# so they aren't garbage collected before they finish.
+unfinished_tasks = set()
 
-games_being_sorted = dict()
-sort_check_lock = asyncio.Lock()  # Use to modify games_being_sorted.
+# What we say when a stage of a command runs out of time
+deadline_replies = {
+    'player': "I'm taking too long to look you up - try again in a moment, indeed!",
+    'db': "I'm taking too long to look you up - try again in a moment, indeed!",
+    'faf_player': "FAF is taking too long to answer me - try again in a minute or so, indeed!",
+    'game': "FAF is taking too long to answer me - try again in a minute or so, indeed!",
+}
+# The channel each game was first sorted from, so a re-sort can pick up
+# people who've since joined it even if it's asked for from a team channel.
+lobby_of_game = TTLCache('sort_lobby', maxsize=500, ttl=6 * 3600)
 
 
 def read_config(config_filename):
@@ -57,36 +82,114 @@ def read_config(config_filename):
 # logger = logging.getLogger('brackman')
 # logging.addHandler(file_log)
 
-brackman = commands.Bot(command_prefix='f/', intents=intents)
+class Brackman(commands.Bot):
+    """
+    The bot, with our own background tasks started once it's running and our
+    resources tidied up when it shuts down.  The full config is set before
+    the bot is run.
+    """
+    config = dict()
+
+    async def setup_hook(self):
+        await faf_start()
+        rosters.configure(**(self.config.get('roster') or {}))
+        actions.configure(**(self.config.get('actions') or {}))
+        temp_channels.configure(**(self.config.get('temp_channels') or {}))
+        sort_jobs.configure(**(self.config.get('sort_jobs') or {}))
+        temp_channels.start()
+        metrics_config = self.config.get('metrics') or {}
+        if metrics_config.get('port'):
+            await metrics_lib.start_server(**metrics_config)
+        autosort_config = self.config.get('autosort') or {}
+        if autosort_config.get('enabled', True):
+            autosorter.interval = autosort_config.get('interval', autosorter.interval)
+            autosorter.max_interval = autosort_config.get('max_interval', autosorter.max_interval)
+            autosorter.jitter = autosort_config.get('jitter', autosorter.jitter)
+            autosorter.sorted_ttl = autosort_config.get('sorted_ttl', autosorter.sorted_ttl)
+            autosorter.start()
+
+    async def on_command_error(self, ctx, error):
+        original = getattr(error, 'original', error)
+        if isinstance(original, DeadlineExceeded):
+            await ctx.reply(deadline_replies.get(
+                original.stage, "I'm afraid that took me too long - try again in a moment!"
+            ))
+            return
+        if isinstance(error, commands.NoPrivateMessage):
+            await ctx.reply("I can only do that in a server, I'm afraid - not in private, indeed!")
+            return
+        await super().on_command_error(ctx, error)
+
+    async def close(self):
+        await autosorter.stop()
+        await temp_channels.stop()
+        await faf_close()
+        await metrics_lib.stop_server()
+        await super().close()
+        # Let any queued database writes finish.
+        await asyncio.to_thread(db_close)
+
+
+brackman = Brackman(command_prefix='f/', intents=intents)
+
+
+@brackman.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.monotonic()
+    # The FAF, database and Discord calls made for the command only get
+    # the time it has left
+    set_deadline(ctx.command.name)
+    # Everything logged while the command runs is tagged with it
+    set_log_fields(
+        guild_id=ctx.guild.id if ctx.guild else None,
+        command=ctx.command.name,
+        command_id=ctx.message.id,
+    )
+
+
+@brackman.after_invoke
+async def observe_command_time(ctx):
+    metrics_lib.observe('command_seconds', time.monotonic() - ctx.started_at, command=ctx.command.name)
 
 
 @brackman.event
 async def on_ready():
-    logging.info(f"Logged in as {brackman.user} (ID {brackman.user.id})")
+    logging.info("Logged in as %s (ID %s)", brackman.user, brackman.user.id)
+    # Pick up the temporary channels left from before we started
+    for guild in brackman.guilds:
+        temp_channels.adopt(guild)
+
+
+@brackman.event
+async def on_guild_join(guild):
+    temp_channels.adopt(guild)
+
+
+@brackman.event
+async def on_guild_channel_delete(channel):
+    temp_channels.forget(channel.id)
 
 
 @brackman.event
 async def on_voice_state_update(member, before, after):
-    # Check if someone has moved from a temporary channel and if that channel
-    # is now empty.  If so, delete it.
-    if not (before and before.channel):
-        # logging.info("Channel check: no before channel object")
-        return
-    if before.channel == after.channel:
-        # logging.info("Channel check: channel hasn't changed")
-        return
-    if not before.channel.name.endswith('(temp)'):
-        # logging.info("Channel check: %s not a temporary channel", before.channel)
-        return
-    if before.channel.members:
-        logging.info("Channel check: %s not empty", before.channel)
-        return
-    logging.info("Channel check: deleting %s", before.channel.name)
-    await before.channel.delete()
+    if after and after.channel and after.channel != (before and before.channel):
+        # Someone joining a watched channel might be about to start a game.
+        if autosorter.is_watched(after.channel):
+            autosorter.poke()
+    # If someone has left one of our temporary channels and it's now empty,
+    # it'll be tidied up after a grace period; if they've joined one, it's in
+    # use again.  Deciding whether it's ours is a set lookup, and the tidying
+    # up is done by the sweeper - so we don't do any API calls here.
+    if before and before.channel and before.channel != (after and after.channel):
+        if before.channel.id in temp_channels and not before.channel.members:
+            temp_channels.emptied(before.channel.id)
+    if after and after.channel and after.channel != (before and before.channel):
+        temp_channels.joined(after.channel.id)
 
 
 # Help text is the first line of the docstring.
 @brackman.command(description='Set the FAF username you go by')
+@commands.guild_only()
 async def set(ctx, faf_username: str, discord_username: Optional[str]):
     """
     Set the FAF username for this Discord user.
@@ -95,22 +198,27 @@ async def set(ctx, faf_username: str, discord_username: Optional[str]):
     controller; otherwise the command is ignored.  We then use the FAF API to
     get the FAF ID, and store this plus the message's guild in the database.
     """
-    logging.info(f"{ctx=}, {faf_username=}, {discord_username}")
     if discord_username is not None:
         if ctx.author.display_name not in privileged_players:
-            logging.warn(f"User {ctx.author.display_name} not allowed to f/set a Discord username")
+            logging.warning("User %s not allowed to f/set a Discord username", ctx.author.display_name)
             await ctx.send("No, I don't think I need to take order from you, indeed!")
             return
     else:
         discord_username = ctx.author.display_name
-    logging.info(f"Matching {faf_username=} to {discord_username}")
+    logging.info("Matching FAF username %s to %s", faf_username, discord_username)
 
-    faf_id = faf_get_id_for_user(faf_username)
+    with metrics_lib.timed('phase_seconds', command='set', phase='faf_player'):
+        async with within('faf_player'):
+            faf_id = await faf_get_id_for_user_async(faf_username)
     if faf_id is None:
         await ctx.reply("I had a problem getting data from the FAF API, yes!")
         return
-    logging.info(f"User {discord_username} setting {faf_username}[{faf_id}] guild {ctx.guild.id} id {ctx.author.id}")
-    db_set_user(faf_id, faf_username, ctx.guild.id, ctx.author.id, discord_username)
+    logging.info(
+        "User %s setting %s[%s] guild %s id %s",
+        discord_username, faf_username, faf_id, ctx.guild.id, ctx.author.id
+    )
+    with metrics_lib.timed('phase_seconds', command='set', phase='store'):
+        await rosters.set_user(faf_id, faf_username, ctx.guild.id, ctx.author.id, discord_username)
     if ctx.author.display_name != discord_username:
         await ctx.reply(f"I'll remember that {faf_username} is {discord_username} for you, {ctx.author.display_name}")
     else:
@@ -128,22 +236,37 @@ async def set_error(ctx, error):
 
 
 @brackman.command(description='Details about a FAF player')
-async def who(ctx, player: Optional[str]):
+async def who(ctx, player: Optional[str], refresh: Optional[Literal['refresh']]):
     """
     Get details about a FAF user
+
+    Brackman controllers can add 'refresh' to skip the cached FAF details.
     """
     if not player:
         player = ctx.author.display_name
-    # Find out what the database knows
-    db_details = db_get_user(faf_username=player)
-    if db_details is None:
-        db_details = db_get_user(discord_username=player)
-    # Might still be None here...
-    if db_details is not None:
-        # We want a better guess of the FAF username for this player:
-        player = db_details['faf_username']
+    # Find out what we know - in this guild first (if it's not a DM), then in any
+    with metrics_lib.timed('phase_seconds', command='who', phase='player'):
+        async with within('player'):
+            known_as = None
+            if ctx.guild is not None:
+                known_as = (await rosters.get(ctx.guild)).faf_username_of(player)
+            if known_as is not None:
+                player = known_as
+                seen_before = True
+            else:
+                db_details = await db_get_user_async(faf_username=player)
+                if db_details is None:
+                    db_details = await db_get_user_async(discord_username=player)
+                # Might still be None here...
+                if db_details is not None:
+                    # We want a better guess of the FAF username for this player:
+                    player = db_details['faf_username']
+                seen_before = db_details is not None
     # Find out what FAF knows
-    faf_details = faf_get_player_for_user(player)
+    bypass_cache = bool(refresh) and ctx.author.display_name in privileged_players
+    with metrics_lib.timed('phase_seconds', command='who', phase='faf_player'):
+        async with within('faf_player'):
+            faf_details = await faf_get_player_for_user_async(player, bypass_cache=bypass_cache)
     if not faf_details:
         await ctx.reply(f"You must be mistaken, FAF does not know a player called `{player}`")
         return
@@ -151,7 +274,7 @@ async def who(ctx, player: Optional[str]):
     created_at = datetime.datetime.fromisoformat(faf_details['attributes']['createTime']).astimezone(sydney_tz)
     updated_at = datetime.datetime.fromisoformat(faf_details['attributes']['updateTime']).astimezone(sydney_tz)
     sorted_before = (
-        "I've seen them before, yes!" if db_details else "I believe I do not recognise them!"
+        "I've seen them before, yes!" if seen_before else "I believe I do not recognise them!"
     )
     await ctx.reply(f"""
 Player {player} joined at {created_at}
@@ -160,116 +283,121 @@ They last logged in at {updated_at}
     """)
 
 
-async def send_game_start_message(ctx, game):
+async def send_game_start_message(messageable, player, game):
     """
-    Send a message with information about the game and its players.
+    Send a message with information about the game and its players, to the
+    context or channel given, addressed to the player's display name.
     """
     messages = std_game_start_messages.copy()
-    player = ctx.author.display_name
-    host = game['host_faf_name']
+    host = game.host_faf_name
     host_s = host + "'s"
     if host == player:
         host = 'your'
         host_s = 'your'
-    name = game['name']
+    name = game.name
     if player in privileged_players:
         messages.extend(spec_game_start_messages)
     message = choice(messages)
-    await ctx.send(message.format(player=player, host=host, host_s=host_s, name=name))
+    await messageable.send(message.format(player=player, host=host, host_s=host_s, name=name))
 
 
-def resolve_players(ctx, players, active_channel):
+async def resolve_players(guild, players, channels):
     """
-    Resolve the discord IDs for all players.  Search the database first, and
-    the active channel membership (case-independently) second.  If we find
-    any players in the active channel the database didn't know, save them.
-    Set the 'discord_id' key in the player dict if we found one.
+    Resolve the discord IDs for all players.  Search the guild's roster of
+    known players first, and the members in the given voice channels (case-
+    independently, by their display names now) second.  If we find any
+    players in those channels we didn't know, save them.  Set the discord_id
+    of each GamePlayer we found.
     """
-    db_users = db_get_users(players.keys(), ctx.guild.id)  # organised by ID
-    # This only gives the users that matched.  Assign their discord ID into
-    # the players dict.
-    logging.info(
-        "players keys:%s, db users keys: %s",
-        repr(players.keys()), repr([u['faf_id'] for u in db_users])
-    )
-    for db_user in db_users:
-        faf_id = str(db_user['faf_id'])  # database types, eh?
-        players[faf_id]['discord_id'] = db_user['discord_id']
-        logging.info(
-            "Resolve 1: Found discord ID %s for FAF username %s(%s)",
-            db_user['discord_id'], db_user['faf_username'], faf_id
-        )
-
-    # Rearrange the active channel's member list into a dict of lower case
-    # username to discord ID.
-    member_with_display_name_lc = {
-        member.display_name.lower(): member
-        for member in active_channel.members
+    roster = await rosters.get(guild)
+    member_of_name = {
+        member.display_name.casefold(): member
+        for channel in channels
+        for member in channel.members
+        if not member.bot
     }
-    # Now go through the player list looking for players we haven't already
-    # matched but who are in the active channel (case insensitive)
+    new_users = []
     for player_id, player in players.items():
-        if 'discord_id' in player:
+        discord_id = roster.discord_of_faf.get(player_id)
+        if discord_id is not None:
+            player.discord_id = discord_id
+            logging.info(
+                "Resolve 1: Found discord ID %s for FAF username %s(%s)",
+                discord_id, player.name, player_id
+            )
             continue
-        player_name_lc = player['name'].lower()
-        if player_name_lc in member_with_display_name_lc:
-            member = member_with_display_name_lc[player_name_lc]
-            try:
-                db_set_user(
-                    player_id, player['name'], ctx.guild.id, member.id, member.display_name
-                )
-            except:
-                logging.error("Error thrown while calling db_set_user")
-                pass
-            player['discord_id'] = member.id
-            logging.info("Resolve 2: Found discord ID %s for FAF username %s", member.id, player['name'])
-    # No return - resolved data is in the players dict
+        if not player.name:
+            continue
+        member = member_of_name.get(player.name.casefold())
+        if member:
+            new_users.append((
+                player_id, player.name, guild.id, member.id, member.display_name
+            ))
+            player.discord_id = member.id
+            logging.info("Resolve 2: Found discord ID %s for FAF username %s", member.id, player.name)
+    # Save them all at once, in one transaction
+    if new_users:
+        try:
+            await rosters.set_users(new_users)
+        except Exception as e:
+            logging.error("Error thrown while calling db_set_users: %s", e)
+    # No return - resolved data is in the players
 
 
-async def create_voice_channel(ctx, active_channel, game_name, team_no):
+async def create_voice_channel(guild, messageable, active_channel, game_id, game_name, team_no):
     """
-    Create the voice channel for this team, if it doesn't already exist.
+    Get the voice channel for this team - the one it already has, a spare one
+    renamed, or a new one.  Problems are reported to the messageable context
+    or channel.
 
     Return the target channel
     """
-    # Voice channels can only be max 100 chars
-    if len(game_name) > 82:
-        game_name = game_name[:82]
-    channel_name = f"Team {team_no} - {game_name} (temp)"
-    channel = discord.utils.get(
-        ctx.guild.voice_channels, name=channel_name
-    )
-    if channel:
-        logging.info("Voice channel %s exists", channel_name)
-    else:
-        logging.info("Voice channel %s doesn't exist - creating", channel_name)
-        try:
-            channel = await ctx.message.guild.create_voice_channel(
-                channel_name,
-                reason=f'temp channel {team_no} for FAF game {game_name}',
-                position=team_no,
-                category=active_channel.category
-            )
-        except Exception as e:
-            logging.error(f"Could not create channel - {e}")
-            await ctx.send(f"I'm afraid I can't create a voice channel - indeed not!")
-            return None
-        if not channel:
-            logging.error("Could not create channel - unknown error")
-            await ctx.send(f"I'm afraid I can't create a voice channel - this is a temporary inconvenience at best!")
-            return None
+    try:
+        channel = await temp_channels.acquire(
+            guild, active_channel.category, game_id, game_name, team_no
+        )
+    except Exception as e:
+        logging.error("Could not create channel - %s", e)
+        await messageable.send(f"I'm afraid I can't create a voice channel - indeed not!")
+        return None
+    if not channel:
+        logging.error("Could not create channel - unknown error")
+        await messageable.send(f"I'm afraid I can't create a voice channel - this is a temporary inconvenience at best!")
+        return None
     return (team_no, channel)
 
 
-async def move_player(member, channel):
+async def move_player(member, channel, priority=PRIORITY_MOVE):
     """
     Move the player to the channel, with logging.
     """
-    logging.info(f"Moving {member.display_name}[{member.id}] into {channel.name}")
-    await member.move_to(channel)
+    logging.info("Moving %s[%s] into %s", member.display_name, member.id, channel.name)
+    await actions.run(member.guild.id, 'move', priority, member.move_to, channel)
+
+
+async def move_members(members, channel_of_player, issuer_id=None):
+    """
+    Move each of the members that we have a channel for into it, unless
+    they're already there.  The moves are queued together, with the member
+    who asked for the sort first.  Returns the number moved and the number
+    that couldn't be.
+    """
+    moves = [
+        move_player(
+            member, channel_of_player[member.id],
+            PRIORITY_ISSUER if member.id == issuer_id else PRIORITY_MOVE
+        )
+        for member in members
+        if member.id in channel_of_player
+        and not (member.voice and member.voice.channel == channel_of_player[member.id])
+    ]
+    results = await asyncio.gather(*moves, return_exceptions=True)
+    failed = sum(1 for result in results if isinstance(result, Exception))
+    return len(moves) - failed, failed
 
 
 @brackman.command(description='Sort players in your game into voice channels')
+@commands.guild_only()
 async def sort(ctx, discord_username: Optional[str]):
     """
     Sort the players in the game the user is in into team voice channels.
@@ -282,127 +410,420 @@ async def sort(ctx, discord_username: Optional[str]):
 
     guild = ctx.guild
     if not ctx.author.voice:
-        logging.info(f"User {ctx.author.display_name} not in voice channel")
+        logging.info("User %s not in voice channel", ctx.author.display_name)
         await ctx.reply("You must be in a voice channel in order to issue this command.")
         return
     active_channel = ctx.author.voice.channel
 
-    if discord_username:
-        db_user = db_get_user(discord_username=discord_username)
-        logging.info(
-            "Got DB data for %s on behalf of %s[%s]",
-            discord_username, ctx.author.display_name, ctx.author.id
-        )
-    else:
-        db_user = db_get_user(discord_id=ctx.author.id)
-        logging.info("Got DB data %s for author %s[%s]", db_user, ctx.author.display_name, ctx.author.id)
+    with metrics_lib.timed('phase_seconds', command='sort', phase='player'):
+        async with within('player'):
+            if discord_username:
+                db_user = await db_get_user_async(discord_username=discord_username)
+                logging.info(
+                    "Got DB data for %s on behalf of %s[%s]",
+                    discord_username, ctx.author.display_name, ctx.author.id
+                )
+            else:
+                known = (await rosters.get(guild)).player_of_discord.get(ctx.author.id)
+                if known:
+                    db_user = {'faf_id': known[0], 'faf_username': known[1]}
+                else:
+                    db_user = await db_get_user_async(discord_id=ctx.author.id)
+                logging.info("Got DB data %s for author %s[%s]", db_user, ctx.author.display_name, ctx.author.id)
     if db_user:
         faf_id = db_user['faf_id']
     else:
         # Try searching FAF for the username
-        faf_id = faf_get_id_for_user(ctx.author.display_name)
+        with metrics_lib.timed('phase_seconds', command='sort', phase='faf_player'):
+            async with within('faf_player'):
+                faf_id = await faf_get_id_for_user_async(ctx.author.display_name)
         if not faf_id:
             logging.info("Couldn't find FAF username for %s", ctx.author.display_name)
             await ctx.send(f"I couldn't find your FAF username. Please set it, eg `f/set {ctx.author.username}`")
             return
-        db_user = db_set_user(faf_id, ctx.author.display_name, ctx.guild.id, ctx.author.id, ctx.author.display_name)
-
-    game = faf_get_last_game_for_faf_id(faf_id)
-    if not game:
-        logging.info("Player %s[%s] not in any game", db_user['faf_username'], faf_id)
-        await ctx.send("I couldn't find you in any games on FAF, indeed!")
-        return
-    if game['end_time']:
-        logging.info("Player %s[%s] not in a current game", db_user['faf_username'], faf_id)
-        await ctx.send("I'm afraid your last game is... over!")
+        db_user = await rosters.set_user(faf_id, ctx.author.display_name, ctx.guild.id, ctx.author.id, ctx.author.display_name)
+
+    # If this player's game is already being sorted we can just join in.  If
+    # it was sorted here lately it's likely still being played, and the game
+    # cache has it.  Otherwise ask FAF what their game is.
+    game = None
+    game_id = sort_jobs.game_of_player(guild.id, faf_id)
+    if game_id is None:
+        recent_id = sort_jobs.recent_game_of_player(guild.id, faf_id)
+        with metrics_lib.timed('phase_seconds', command='sort', phase='game'):
+            async with within('game'):
+                if recent_id is not None:
+                    game = await faf_get_game_async(recent_id)
+                    if game and game.end_time:
+                        game = None
+                if not game:
+                    game = await faf_get_last_game_for_faf_id_async(faf_id)
+        if not game and faf_breaker.is_open:
+            await ctx.send("FAF isn't answering me at the moment - try again in a minute or so, indeed!")
+            return
+        if not game:
+            logging.info("Player %s[%s] not in any game", db_user['faf_username'], faf_id)
+            await ctx.send("I couldn't find you in any games on FAF, indeed!")
+            return
+        if game.end_time:
+            logging.info("Player %s[%s] not in a current game", db_user['faf_username'], faf_id)
+            await ctx.send("I'm afraid your last game is... over!")
+            return
+        game_id = game.id
+
+    # Only one sort happens for each game in a guild - if someone else is
+    # already sorting it then we say how it's going and get the result of
+    # their sort.  There must be no await between checking the game of the
+    # player and here, or that sort could finish.
+    job, leader = sort_jobs.start(
+        guild.id, game_id, ctx.author.display_name,
+        sort_game, guild, ctx, ctx.author.display_name, game, active_channel, ctx.author.id
+    )
+    if not leader:
+        logging.info(
+            "Game ID %s already being sorted by %s, %s[%s] joined that sort",
+            game_id, job.issuer, db_user['faf_username'], faf_id
+        )
+        await ctx.send(
+            f"You will have to be patient, {ctx.author.display_name}, "
+            f"{job.issuer} is already sorting {job.name or 'your game'} - "
+            f"I'm {job.progress()}, indeed!"
+        )
+    result = await job.wait()
+    if leader or not result:
         return
+    # Their sort only moved the people in their channel, so move the people
+    # in ours.
+    with metrics_lib.timed('phase_seconds', command='sort', phase='moves'):
+        await move_members(active_channel.members, result['channel_of_player'], ctx.author.id)
+    await ctx.send(f"There you are, {ctx.author.display_name} - I have sorted you too, oh yes!")
+
+
+async def sort_game(job, guild, messageable, issuer, game, active_channel, issuer_id=None):
+    """
+    Create the team channels for the game and move the players in the active
+    channel into them, as the sort job for it.  Messages go to the
+    messageable context or channel, and the issuer is the display name of
+    who asked for the sort - and issuer_id their Discord ID, if they're to be
+    moved first.
+
+    Returns a dict with the name of the game, who sorted it and the map of
+    Discord ID to team channel, or None if no channels could be created.
+    The job registry marks the game as no longer being sorted however this
+    finishes.
+    """
+    set_log_fields(guild_id=guild.id, game_id=game.id)
+    sort_jobs.track_players(job, game.name, game.players)
+    return await sort_game_players(guild, messageable, issuer, game, active_channel, issuer_id, job)
 
-    # Interlock to make sure two people don't try to sort the same game at
-    # the same time.
-    game_id = game['id']
-    async with sort_check_lock:
-        if game_id in games_being_sorted:
-            logging.info(
-                "Game ID %s already being sorted by %s[%s]",
-                game_id, db_user['faf_username'], faf_id
-            )
-            await ctx.send(
-                f"You will have to be patient, {ctx.author.display_name}, "
-                f"{games_being_sorted[game_id]} is already sorting {game['name']} "
-                f"- oh yes!"
-            )
-            return
-        games_being_sorted[game_id] = ctx.author.display_name
 
-    await send_game_start_message(ctx, game)
+def plan_moves(game, members, channel_of_team):
+    """
+    Work out who needs to move where: each of the members who is a resolved
+    player in the game, on a team with a channel, and not already in it.
+    Returns a list of (member, channel).
+    """
+    member_of_id = {member.id: member for member in members}
+    moves = []
+    for team, team_players in game.team_players.items():
+        channel = channel_of_team.get(team)
+        if channel is None:
+            continue
+        for player in team_players:
+            member = member_of_id.get(player.discord_id)
+            if member and not (member.voice and member.voice.channel == channel):
+                moves.append((member, channel))
+    return moves
 
-    # This adds Discord ID data into the game['players'] structure
-    resolve_players(ctx, game['players'], active_channel)
 
-    channels = await asyncio.gather(*[
-        create_voice_channel(ctx, active_channel, game['name'], team_no+1)
-        for team_no in range(game['teams'])  # because range goes from 0..n-1
-    ])
-    if (not channels) or (all(x is None for x in channels)):
+async def sort_game_players(guild, messageable, issuer, game, active_channel, issuer_id=None, job=None):
+    """
+    The work of sort_game, once the game is marked as being sorted, keeping
+    the job up to date with how far it's got.
+
+    If the game's been sorted before, this is a re-sort: the players in the
+    game's team channels and the channel it was first sorted from are
+    included along with those in the active channel, channels are only
+    created for teams that now have someone to move, and only the people not
+    in their team's channel are moved - so a game that's still sorted needs
+    no channel changes or moves at all.
+    """
+    start = time.monotonic()
+    if job is None:
+        job = SortJob(guild.id, game.id, issuer)
+    team_nos = range(1, game.teams + 1)
+    channel_of_team = {
+        team_no: channel
+        for team_no in team_nos
+        if (channel := temp_channels.team_channel(guild, game.id, team_no)) is not None
+    }
+    resort = bool(channel_of_team)
+    if not resort:
+        await send_game_start_message(messageable, issuer, game)
+        lobby_of_game.set((guild.id, game.id), active_channel.id)
+    source_channels = [active_channel]
+    _, lobby_id = lobby_of_game.lookup((guild.id, game.id))
+    for channel in [guild.get_channel(lobby_id) if lobby_id else None, *channel_of_team.values()]:
+        if channel is not None and channel not in source_channels:
+            source_channels.append(channel)
+
+    # This adds Discord ID data into the game's players.  If it runs out of
+    # time we carry on with the players it's found so far.
+    job.advance('resolving')
+    with metrics_lib.timed('phase_seconds', command='sort', phase='resolve'):
+        try:
+            async with within('resolve'):
+                await resolve_players(guild, game.players, source_channels)
+        except DeadlineExceeded:
+            pass
+
+    # On a re-sort only the teams with someone here to move need a channel
+    present = {member.id for channel in source_channels for member in channel.members}
+    needed = [
+        team_no for team_no in team_nos
+        if team_no not in channel_of_team and (not resort or any(
+            player.discord_id in present for player in game.team_players.get(team_no, [])
+        ))
+    ]
+    # Channels that take too long are left to finish in the background, so
+    # they're there for the next f/sort, and we go on with the ones we have.
+    # So that they do finish, they're made without the sort's deadline - we
+    # just don't wait for them past it.
+    job.advance('creating', len(needed))
+    with metrics_lib.timed('phase_seconds', command='sort', phase='channels'):
+        with no_deadline():
+            creates = [
+                asyncio.ensure_future(create_voice_channel(
+                    guild, messageable, active_channel, game.id, game.name, team_no
+                ))
+                for team_no in needed
+            ]
+        for task in creates:
+            task.add_done_callback(job.step)
+        try:
+            done, pending = await wait_within('channels', creates)
+        finally:
+            for task in creates:
+                if not task.done():
+                    unfinished_tasks.add(task)
+                    task.add_done_callback(unfinished_tasks.discard)
+    channel_of_team.update(x for task in done if (x := task.result()))  # team_no: channel
+    if not channel_of_team and pending:
+        await messageable.send(
+            "Discord is taking its time making your team channels - try `f/sort` again in a moment!"
+        )
+        return None
+    if not channel_of_team:
         logging.info("No voice channels created!")
-        ctx.reply("I'm afraid I was unable to create any voice channels.")
-        return
-    # Reconstruct the data to map players into channels by team number
-    channel_of_team = dict(channels)  # team_no: channel
-    # logging.info("Created channels from: %s", channels)
-    # logging.info("Players in game: %s", game['players'])
-    # Map the player's discord_id to the channel object to put them in
-    # game keys: player FAF ID; values: name and team.
+        await messageable.send("I'm afraid I was unable to create any voice channels.")
+        return None
+    # Map the player's discord_id to the channel object to put them in, from
+    # the players already grouped by team.
     channel_of_player = {
-        player['discord_id']: channel_of_team[player['team']]
-        for player in game['players'].values()
-        if 'discord_id' in player and 'team' in player and player['team'] in channel_of_team
+        player.discord_id: channel_of_team[team]
+        for team, team_players in game.team_players.items()
+        if team in channel_of_team
+        for player in team_players
+        if player.discord_id is not None
     }
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(
+            "Resolved channels for players: %s",
+            {k: v.name for k, v in channel_of_player.items()}
+        )
+    unresolved = game.unresolved_players()
+    if unresolved:
+        logging.info("Players with no discord ID: %s", unresolved)
+
+    # Move all the players in one go, the issuer first.  The moves not done
+    # by the deadline are called off.
+    moves = plan_moves(
+        game,
+        [member for channel in source_channels for member in channel.members],
+        channel_of_team
+    )
+    job.advance('moving', len(moves))
+    with metrics_lib.timed('phase_seconds', command='sort', phase='moves'):
+        move_tasks = [
+            asyncio.ensure_future(move_player(
+                member, channel, PRIORITY_ISSUER if member.id == issuer_id else PRIORITY_MOVE
+            ))
+            for member, channel in moves
+        ]
+        for task in move_tasks:
+            task.add_done_callback(job.step)
+        try:
+            done, unmoved = await wait_within('moves', move_tasks)
+        finally:
+            for task in move_tasks:
+                task.cancel()
+    failed = sum(1 for task in done if task.exception() is not None)
+    moved = len(done) - failed
+    elapsed = time.monotonic() - start
+    metrics_lib.observe('sort_seconds', elapsed)
     logging.info(
-        "Resolved channels for players: %s",
-        {k: v.name for k, v in channel_of_player.items()}
+        "%s game %s: %d created, %d moved, %d failed, %d unfinished, in %.1fs",
+        'Re-sorted' if resort else 'Sorted', game.id, len(needed) - len(pending),
+        moved, failed, len(unmoved), elapsed
     )
-    if any('discord_id' not in v for v in game['players'].values()):
-        logging.info(
-            "Players with no discord ID: %s",
-            {k: v for k, v in game['players'].items() if 'discord_id' not in v}
+    if pending or unmoved:
+        # Tell them how far we got
+        await messageable.send(
+            f"I ran out of time, I'm afraid: I moved {moved} of you and "
+            f"{len(unmoved) + failed} are still to go"
+            + (f", and {len(pending)} team channels are still being made" if pending else "")
+            + " - try `f/sort` again in a moment!"
         )
-    # resolve_players() should set a team, but had one crash when it didn't,
-    # so log that for checking later.
-    if any('team' not in v for v in game['players'].values()):
-        logging.warn(
-            "Players with no team: %s",
-            {k: v for k, v in game['players'].items() if 'team' not in v}
+    elif failed:
+        await messageable.send(
+            f"I'm afraid Discord wouldn't let me move {failed} of you - try `f/sort` again in a moment!"
+        )
+    if resort and not (pending or unmoved):
+        await messageable.send(
+            f"I have moved {moved} more of you into your team channels, oh yes!" if moved
+            else "Everyone I know of is already in their team channel, indeed!"
         )
 
-    # Move all the players in one go, near-simultaneously
-    await asyncio.gather(*[
-        move_player(member, channel_of_player[member.id])
-        for member in active_channel.members
-        if member.id in channel_of_player
-    ])
-
-    # Find all the unknown players, and warn about them
+    # Find all the unknown players, and warn about them - once
     unknown_players = sorted(
-        player['name']
-        for player in game['players'].values()
-        if 'discord_id' not in player
+        player.name or str(player.faf_id)
+        for player in unresolved
     )
-    if unknown_players:
-        await ctx.send(
+    if unknown_players and not resort:
+        await messageable.send(
             "I couldn't find Discord usernames for the following FAF players: " +
             ', '.join(unknown_players) +
             " - if you're one of those people, issue `f/set` with your FAF username."
         )
-    # Finally mark this game as no longer being sorted:
-    async with sort_check_lock:
-        del games_being_sorted[game_id]
     # And that's it!
+    return {
+        'name': game.name,
+        'sorted_by': issuer,
+        'channel_of_player': channel_of_player,
+    }
+
+
+async def auto_sort_game(guild, channel, game, members):
+    """
+    Sort a game that the auto-sorter found being played by the members in a
+    watched channel.  Messages go to the voice channel's text chat.  Returns
+    the sort's result, which is None if it failed.
+    """
+    with log_context(guild_id=guild.id, game_id=game.id, command='autosort'):
+        logging.info(
+            "Auto-sorting game %s for %s in %s",
+            game.id, [member.display_name for member in members], channel.name
+        )
+        with deadline_for('sort'):
+            job, _ = sort_jobs.start(
+                guild.id, game.id, members[0].display_name,
+                sort_game, guild, channel, members[0].display_name, game, channel, members[0].id
+            )
+        return await job.wait()
+
+
+autosorter = AutoSorter(brackman, auto_sort_game)
+temp_channels = TempChannelPool(brackman)
+
+
+@brackman.command(description='Automatically sort games started in your voice channel')
+@commands.guild_only()
+async def watch(ctx):
+    """
+    Watch the voice channel you are in, and sort the games of the people in
+    it as they start, without anyone needing to f/sort.
+    """
+    if ctx.author.display_name not in privileged_players:
+        await ctx.reply("I'm afraid you are not that special, my child!")
+        return
+    if not ctx.author.voice:
+        await ctx.reply("You must be in a voice channel in order to issue this command.")
+        return
+    await autosorter.watch(ctx.author.voice.channel)
+    await ctx.reply(f"I shall keep an eye on {ctx.author.voice.channel.name} - oh yes!")
+
+
+@brackman.command(description='Stop automatically sorting your voice channel')
+@commands.guild_only()
+async def unwatch(ctx):
+    """
+    Stop watching the voice channel you are in.
+    """
+    if ctx.author.display_name not in privileged_players:
+        await ctx.reply("I'm afraid you are not that special, my child!")
+        return
+    if not ctx.author.voice:
+        await ctx.reply("You must be in a voice channel in order to issue this command.")
+        return
+    if await autosorter.unwatch(ctx.author.voice.channel):
+        await ctx.reply(f"I shall stop watching {ctx.author.voice.channel.name}.")
+    else:
+        await ctx.reply(f"I wasn't watching {ctx.author.voice.channel.name}, indeed!")
+
+
+@brackman.command(description='How the sorts in this server are going')
+@commands.guild_only()
+async def sorts(ctx):
+    """
+    List the games being sorted in this server, and those sorted recently,
+    with how far each has got.
+    """
+    jobs = sort_jobs.status(ctx.guild.id)
+    if not jobs:
+        await ctx.reply("I haven't been sorting anything here lately, indeed!")
+        return
+    now = time.monotonic()
+    await ctx.reply('\n'.join(
+        f"{job.name or job.game_id}: {job.progress()} - sorted by {job.issuer}, "
+        f"{now - job.started_at:.0f}s ago"
+        for job in jobs
+    ))
+
+
+@brackman.command(description='How long commands have been taking')
+async def stats(ctx):
+    """
+    Summarise the recent timings of each command and its phases, and the
+    errors from Discord and FAF.
+    """
+    if ctx.author.display_name not in privileged_players:
+        await ctx.reply("I'm afraid you are not that special, my child!")
+        return
+    rows = sorted(
+        [(labels['command'], '(all)', summary)
+         for labels, summary in metrics_lib.timing_summaries('command_seconds')]
+        + [(labels['command'], labels['phase'], summary)
+           for labels, summary in metrics_lib.timing_summaries('phase_seconds')],
+        key=lambda row: row[:2]
+    )
+    if not rows:
+        await ctx.reply("Nothing has happened yet, my child - patience!")
+        return
+    lines = [f"{'command':<8} {'phase':<10} {'count':>6} {'p50 ms':>8} {'p99 ms':>8}"]
+    lines.extend(
+        f"{command:<8} {phase:<10} {summary['count']:>6} "
+        f"{summary['p50'] * 1000:>8.1f} {summary['p99'] * 1000:>8.1f}"
+        for command, phase, summary in rows
+    )
+    faf_errors = (
+        metrics_lib.counter_total('faf_api_responses')
+        - metrics_lib.counter_total('faf_api_responses', status=200)
+    )
+    lines.append(
+        f"Discord 429s: {metrics_lib.counter_total('discord_errors', status=429)}, "
+        f"FAF API errors: {faf_errors}"
+    )
+    await ctx.reply('```\n' + '\n'.join(lines) + '\n```')
 
 
 if __name__ == '__main__':
     full_config = read_config('config.yaml')
+    log_init(full_config)
+    deadline_init(full_config)
     init_oauth_config(full_config)
+    db_init(full_config)
+    brackman.config = full_config
     assert 'discord' in full_config
     assert 'token' in full_config['discord']
-    brackman.run(full_config['discord']['token'])  #, log_handler=file_log)
+    # Our logging is set up already, so discord.py doesn't need to
+    brackman.run(full_config['discord']['token'], log_handler=None)
@@ -0,0 +1,154 @@
+import asyncio
+from collections import OrderedDict
+import time
+
+import metrics_lib
+
+
+class TTLCache:
+    """
+    A bounded in-process cache whose entries expire.
+
+    Found values and 'not found' results (stored as None) have separate
+    lifetimes, so we can remember that a name doesn't exist for less time
+    than we remember one that does.  When the cache is full the least
+    recently used entry is evicted.  Hits and misses are counted here and in
+    metrics_lib as cache_hits and cache_misses, labelled with the name.
+
+    Expired entries are kept for stale_ttl seconds more, for lookup_stale()
+    to return while the caller refreshes them, or for stale() to fall back
+    on if it can't.  'Not found' results are never used stale: once one has
+    expired we ask again, in case the name now exists.
+    """
+    def __init__(self, name, maxsize=2000, ttl=600, negative_ttl=60, stale_ttl=0):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.stale_ttl = stale_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key: (expiry time, value)
+
+    def configure(self, maxsize=None, ttl=None, negative_ttl=None, stale_ttl=None):
+        """
+        Change the size or lifetimes of the cache.  Entries already in the
+        cache keep the expiry time they were given.
+        """
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if ttl is not None:
+            self.ttl = ttl
+        if negative_ttl is not None:
+            self.negative_ttl = negative_ttl
+        if stale_ttl is not None:
+            self.stale_ttl = stale_ttl
+        self._evict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def lookup(self, key):
+        """
+        Return a tuple of (found, value).  Found is False if the key isn't in
+        the cache or its entry has expired; value may be None for a cached
+        'not found' result.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] > time.monotonic():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            metrics_lib.incr('cache_hits', cache=self.name)
+            return True, entry[1]
+        if entry is not None and not self._is_stale(entry):
+            del self._entries[key]
+        self.misses += 1
+        metrics_lib.incr('cache_misses', cache=self.name)
+        return False, None
+
+    def lookup_stale(self, key):
+        """
+        Return a tuple of (found, value, stale), where stale is True if the
+        entry has expired but is still within stale_ttl - the caller should
+        use it, and refresh it.
+        """
+        entry = self._entries.get(key)
+        if self._is_stale(entry):
+            self._entries.move_to_end(key)
+            metrics_lib.incr('cache_stale_hits', cache=self.name)
+            return True, entry[1], True
+        found, value = self.lookup(key)
+        return found, value, False
+
+    def stale(self, key):
+        """
+        Return a tuple of (found, value) for the entry, even if it's expired
+        but still within stale_ttl.  Not counted as a hit or a miss.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and (entry[0] > time.monotonic() or self._is_stale(entry)):
+            return True, entry[1]
+        return False, None
+
+    def _is_stale(self, entry):
+        """
+        Is this entry a found value that's expired but still within
+        stale_ttl?
+        """
+        return (
+            entry is not None and entry[1] is not None
+            and entry[0] <= time.monotonic() < entry[0] + self.stale_ttl
+        )
+
+    def set(self, key, value):
+        """
+        Store the value, or None to record that the key wasn't found.
+        """
+        ttl = self.ttl if value is not None else self.negative_ttl
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        self._evict()
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def _evict(self):
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key into one.
+
+    The first caller for a key starts the work; anyone else asking for the
+    same key while it's running waits for that work and gets its result (or
+    its exception) instead of starting their own.  The work carries on even if
+    the caller that started it is cancelled, as others may be waiting on it.
+    """
+    def __init__(self):
+        self._in_flight = dict()  # key: future of the running work
+
+    def __contains__(self, key):
+        return key in self._in_flight
+
+    async def run(self, key, func, *args):
+        """
+        Run func(*args) for this key, or wait for the run already going.
+        Returns a tuple of (leader, result), where leader is True if this
+        call started the work.
+        """
+        future = self._in_flight.get(key)
+        if future is not None:
+            return False, await asyncio.shield(future)
+        future = asyncio.ensure_future(func(*args))
+        self._in_flight[key] = future
+        future.add_done_callback(lambda f: self._done(key, f))
+        return True, await asyncio.shield(future)
+
+    def _done(self, key, future):
+        if self._in_flight.get(key) is future:
+            del self._in_flight[key]
@@ -0,0 +1,332 @@
+import asyncio
+from collections import deque
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import Optional
+
+from action_lib import actions, PRIORITY_CREATE, PRIORITY_CLEANUP
+import metrics_lib
+
+# Discord allows a channel to be renamed twice in ten minutes.
+RENAME_LIMIT = (2, 600.0)
+
+
+def team_channel_name(game_name, team_no):
+    # Voice channels can only be max 100 chars
+    if len(game_name) > 82:
+        game_name = game_name[:82]
+    return f"Team {team_no} - {game_name} (temp)"
+
+
+@dataclass(slots=True)
+class TempChannel:
+    """
+    A team voice channel we created.  While it's in use it belongs to a team
+    in a game; once everyone has left, and stayed away for the grace period,
+    it's spare, and can be renamed for the next game sorted in the same
+    category.
+    """
+    id: int
+    guild_id: int
+    category_id: Optional[int]
+    name: str
+    game_id: Optional[int] = None
+    team_no: Optional[int] = None
+    empty_since: Optional[float] = None
+    spare_since: Optional[float] = None
+    renames: deque = field(default_factory=deque)  # times of recent renames
+
+    def can_rename(self, now):
+        calls, per = RENAME_LIMIT
+        while self.renames and self.renames[0] <= now - per:
+            self.renames.popleft()
+        return len(self.renames) < calls
+
+
+class TempChannelPool:
+    """
+    The temporary team channels in every guild, indexed by ID, by name and by
+    the game and team they're for - so finding a game's channels never means
+    scanning the guild's channel list.
+
+    Voice events only note when one of our channels empties or is joined -
+    no API calls.  A team channel that's stayed empty for the grace period
+    isn't deleted but kept as a spare in its category, so people dropping out
+    and reconnecting don't lose it.  The next game sorted in that category
+    renames a spare rather than creating a new channel, so sorting into a
+    warm pool only needs a rename and the moves.
+
+    The sweeper deletes spares that haven't been used for spare_ttl seconds,
+    and any beyond max_spare in a category, at most max_deletes at a time.
+    """
+    def __init__(self, bot, grace=60, max_spare=4, spare_ttl=900, interval=15, max_deletes=5):
+        self.bot = bot
+        self.grace = grace
+        self.max_spare = max_spare
+        self.spare_ttl = spare_ttl
+        self.interval = interval
+        self.max_deletes = max_deletes
+        self._channels = dict()  # channel_id: TempChannel
+        self._empty = set()  # IDs of channels in use that have emptied
+        self._by_name = dict()  # (guild_id, name): channel_id
+        self._by_team = dict()  # (guild_id, game_id, team_no): channel_id
+        self._spare = dict()  # (guild_id, category_id): [channel_id], most recently spare last
+        self._task = None
+
+    def configure(self, grace=None, max_spare=None, spare_ttl=None, interval=None, max_deletes=None):
+        if grace is not None:
+            self.grace = grace
+        if max_spare is not None:
+            self.max_spare = max_spare
+        if spare_ttl is not None:
+            self.spare_ttl = spare_ttl
+        if interval is not None:
+            self.interval = interval
+        if max_deletes is not None:
+            self.max_deletes = max_deletes
+
+    def __contains__(self, channel_id):
+        return channel_id in self._channels
+
+    def adopt(self, guild):
+        """
+        Track the temporary channels left in the guild from before we
+        started.  Empty ones are spares; ones people are in - a game that
+        was going when we restarted - are in use, and only become spare once
+        they've emptied and the grace period has passed.  Returns the number
+        adopted.
+        """
+        adopted = 0
+        for channel in guild.voice_channels:
+            if channel.id not in self._channels and channel.name.endswith('(temp)'):
+                temp = self._add(channel, None, None)
+                if not channel.members:
+                    self._make_spare(temp)
+                adopted += 1
+        if adopted:
+            logging.info("Adopted %d temporary channels in guild %s", adopted, guild.id)
+        return adopted
+
+    def _add(self, channel, game_id, team_no):
+        temp = TempChannel(
+            channel.id, channel.guild.id, channel.category_id, channel.name,
+            game_id, team_no
+        )
+        self._channels[temp.id] = temp
+        self._by_name[(temp.guild_id, temp.name)] = temp.id
+        if game_id is not None:
+            self._by_team[(temp.guild_id, game_id, team_no)] = temp.id
+        return temp
+
+    def _use(self, temp, game_id, team_no):
+        temp.empty_since = None
+        self._empty.discard(temp.id)
+        if temp.spare_since is not None:
+            self._spare_list(temp).remove(temp.id)
+            temp.spare_since = None
+        self._by_team.pop((temp.guild_id, temp.game_id, temp.team_no), None)
+        temp.game_id = game_id
+        temp.team_no = team_no
+        self._by_team[(temp.guild_id, game_id, team_no)] = temp.id
+
+    def _spare_list(self, temp):
+        return self._spare.setdefault((temp.guild_id, temp.category_id), [])
+
+    def forget(self, channel_id):
+        """
+        Stop tracking the channel, e.g. because it's been deleted.
+        """
+        temp = self._channels.pop(channel_id, None)
+        if temp is None:
+            return
+        if self._by_name.get((temp.guild_id, temp.name)) == temp.id:
+            del self._by_name[(temp.guild_id, temp.name)]
+        if self._by_team.get((temp.guild_id, temp.game_id, temp.team_no)) == temp.id:
+            del self._by_team[(temp.guild_id, temp.game_id, temp.team_no)]
+        if temp.spare_since is not None:
+            self._spare_list(temp).remove(temp.id)
+        self._empty.discard(channel_id)
+
+    def team_channel(self, guild, game_id, team_no):
+        """
+        Return the channel this team of this game already has, or None.
+        """
+        channel_id = self._by_team.get((guild.id, game_id, team_no))
+        return guild.get_channel(channel_id) if channel_id else None
+
+    def emptied(self, channel_id):
+        """
+        One of our channels has emptied - start its grace period.
+        """
+        temp = self._channels.get(channel_id)
+        if temp is None:
+            return
+        if temp.spare_since is not None:
+            # An unused spare stays for spare_ttl from when it was last used
+            temp.spare_since = time.monotonic()
+        else:
+            temp.empty_since = time.monotonic()
+            self._empty.add(channel_id)
+
+    def joined(self, channel_id):
+        """
+        Someone has joined the channel - if it was in its grace period, or
+        spare, it's in use again.  A spare goes back to being spare once it's
+        been empty for the grace period.
+        """
+        temp = self._channels.get(channel_id)
+        if temp is None:
+            return
+        if temp.empty_since is not None:
+            temp.empty_since = None
+            self._empty.discard(channel_id)
+        if temp.spare_since is not None:
+            self._spare_list(temp).remove(channel_id)
+            temp.spare_since = None
+
+    def _make_spare(self, temp):
+        temp.empty_since = None
+        self._empty.discard(temp.id)
+        if temp.spare_since is None:
+            self._by_team.pop((temp.guild_id, temp.game_id, temp.team_no), None)
+            temp.game_id = temp.team_no = None
+            temp.spare_since = time.monotonic()
+            self._spare_list(temp).append(temp.id)
+            logging.info("Keeping %s as a spare channel", temp.name)
+
+    async def acquire(self, guild, category, game_id, game_name, team_no):
+        """
+        Return the voice channel for this team of this game: the one it
+        already has, one with its name, a renamed spare, or a new channel.
+        """
+        name = team_channel_name(game_name, team_no)
+        for channel_id in (
+            self._by_team.get((guild.id, game_id, team_no)),
+            self._by_name.get((guild.id, name)),
+        ):
+            channel = guild.get_channel(channel_id) if channel_id else None
+            if channel is not None:
+                self._use(self._channels[channel.id], game_id, team_no)
+                metrics_lib.incr('temp_channel_existing')
+                logging.info("Voice channel %s exists", name)
+                return channel
+            if channel_id:
+                self.forget(channel_id)
+
+        now = time.monotonic()
+        category_id = category.id if category else None
+        for channel_id in list(reversed(self._spare.get((guild.id, category_id), []))):
+            temp = self._channels[channel_id]
+            channel = guild.get_channel(channel_id)
+            if channel is None:
+                self.forget(channel_id)
+                continue
+            if channel.members or not temp.can_rename(now):
+                # Never take a channel from under the people in it
+                continue
+            logging.info("Renaming spare channel %s to %s", temp.name, name)
+            temp.renames.append(now)
+            self._use(temp, game_id, team_no)
+            try:
+                await actions.run(
+                    guild.id, 'edit', PRIORITY_CREATE, channel.edit,
+                    name=name, position=team_no,
+                    reason=f'temp channel {team_no} for FAF game {game_name}',
+                )
+            except Exception as e:
+                logging.error("Could not rename spare channel %s: %r", temp.name, e)
+                self._make_spare(temp)
+                break
+            if self._by_name.get((guild.id, temp.name)) == temp.id:
+                del self._by_name[(guild.id, temp.name)]
+            temp.name = name
+            self._by_name[(guild.id, name)] = temp.id
+            metrics_lib.incr('temp_channel_reused')
+            return channel
+
+        logging.info("Voice channel %s doesn't exist - creating", name)
+        channel = await actions.run(
+            guild.id, 'create', PRIORITY_CREATE, guild.create_voice_channel,
+            name,
+            reason=f'temp channel {team_no} for FAF game {game_name}',
+            position=team_no,
+            category=category,
+        )
+        if channel:
+            self._add(channel, game_id, team_no)
+            metrics_lib.incr('temp_channel_created')
+        return channel
+
+    async def sweep(self):
+        """
+        Make spares of the channels that have been empty for the grace
+        period, then delete the spares that have been unused for too long
+        and any beyond max_spare in each category - at most max_deletes of
+        them, the rest being left for the next sweep.  Returns the number
+        deleted.
+        """
+        now = time.monotonic()
+        for channel_id in [
+            channel_id for channel_id in self._empty
+            if self._channels[channel_id].empty_since <= now - self.grace
+        ]:
+            self._make_spare(self._channels[channel_id])
+
+        cutoff = now - self.spare_ttl
+        doomed = []
+        for spare in self._spare.values():
+            # Oldest first
+            excess = len(spare) - self.max_spare
+            for pos, channel_id in enumerate(spare):
+                if pos < excess or self._channels[channel_id].spare_since < cutoff:
+                    doomed.append(channel_id)
+        deletes = []
+        for channel_id in doomed:
+            if len(deletes) >= self.max_deletes:
+                break
+            channel = self.bot.get_channel(channel_id)
+            if channel is not None and channel.members:
+                # Someone's using it anyway; keep it until they leave
+                self._channels[channel_id].spare_since = now
+                continue
+            self.forget(channel_id)
+            if channel is not None:
+                deletes.append(channel)
+        results = await asyncio.gather(*[
+            actions.run(channel.guild.id, 'delete', PRIORITY_CLEANUP, channel.delete)
+            for channel in deletes
+        ], return_exceptions=True)
+        for channel, result in zip(deletes, results):
+            if isinstance(result, Exception):
+                logging.error("Could not delete spare channel %s: %r", channel.name, result)
+            else:
+                logging.info("Deleted spare channel %s", channel.name)
+        metrics_lib.incr('temp_channel_deleted', len(deletes))
+        return len(deletes)
+
+    async def run(self):
+        await self.bot.wait_until_ready()
+        while not self.bot.is_closed():
+            try:
+                await self.sweep()
+            except Exception:
+                logging.exception("Sweeping temporary channels failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        """
+        Start sweeping in the background.  Must be called from
+        within the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
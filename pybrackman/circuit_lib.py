@@ -0,0 +1,64 @@
+import logging
+import time
+
+import metrics_lib
+
+
+class CircuitBreaker:
+    """
+    Stop calling a service that keeps failing, so callers fail fast rather
+    than each waiting out its timeouts and retries.
+
+    The circuit opens after max_failures failures in a row.  While it's open
+    allow() refuses every call except one trial every reset_timeout
+    seconds: if the trial succeeds the circuit closes again, and if it fails
+    we wait another reset_timeout before the next.  Callers report how each
+    call went with success() or failure().
+    """
+    def __init__(self, name, max_failures=5, reset_timeout=30):
+        self.name = name
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None  # when the circuit opened or last let a trial through
+
+    def configure(self, max_failures=None, reset_timeout=None):
+        if max_failures is not None:
+            self.max_failures = max_failures
+        if reset_timeout is not None:
+            self.reset_timeout = reset_timeout
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def allow(self):
+        """
+        Return True if a call may go ahead.
+        """
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now >= self.opened_at + self.reset_timeout:
+            self.opened_at = now
+            logging.info("Circuit %s letting a trial call through", self.name)
+            return True
+        metrics_lib.incr('circuit_refused', circuit=self.name)
+        return False
+
+    def success(self):
+        if self.opened_at is not None:
+            logging.warning("Circuit %s closed again", self.name)
+            metrics_lib.incr('circuit_changes', circuit=self.name, state='closed')
+        self.failures = 0
+        self.opened_at = None
+
+    def failure(self):
+        self.failures += 1
+        if self.opened_at is None and self.failures >= self.max_failures:
+            logging.warning(
+                "Circuit %s opened after %d failures - failing fast for %ss",
+                self.name, self.failures, self.reset_timeout
+            )
+            metrics_lib.incr('circuit_changes', circuit=self.name, state='open')
+            self.opened_at = time.monotonic()
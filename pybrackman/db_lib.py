@@ -1,12 +1,34 @@
+import asyncio
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
+import functools
 import logging
+import queue
 import sqlite3
+import threading
+import time
 
-con = sqlite3.connect(
-    "players.db",
-    detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
-)
-cursor = con.cursor()
+from game_lib import Game, GamePlayer
+import deadline_lib
+import metrics_lib
+
+# Each thread gets its own connection to the database, opened when it first
+# needs one.  The bot does its reads in a small pool of threads and all its
+# writes in one writer thread, which groups them into batched transactions -
+# see db_read() and db_write().  The database is in WAL mode, so reads carry
+# on while a write is being committed.  The settings can be changed from the
+# optional 'database' section of the config, before the first query.
+db_config = {
+    'path': 'players.db',
+    'read_threads': 4,
+    'batch_size': 100,       # most writes in one transaction
+    'batch_delay': 0.005,    # seconds to wait for more writes to batch up
+    'cache_size_kb': 16384,  # page cache per connection
+}
+_local = threading.local()
+_schema_lock = threading.Lock()
+_schema_checked = False
 
 
 PLAYER_HEADER = ['faf_id', 'faf_username', 'guild_id', 'discord_id', 'discord_username']
@@ -18,7 +40,7 @@ def db_create(cursor):
     # may be on multiple Discord servers.  It's actually the combination of
     # guild_id and discord_id that is unique.
     cursor.execute("""
-        CREATE TABLE players (
+        CREATE TABLE IF NOT EXISTS players (
             faf_id integer,
             faf_username text,
             guild_id integer(8),
@@ -30,43 +52,543 @@ def db_create(cursor):
         );
     """)
     cursor.execute("""
-        CREATE INDEX player_faf_id on players (faf_id);
+        CREATE INDEX IF NOT EXISTS player_faf_id on players (faf_id);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS player_faf_username on players (faf_username);
+    """)
+
+
+def db_create_watched_channels(cursor):
+    # The voice channels that are watched for new games to sort automatically.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS watched_channels (
+            guild_id integer(8),
+            channel_id integer(8),
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            CONSTRAINT guild_channel UNIQUE (guild_id, channel_id)
+        );
+    """)
+
+
+def db_create_player_indexes(cursor):
+    # Indexes for the queries the bot actually makes:
+    # - db_get_users() looks up FAF IDs within a guild, and gets everything it
+    #   needs from this index without touching the table;
+    # - db_get_users_by_discord_ids() and the upsert use the guild_member
+    #   unique constraint;
+    # - db_get_user() looks up one of discord_id, faf_username or
+    #   discord_username, the names without regard to case.
+    # The old faf_id and faf_username indexes are replaced by these.
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS player_guild_faf_id
+        ON players (guild_id, faf_id, discord_id, faf_username, discord_username);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS player_discord_id on players (discord_id);
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS player_faf_username_nocase
+        ON players (faf_username COLLATE NOCASE);
     """)
     cursor.execute("""
-        CREATE INDEX player_faf_username on players (faf_username);
+        CREATE INDEX IF NOT EXISTS player_discord_username_nocase
+        ON players (discord_username COLLATE NOCASE);
     """)
+    cursor.execute("DROP INDEX IF EXISTS player_faf_id;")
+    cursor.execute("DROP INDEX IF EXISTS player_faf_username;")
 
 
-def read_csv(cursor, filename):
+def db_create_games(cursor):
+    # A cache of the games we've fetched from FAF, as parsed.  Games that have
+    # ended don't change, so once we have one with an end_time it's never
+    # updated; running games are refreshed when fetched_at (a Unix time) is
+    # too old.
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS games (
+            id integer PRIMARY KEY,
+            name text,
+            start_time text,
+            end_time text,
+            host_faf_id integer,
+            host_faf_name text,
+            teams integer,
+            fetched_at real
+        );
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS game_players (
+            game_id integer,
+            faf_id integer,
+            name text,
+            team integer,
+            PRIMARY KEY (game_id, faf_id)
+        ) WITHOUT ROWID;
+    """)
+    cursor.execute("""
+        CREATE INDEX IF NOT EXISTS game_player_faf_id on game_players (faf_id, game_id);
+    """)
+
+
+# The schema migrations, in order.  The database's user_version is the
+# number of them that have been applied; db_migrate() applies the rest.
+# Add new ones at the end and never change one that's been released.
+# The first ones use IF NOT EXISTS because databases from before there were
+# migrations may already have their tables.
+MIGRATIONS = [
+    db_create,
+    db_create_watched_channels,
+    db_create_player_indexes,
+    db_create_games,
+]
+
+
+def db_init(full_config):
     """
-    Read the CSV output and map it into the table here.  Modify the CSV to
-    have a header with the right field names (including sqlite3's 'rowid').
+    Load the settings from the optional 'database' section of the config.
     """
-    import csv
-    fh = open(filename, 'r')
-    reader = csv.reader(fh.readlines())
-    header = next(reader)
-    # players = map_rows(reader, header)
-    # return players
-    header_str = ', '.join(header)
-    values_str = ', '.join(['?'] * len(header))
-    ins_sql = f"""
-        INSERT INTO players
-        ({header_str})
-        VALUES ({values_str})
+    db_config.update(full_config.get('database') or {})
+
+
+def db_connection():
     """
+    Return this thread's connection, opening it if necessary.
 
-    def process_rows(rows):
-        for row in rows:
-            out = []
-            for field, val in zip(header, row):
-                if field == 'created_at' or field == 'updated_at':
-                    val = datetime.fromisoformat(val)
-                out.append(val)
-            yield out
+    Connections are in autocommit mode; writes use db_transaction() to group
+    their statements.
+    """
+    con = getattr(_local, 'con', None)
+    if con is None:
+        con = sqlite3.connect(
+            db_config['path'],
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            isolation_level=None,
+        )
+        con.execute("PRAGMA journal_mode = WAL")
+        # In WAL mode NORMAL is still safe from corruption, and only syncs
+        # at checkpoints rather than on every commit.
+        con.execute("PRAGMA synchronous = NORMAL")
+        con.execute(f"PRAGMA cache_size = -{int(db_config['cache_size_kb'])}")
+        con.execute("PRAGMA temp_store = MEMORY")
+        con.execute("PRAGMA busy_timeout = 5000")
+        _local.con = con
+        db_check_schema(con)
+    return con
 
-    cursor.executemany(ins_sql, process_rows(reader))
-    con.commit()
+
+def db_check_schema(con):
+    """
+    Bring the database up to date, once per process.
+    """
+    global _schema_checked
+    with _schema_lock:
+        if _schema_checked:
+            return
+        db_migrate(con)
+        _schema_checked = True
+
+
+def db_migrate(con):
+    """
+    Apply the migrations this database hasn't had yet, each in its own
+    transaction along with the update of its version number.  The version is
+    checked again once we hold the write lock, in case another process is
+    migrating the same database.  Returns the new version.
+    """
+    version = con.execute("PRAGMA user_version").fetchone()[0]
+    while version < len(MIGRATIONS):
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            version = con.execute("PRAGMA user_version").fetchone()[0]
+            if version < len(MIGRATIONS):
+                migration = MIGRATIONS[version]
+                logging.info("Migrating database to version %d: %s", version + 1, migration.__name__)
+                migration(con.cursor())
+                version += 1
+                con.execute(f"PRAGMA user_version = {version}")
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+    return version
+
+
+def db_query_plans():
+    """
+    Run each query the bot makes against an empty in-memory database with
+    the current schema, and ask SQLite how it would run them.  Returns a list
+    of (sql, plan) for each statement, the plan being a list of its steps.
+    """
+    import os
+    import tempfile
+    con = sqlite3.connect(
+        ':memory:', detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None
+    )
+    db_migrate(con)
+    saved_con = getattr(_local, 'con', None)
+    _local.con = con
+    statements = []
+    con.set_trace_callback(statements.append)
+    try:
+        db_set_users([(1, 'Player', 2, 3, 'Member')])
+        db_get_user(faf_username='player')
+        db_get_user(discord_username='member')
+        db_get_user(discord_id=3)
+        db_get_users([1, 4], 2)
+        db_get_guild_users(2)
+        db_get_users_by_discord_ids([3, 5], 2)
+        db_watch_channel(2, 6)
+        db_unwatch_channel(2, 6)
+        db_store_games([Game(7, 'Game', None, None, 1, 'Player', {1: GamePlayer(1, 'Player', 1)})])
+        db_get_game(7)
+        db_get_active_game_for_player(1, 0)
+        db_get_watched_channels()
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            db_export_csv(os.path.join(tmp_dir, 'players.csv'))
+    finally:
+        con.set_trace_callback(None)
+        _local.con = saved_con
+    plans = []
+    for sql in statements:
+        if sql.split(None, 1)[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE'):
+            continue
+        plans.append((sql, [row[3] for row in con.execute(f"EXPLAIN QUERY PLAN {sql}")]))
+    con.close()
+    return plans
+
+
+def db_check_query_plans():
+    """
+    Return a list of (sql, plan) for the queries the bot makes that would
+    scan a table rather than use an index - which should be empty.  The
+    queries in FULL_TABLE_QUERIES read the whole table, so are expected to.
+    """
+    return [
+        (sql, plan) for sql, plan in db_query_plans()
+        if any(detail.startswith('SCAN') for detail in plan)
+        and ' '.join(sql.split()) not in FULL_TABLE_QUERIES
+    ]
+
+
+@contextmanager
+def db_transaction():
+    """
+    Run the body in a transaction on this thread's connection, and give it a
+    cursor.  In the writer thread the batch is already in a transaction, so
+    each write gets a savepoint instead - that way one failing write doesn't
+    undo the rest of the batch.
+    """
+    con = db_connection()
+    if getattr(_local, 'in_batch', False):
+        con.execute("SAVEPOINT write")
+        try:
+            yield con.cursor()
+        except BaseException:
+            con.execute("ROLLBACK TO write")
+            con.execute("RELEASE write")
+            raise
+        con.execute("RELEASE write")
+    else:
+        con.execute("BEGIN IMMEDIATE")
+        try:
+            yield con.cursor()
+        except BaseException:
+            con.execute("ROLLBACK")
+            raise
+        con.execute("COMMIT")
+
+
+class DBWriter:
+    """
+    Do all the bot's writes in one thread, so they never wait on a disk
+    sync in the event loop.  Writes that arrive within batch_delay of each
+    other - up to batch_size of them - are committed in one transaction, and
+    each write's future gets its result once that transaction is committed.
+    """
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Queue func(*args, **kwargs) to run in the writer thread.  Returns a
+        concurrent.futures.Future of its result.
+        """
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(
+                    target=self._run, name='db-writer', daemon=True
+                )
+                self._thread.start()
+        future = Future()
+        self._queue.put((func, args, kwargs, future))
+        return future
+
+    def close(self):
+        """
+        Finish the writes already queued and stop the thread.
+        """
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                self._queue.put(None)
+                self._thread.join()
+            self._thread = None
+
+    def _next_batch(self, first):
+        batch = [first]
+        deadline = time.monotonic() + db_config['batch_delay']
+        while len(batch) < db_config['batch_size']:
+            try:
+                item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+            except queue.Empty:
+                break
+            if item is None:
+                # Put the stop marker back for the main loop to see.
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        _local.in_batch = True
+        while True:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = self._next_batch(first)
+            self._write_batch(batch)
+
+    def _write_batch(self, batch):
+        start = time.monotonic()
+        results = []
+        try:
+            con = db_connection()
+            con.execute("BEGIN IMMEDIATE")
+            for func, args, kwargs, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                try:
+                    results.append((future, func(*args, **kwargs), None))
+                except Exception as e:
+                    results.append((future, None, e))
+            con.execute("COMMIT")
+        except Exception as e:
+            logging.error("Database write batch of %d failed: %s", len(batch), e)
+            try:
+                db_connection().execute("ROLLBACK")
+            except sqlite3.Error:
+                pass
+            for func, args, kwargs, future in batch:
+                if not future.done():
+                    if future.running():
+                        future.set_exception(e)
+                    elif future.set_running_or_notify_cancel():
+                        future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+        metrics_lib.incr('db_write_batches')
+        metrics_lib.incr('db_writes', len(batch))
+        metrics_lib.observe('db_write_batch_seconds', time.monotonic() - start)
+
+
+db_writer = DBWriter()
+_read_executor = None
+
+
+def db_read_executor():
+    """
+    Return the pool of reader threads, starting it if necessary.
+    """
+    global _read_executor
+    if _read_executor is None:
+        _read_executor = ThreadPoolExecutor(
+            max_workers=db_config['read_threads'], thread_name_prefix='db-read'
+        )
+    return _read_executor
+
+
+def db_count_rows(query, result):
+    """
+    Count the rows a query returned or a write was given, in metrics_lib's
+    db_rows.  A list is counted by its length, a tuple such as (game,
+    fetched_at) by whether its first item was found, None as no rows and
+    anything else as one.
+    """
+    if isinstance(result, list):
+        rows = len(result)
+    elif isinstance(result, tuple):
+        rows = 0 if result[0] is None else 1
+    else:
+        rows = 0 if result is None else 1
+    metrics_lib.incr('db_rows', rows, query=query)
+
+
+async def db_read(func, *args, **kwargs):
+    """
+    Run one of the query functions here in a reader thread, so the event
+    loop carries on while it runs.  Under a command's deadline we only wait
+    for the time left, raising DeadlineExceeded if it runs out - the query
+    carries on in its thread, but nothing waits for it.
+    """
+    loop = asyncio.get_running_loop()
+    with metrics_lib.timed('db_seconds', query=func.__name__):
+        result = loop.run_in_executor(
+            db_read_executor(), functools.partial(func, *args, **kwargs)
+        )
+        try:
+            result = await asyncio.wait_for(result, deadline_lib.remaining())
+        except asyncio.TimeoutError:
+            raise deadline_lib.exceeded('db') from None
+    db_count_rows(func.__name__, result)
+    return result
+
+
+async def db_write(func, *args, **kwargs):
+    """
+    Run one of the write functions here in the writer thread, batched with
+    any other writes happening at the same time.
+    """
+    with metrics_lib.timed('db_seconds', query=func.__name__):
+        result = await asyncio.wrap_future(db_writer.submit(func, *args, **kwargs))
+    db_count_rows(func.__name__, result)
+    return result
+
+
+def db_close():
+    """
+    Finish any queued writes and stop the database threads.
+    """
+    global _read_executor
+    db_writer.close()
+    if _read_executor is not None:
+        _read_executor.shutdown(wait=True)
+        _read_executor = None
+
+
+PLAYER_TIMESTAMPS = ['created_at', 'updated_at']
+PLAYER_EXPORT_SQL = f"SELECT {', '.join(PLAYER_HEADER + PLAYER_TIMESTAMPS)} FROM players"
+WATCHED_CHANNELS_SQL = "SELECT guild_id, channel_id FROM watched_channels"
+# The queries that read all of a table, so have to scan it
+FULL_TABLE_QUERIES = (PLAYER_EXPORT_SQL, WATCHED_CHANNELS_SQL)
+
+
+def db_import_csv(filename, chunk_size=1000, progress=None):
+    """
+    Read a CSV export of the players table - such as the one from the
+    TypeScript version of the bot - into the table here.  The header must
+    use the column names here; other columns, including sqlite3's 'rowid',
+    are ignored, and guild_id and discord_id are required.  Rows with either
+    of them empty are skipped, with a warning giving their line numbers,
+    since they'd be NULL and so never match - each run would add them again.
+
+    The file is read a chunk of rows at a time, each chunk upserted in its own
+    transaction, so memory use doesn't grow with the file and the import can
+    be safely run again - existing players are updated, not duplicated.  If
+    given, progress(rows, chars_read, file_chars) is called after each chunk.
+    Returns the number of rows imported.
+    """
+    import csv
+    import os
+    read = {'chars': 0}
+
+    def counted(fh):
+        for line in fh:
+            read['chars'] += len(line)
+            yield line
+
+    with open(filename, 'r', newline='') as fh:
+        file_chars = os.fstat(fh.fileno()).st_size
+        reader = csv.reader(counted(fh))
+        header = next(reader)
+        columns = [
+            (pos, field) for pos, field in enumerate(header)
+            if field in PLAYER_HEADER or field in PLAYER_TIMESTAMPS
+        ]
+        fields = [field for _, field in columns]
+        ignored = [field for field in header if field not in fields]
+        if ignored:
+            logging.info("Ignoring CSV columns %s", ignored)
+        if 'guild_id' not in fields or 'discord_id' not in fields:
+            raise ValueError("CSV needs guild_id and discord_id columns")
+        timestamp_pos = {pos for pos, field in columns if field in PLAYER_TIMESTAMPS}
+        key_pos = [pos for pos, field in columns if field in ('guild_id', 'discord_id')]
+        updates = ', '.join(
+            f"{field}=excluded.{field}"
+            for field in fields if field not in ('guild_id', 'discord_id')
+        )
+        ins_sql = f"""
+            INSERT INTO players
+            ({', '.join(fields)})
+            VALUES ({', '.join(['?'] * len(fields))})
+            ON CONFLICT (guild_id, discord_id) DO
+            UPDATE SET {updates}
+        """
+
+        def process_row(row):
+            return [
+                datetime.fromisoformat(row[pos]) if (pos in timestamp_pos and row[pos]) else (row[pos] or None)
+                for pos, _ in columns
+            ]
+
+        skipped = []  # line numbers
+
+        def keyed(reader):
+            for row in reader:
+                if all(row[pos] for pos in key_pos):
+                    yield row
+                else:
+                    skipped.append(reader.line_num)
+
+        rows = 0
+        keyed_rows = keyed(reader)
+        while True:
+            chunk = [process_row(row) for _, row in zip(range(chunk_size), keyed_rows)]
+            if not chunk:
+                break
+            with db_transaction() as cursor:
+                cursor.executemany(ins_sql, chunk)
+            rows += len(chunk)
+            if progress:
+                progress(rows, read['chars'], file_chars)
+    if skipped:
+        logging.warning(
+            "Skipped %d rows with no guild_id or discord_id, on lines %s",
+            len(skipped), ', '.join(map(str, skipped))
+        )
+    return rows
+
+
+def db_export_csv(filename, chunk_size=1000, progress=None):
+    """
+    Write the players table to a CSV file that db_import_csv() can read,
+    fetching a chunk of rows at a time.  The file is written under a
+    temporary name and renamed at the end, so a failed export never leaves
+    half a file behind.  If given, progress(rows) is called after each chunk.
+    Returns the number of rows exported.
+    """
+    import csv
+    import os
+    tmp_filename = f"{filename}.tmp"
+    rows = 0
+    with open(tmp_filename, 'w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(PLAYER_HEADER + PLAYER_TIMESTAMPS)
+        res = db_connection().execute(PLAYER_EXPORT_SQL)
+        while True:
+            chunk = res.fetchmany(chunk_size)
+            if not chunk:
+                break
+            writer.writerows(chunk)
+            rows += len(chunk)
+            if progress:
+                progress(rows)
+    os.replace(tmp_filename, filename)
+    return rows
 
 
 def map_rows(rows, fields=PLAYER_HEADER):
@@ -94,8 +616,8 @@ def map_row(row, fields=PLAYER_HEADER):
 def db_get_user(**kwargs):
     """
     Search the players table for a single row matching the given fields.
-    This is going to be a bit ugly compared to the nice query construction
-    syntax in e.g. Django.
+    Usernames are matched without regard to case.  This is going to be a bit
+    ugly compared to the nice query construction syntax in e.g. Django.
     """
     # Make up a where clause correlated to values
     if not kwargs:
@@ -103,14 +625,17 @@ def db_get_user(**kwargs):
     conditions = []
     values = []
     for field, value in kwargs.items():
-        conditions.append(f"{field} = ?")
+        if field in ('faf_username', 'discord_username'):
+            conditions.append(f"{field} = ? COLLATE NOCASE")
+        else:
+            conditions.append(f"{field} = ?")
         values.append(value)
     sql = f"""
         SELECT {PLAYER_HEADER_STR}
         FROM players
         WHERE {' and '.join(conditions)}
     """
-    res = cursor.execute(sql, values)
+    res = db_connection().execute(sql, values)
     row = res.fetchone()
     if not row:
         return None
@@ -119,8 +644,9 @@ def db_get_user(**kwargs):
 
 def db_get_users(faf_ids, guild_id):
     """
-    Fetch a list of database rows matching those FAF IDs.  Used
-    primarily for resolving players from a game.
+    Fetch a list of database rows matching those FAF IDs, which are
+    integers (e.g. the keys of Game.players).  Used primarily for resolving
+    players from a game.
     """
     qmarks = ', '.join(['?'] * len(faf_ids))
     sql = f"""
@@ -128,17 +654,45 @@ def db_get_users(faf_ids, guild_id):
         FROM players
         WHERE faf_id in ({qmarks}) AND guild_id = ?
     """
-    logging.info("Requesting FAF IDs %s", repr(faf_ids))
-    res = cursor.execute(sql, [int(i) for i in faf_ids] + [guild_id])
+    logging.debug("Requesting FAF IDs %s", faf_ids)
+    res = db_connection().execute(sql, list(faf_ids) + [guild_id])
     data = map_rows(res.fetchall())
-    logging.info("db_get_users returns %s", repr(data))
+    logging.debug("db_get_users returns %d rows for guild %s", len(data), guild_id)
     return data
 
 
+def db_get_guild_users(guild_id):
+    """
+    Fetch all the rows for this guild, as (faf_id, faf_username, discord_id)
+    tuples.  Used to load a guild's roster in one go.
+    """
+    res = db_connection().execute("""
+        SELECT faf_id, faf_username, discord_id
+        FROM players
+        WHERE guild_id = ?
+    """, (guild_id,))
+    return res.fetchall()
+
+
 def db_set_user(faf_id, faf_username, guild_id, discord_id, discord_username):
     """
     Add a user, or update them if they already exist.  The unique key is
-    (guild_id, discord_id).
+    (guild_id, discord_id).  Returns the user's row.
+    """
+    return db_set_users([
+        (faf_id, faf_username, guild_id, discord_id, discord_username)
+    ])[0]
+
+
+def db_set_users(users):
+    """
+    Add or update a batch of users in one transaction.  Each user is a tuple
+    in PLAYER_HEADER order: (faf_id, faf_username, guild_id, discord_id,
+    discord_username).  The unique key is (guild_id, discord_id).
+
+    Returns the rows, in the same order.  The upsert sets every column we
+    return, so the rows are made from what we were given rather than
+    selected again.
     """
     ins_sql = f"""
         INSERT INTO players
@@ -149,24 +703,221 @@ def db_set_user(faf_id, faf_username, guild_id, discord_id, discord_username):
           discord_username=excluded.discord_username, updated_at=excluded.updated_at
     """
     #     RETURNING {PLAYER_HEADER_STR} - doesn't seem to work
-    row_vals = (
-        faf_id, faf_username, discord_username, datetime.now(),
-        guild_id, discord_id,
-    )
-    # For some reason logging really doesn't like taking row_vals as an arguemnt here.
-    # Have to manually expand it?
-    # logging.info('Insert SQL: %s', ins_sql)
-    # logging.info('Row data: %s', repr(row_vals))
-    res = cursor.execute(ins_sql, row_vals)
-    con.commit()
-
-    # For some reason the RETURNING keyword doesn't work - SQLite complains about a
-    # syntax error.  So we just select it again...
+    users = list(users)
+    now = datetime.now()
+    with db_transaction() as cursor:
+        cursor.executemany(ins_sql, [
+            (faf_id, faf_username, discord_username, now, guild_id, discord_id)
+            for faf_id, faf_username, guild_id, discord_id, discord_username in users
+        ])
+    return map_rows(users)
+
+
+def db_get_users_by_discord_ids(discord_ids, guild_id):
+    """
+    Fetch a list of database rows for these Discord IDs in this guild.  Used
+    for finding the FAF IDs of the people in a voice channel.
+    """
+    qmarks = ', '.join(['?'] * len(discord_ids))
     sql = f"""
         SELECT {PLAYER_HEADER_STR}
         FROM players
-        WHERE guild_id = ? and discord_id = ?
+        WHERE guild_id = ? AND discord_id in ({qmarks})
     """
-    res = cursor.execute(sql, [guild_id, discord_id])
-    row = res.fetchone()
-    return map_row(row)
+    res = db_connection().execute(sql, [guild_id] + list(discord_ids))
+    return map_rows(res.fetchall())
+
+
+def db_get_watched_channels():
+    """
+    Return a list of (guild_id, channel_id) tuples of all the watched
+    channels.
+    """
+    res = db_connection().execute(WATCHED_CHANNELS_SQL)
+    return res.fetchall()
+
+
+def db_watch_channel(guild_id, channel_id):
+    """
+    Start watching this channel for games to sort.
+    """
+    with db_transaction() as cursor:
+        cursor.execute("""
+            INSERT INTO watched_channels (guild_id, channel_id)
+            VALUES (?, ?)
+            ON CONFLICT (guild_id, channel_id) DO NOTHING
+        """, (guild_id, channel_id))
+
+
+def db_unwatch_channel(guild_id, channel_id):
+    """
+    Stop watching this channel.  Returns True if it was being watched.
+    """
+    with db_transaction() as cursor:
+        res = cursor.execute("""
+            DELETE FROM watched_channels
+            WHERE guild_id = ? AND channel_id = ?
+        """, (guild_id, channel_id))
+    return res.rowcount > 0
+
+
+GAME_HEADER_STR = 'id, name, start_time, end_time, host_faf_id, host_faf_name, teams, fetched_at'
+
+
+def db_store_games(games):
+    """
+    Save the games to the cache, in one transaction.  Games that we already
+    have as ended aren't touched; the rest are replaced, players and all.
+    """
+    now = time.time()
+    with db_transaction() as cursor:
+        for game in games:
+            res = cursor.execute("""
+                INSERT INTO games (id, name, start_time, end_time, host_faf_id, host_faf_name, teams, fetched_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO
+                UPDATE SET name=excluded.name, start_time=excluded.start_time,
+                  end_time=excluded.end_time, host_faf_id=excluded.host_faf_id,
+                  host_faf_name=excluded.host_faf_name, teams=excluded.teams,
+                  fetched_at=excluded.fetched_at
+                WHERE games.end_time IS NULL
+            """, (
+                game.id, game.name, game.start_time, game.end_time,
+                game.host_faf_id, game.host_faf_name, game.teams, now
+            ))
+            if res.rowcount == 0:
+                continue  # already frozen
+            cursor.execute("DELETE FROM game_players WHERE game_id = ?", (game.id,))
+            cursor.executemany("""
+                INSERT INTO game_players (game_id, faf_id, name, team)
+                VALUES (?, ?, ?, ?)
+            """, [
+                (game.id, player.faf_id, player.name, player.team)
+                for player in game.players.values()
+            ])
+
+
+def db_game_from_row(con, row):
+    """
+    Make a Game from a row of the games table, with its players.  Returns a
+    tuple of (game, fetched_at).
+    """
+    game_id, name, start_time, end_time, host_faf_id, host_faf_name, teams, fetched_at = row
+    res = con.execute("""
+        SELECT faf_id, name, team FROM game_players WHERE game_id = ?
+    """, (game_id,))
+    players = {
+        faf_id: GamePlayer(faf_id, player_name, team)
+        for faf_id, player_name, team in res.fetchall()
+    }
+    return Game(
+        game_id, name, start_time, end_time, host_faf_id, host_faf_name,
+        players=players, teams=teams,
+    ), fetched_at
+
+
+def db_get_game(game_id):
+    """
+    Return a tuple of the cached game with this ID and the Unix time it was
+    fetched, or (None, None) if we don't have it.
+    """
+    con = db_connection()
+    row = con.execute(f"SELECT {GAME_HEADER_STR} FROM games WHERE id = ?", (game_id,)).fetchone()
+    if not row:
+        return None, None
+    return db_game_from_row(con, row)
+
+
+def db_get_active_game_for_player(faf_id, fetched_since):
+    """
+    Return the newest cached game this player is in that hadn't ended when
+    it was fetched, at or after the Unix time fetched_since - or None.
+    """
+    con = db_connection()
+    row = con.execute(f"""
+        SELECT {', '.join('g.' + field for field in GAME_HEADER_STR.split(', '))}
+        FROM game_players gp JOIN games g ON g.id = gp.game_id
+        WHERE gp.faf_id = ? AND g.end_time IS NULL AND g.fetched_at >= ?
+        ORDER BY gp.game_id DESC
+        LIMIT 1
+    """, (faf_id, fetched_since)).fetchone()
+    if not row:
+        return None
+    return db_game_from_row(con, row)[0]
+
+
+# The async versions of the queries above, for use in the bot's coroutines.
+
+async def db_get_user_async(**kwargs):
+    return await db_read(db_get_user, **kwargs)
+
+
+async def db_get_users_async(faf_ids, guild_id):
+    return await db_read(db_get_users, faf_ids, guild_id)
+
+
+async def db_get_guild_users_async(guild_id):
+    return await db_read(db_get_guild_users, guild_id)
+
+
+async def db_set_user_async(faf_id, faf_username, guild_id, discord_id, discord_username):
+    return await db_write(db_set_user, faf_id, faf_username, guild_id, discord_id, discord_username)
+
+
+async def db_set_users_async(users):
+    return await db_write(db_set_users, users)
+
+
+async def db_get_users_by_discord_ids_async(discord_ids, guild_id):
+    return await db_read(db_get_users_by_discord_ids, discord_ids, guild_id)
+
+
+async def db_get_watched_channels_async():
+    return await db_read(db_get_watched_channels)
+
+
+async def db_watch_channel_async(guild_id, channel_id):
+    return await db_write(db_watch_channel, guild_id, channel_id)
+
+
+async def db_unwatch_channel_async(guild_id, channel_id):
+    return await db_write(db_unwatch_channel, guild_id, channel_id)
+
+
+async def db_store_games_async(games):
+    return await db_write(db_store_games, games)
+
+
+async def db_get_game_async(game_id):
+    return await db_read(db_get_game, game_id)
+
+
+async def db_get_active_game_for_player_async(faf_id, fetched_since):
+    return await db_read(db_get_active_game_for_player, faf_id, fetched_since)
+
+
+if __name__ == '__main__':
+    # Import or export the players table, e.g. to move the players over
+    # from the TypeScript version of the bot:
+    #   python db_lib.py import players.csv
+    # or check that every query the bot makes uses an index:
+    #   python db_lib.py check
+    import sys
+    if sys.argv[1:] == ['check']:
+        problems = db_check_query_plans()
+        for sql, plan in problems:
+            print(f"{' '.join(sql.split())}\n  {'; '.join(plan)}", file=sys.stderr)
+        print(f"{len(problems)} queries without an index", file=sys.stderr)
+        sys.exit(1 if problems else 0)
+    if len(sys.argv) != 3 or sys.argv[1] not in ('import', 'export'):
+        print(f"Usage: {sys.argv[0]} import|export file.csv, or check", file=sys.stderr)
+        sys.exit(1)
+    if sys.argv[1] == 'import':
+        count = db_import_csv(sys.argv[2], progress=lambda rows, done, size: print(
+            f"\r{rows} rows, {100 * done // max(size, 1)}%", end='', file=sys.stderr
+        ))
+    else:
+        count = db_export_csv(sys.argv[2], progress=lambda rows: print(
+            f"\r{rows} rows", end='', file=sys.stderr
+        ))
+    print(f"\n{sys.argv[1].capitalize()}ed {count} rows", file=sys.stderr)
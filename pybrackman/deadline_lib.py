@@ -0,0 +1,165 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+import contextvars
+import logging
+import time
+
+import metrics_lib
+
+# Each command has a deadline, carried in a context variable so the FAF,
+# database and Discord calls made for it - however deeply - can see how
+# long they have left.  The stages of a command each get a share of the
+# whole time, so one slow stage can't use up the rest's; a stage without a
+# share gets whatever's left.  The settings can be overridden from the
+# optional 'deadlines' section of the config.
+
+deadline_config = {
+    'sort': 30,  # seconds for each command
+    'set': 15,
+    'who': 15,
+    'shares': {  # fraction of the command's time for each stage
+        'player': 0.25,
+        'faf_player': 0.5,
+        'game': 0.5,
+        'resolve': 0.25,
+        'channels': 0.5,
+    },
+}
+
+current_deadline = contextvars.ContextVar('current_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    """
+    A stage of a command ran out of time.
+    """
+    def __init__(self, stage):
+        super().__init__(f"{stage} ran out of time")
+        self.stage = stage
+
+
+class Deadline:
+    """
+    The time by which a command must finish, and how long it had.
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+        self.at = time.monotonic() + seconds
+
+    def remaining(self):
+        return max(0.0, self.at - time.monotonic())
+
+    def expired(self):
+        return time.monotonic() >= self.at
+
+    def timeout(self, stage=None):
+        """
+        The most time the stage can have: its share, or what's left if
+        that's less.
+        """
+        share = deadline_config['shares'].get(stage)
+        if share is None:
+            return self.remaining()
+        return min(self.remaining(), share * self.seconds)
+
+
+def deadline_init(full_config):
+    config = dict(full_config.get('deadlines') or {})
+    deadline_config['shares'].update(config.pop('shares', None) or {})
+    deadline_config.update(config)
+
+
+def set_deadline(command):
+    """
+    Start the deadline for this command, if it has one, for the rest of this
+    task (and the tasks it starts).  Returns the deadline or None.
+    """
+    seconds = deadline_config.get(command)
+    deadline = Deadline(seconds) if seconds else None
+    current_deadline.set(deadline)
+    return deadline
+
+
+@contextmanager
+def deadline_for(command):
+    """
+    Run the body of a with statement under this command's deadline.
+    """
+    seconds = deadline_config.get(command)
+    token = current_deadline.set(Deadline(seconds) if seconds else None)
+    try:
+        yield current_deadline.get()
+    finally:
+        current_deadline.reset(token)
+
+
+@contextmanager
+def no_deadline():
+    """
+    Run the body of a with statement - and the tasks it starts - without a
+    deadline.  For work shared by several callers, which each wait on it
+    for as long as they have, rather than being cut short by whoever
+    started it.
+    """
+    token = current_deadline.set(None)
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining():
+    """
+    The seconds left before the current deadline, or None if there isn't one.
+    """
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline.remaining()
+
+
+def stage_timeout(stage):
+    """
+    The most time this stage of the current command can have, or None if
+    there's no deadline.
+    """
+    deadline = current_deadline.get()
+    return None if deadline is None else deadline.timeout(stage)
+
+
+def exceeded(stage):
+    metrics_lib.incr('deadline_exceeded', stage=stage)
+    logging.warning("Stage %s ran out of time", stage)
+    return DeadlineExceeded(stage)
+
+
+@asynccontextmanager
+async def within(stage):
+    """
+    Run the body of an async with statement for at most the stage's time,
+    cancelling it and raising DeadlineExceeded if it takes longer.
+    """
+    timeout = stage_timeout(stage)
+    if timeout is None:
+        yield
+        return
+    try:
+        async with asyncio.timeout(timeout) as scope:
+            yield
+    except TimeoutError:
+        # Not if something inside timed out on its own account
+        if scope.expired():
+            raise exceeded(stage) from None
+        raise
+
+
+async def wait_within(stage, tasks):
+    """
+    Wait for the tasks for at most the stage's time.  Returns the sets of
+    done and pending tasks - the pending ones are left running, for the
+    caller to cancel or leave to finish.
+    """
+    if not tasks:
+        return set(), set()
+    done, pending = await asyncio.wait(tasks, timeout=stage_timeout(stage))
+    if pending:
+        exceeded(stage)
+    return done, pending
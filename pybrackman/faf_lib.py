@@ -1,20 +1,88 @@
+import asyncio
+import aiohttp
+import json
 import logging
+import random
+import time
 import requests
-from requests_oauth2client import (
-    OAuth2Client, ClientSecretPost, ApiClient, OAuth2ClientCredentialsAuth
-)
+from requests_oauth2client import OAuth2Client, ClientSecretPost, ApiClient
 import yaml
+import yarl
+
+from archive_lib import ResponseArchive
+from cache_lib import SingleFlight, TTLCache
+from circuit_lib import CircuitBreaker
+import deadline_lib
+from db_lib import db_get_active_game_for_player_async, db_get_game_async, db_store_games_async
+from game_lib import Game, GamePlayer
+import metrics_lib
+from oauth_lib import TokenManager, TokenManagerAuth
 
 config = dict()
 client = None
 api_root = "https://api.faforever.com/data/"
 api = None
+token_manager = None
+archive = None
+
+# The asynchronous client.  The session is created on first use, because it
+# has to belong to the running event loop; the settings can be overridden from
+# the optional 'faf_api' section of the config.
+session = None
+session_config = {
+    'timeout': 10,          # seconds for the whole request
+    'connect_timeout': 5,   # seconds to establish a connection
+    'pool_size': 20,        # maximum simultaneous connections to the API
+    'keepalive': 30,        # seconds to keep an idle connection open
+    'cache_size': 2000,     # players remembered by the async lookups
+    'cache_ttl': 600,       # seconds to remember a player we found
+    'cache_negative_ttl': 60,  # seconds to remember a player wasn't found
+    'cache_stale_ttl': 3600,  # seconds more to use a player while refreshing it
+    'last_game_ttl': 30,    # seconds to share a running game among its players
+    'archive_dir': None,    # directory to archive raw game responses in, if any
+    'archive_segment_bytes': 8 * 1024 * 1024,
+    'archive_max_bytes': 64 * 1024 * 1024,  # total size of the archive
+    'retries': 2,           # times to retry a request that timed out or failed
+    'retry_delay': 0.5,     # seconds before the first retry, doubling each time
+    'retry_max_delay': 5,   # most seconds to wait before a retry
+    'breaker_failures': 5,  # failed requests in a row before we stop asking
+    'breaker_reset': 30,    # seconds between trial requests once we've stopped
+}
+# Status codes worth retrying: FAF being overloaded or briefly down.
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+breaker = CircuitBreaker('faf_api')
+
+# Caches of the async player and ID lookups, keyed by faf_cache_key(login).
+# Expired players are still answered with while they're refreshed in the
+# background, or if FAF can't be asked.
+player_cache = TTLCache('faf_player', stale_ttl=3600)
+id_cache = TTLCache('faf_id', stale_ttl=3600)
+refresh_flights = SingleFlight()
+refresh_tasks = set()
+# Last game lookups in progress, keyed by FAF ID.  Once a running game has
+# been fetched it's remembered for a short while for all of its players, so
+# the rest of the lobby asking a moment later doesn't need to ask FAF again.
+last_game_flights = SingleFlight()
+last_game_cache = TTLCache('faf_last_game', ttl=30, negative_ttl=0)
+# The most players we ask about in one batched games request.
+BATCH_CHUNK_SIZE = 100
+# The objects and fields of a game document that we actually use.
+GAME_FIELDS = {
+    'game': 'name,startTime,endTime,host,playerStats',
+    'gamePlayerStats': 'team,player',
+    'player': 'login',
+}
+GAME_INCLUDES = 'host,playerStats.player'
 
 
 def init_oauth_config(full_config):
     """
     Load the config for our OAuth2 setup from the 'oauth2' section of the
     config.yaml file, and initialise the client, oauth
+
+    The token is cached in the file named by the optional 'token_cache' key
+    (default 'faf_token.json'), and refreshed 'refresh_margin' seconds
+    (default 300) before it expires.
     """
     if 'oauth2' not in full_config:
         print(f"ERROR: No oauth2 section in config")
@@ -29,53 +97,361 @@ def init_oauth_config(full_config):
         config['token_url'],
         auth=ClientSecretPost(config['client_id'], config['client_secret'])
     )
+    global token_manager
+    token_manager = TokenManager(
+        client,
+        cache_file=config.get('token_cache', 'faf_token.json'),
+        refresh_margin=config.get('refresh_margin', 300),
+        client_id=config['client_id'],
+        token_url=config['token_url'],
+    )
+    token_manager.load_cache()
     global api
     api = ApiClient(
-        api_root, auth=OAuth2ClientCredentialsAuth(client)
+        api_root, auth=TokenManagerAuth(token_manager)
+    )
+    session_config.update(full_config.get('faf_api') or {})
+    for cache in (player_cache, id_cache):
+        cache.configure(
+            maxsize=session_config['cache_size'],
+            ttl=session_config['cache_ttl'],
+            negative_ttl=session_config['cache_negative_ttl'],
+            stale_ttl=session_config['cache_stale_ttl'],
+        )
+    last_game_cache.configure(ttl=session_config['last_game_ttl'])
+    breaker.configure(
+        max_failures=session_config['breaker_failures'],
+        reset_timeout=session_config['breaker_reset'],
     )
+    global archive
+    if session_config['archive_dir']:
+        archive = ResponseArchive(
+            session_config['archive_dir'],
+            segment_bytes=session_config['archive_segment_bytes'],
+            max_bytes=session_config['archive_max_bytes'],
+        )
     logging.info("OAuth2 to FAF API successful")
 
 
-def faf_get_player_for_user(faf_username):
+async def faf_session():
     """
-    Get the player details of a user given their username.
+    Return the shared aiohttp session, creating it if necessary.  All the
+    async calls share its pool of keep-alive connections to the API.
     """
-    global api
-    logging.info("got to faf_get_player_for_user(%s)", faf_username)
-    name = requests.utils.quote(faf_username)
-    path = f"player?filter=login=={name}&page[size]=1&include=names"
-    resp = api.get(path)
-    # logging.info("Received %s on get ID of %s: %s", resp.status_code, name, resp.content.decode())
-    if resp.status_code != 200:
-        logging.warn("Received %s on get ID of %s: %s", resp.status_code, name, resp.content.decode())
+    global session
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=session_config['pool_size'],
+            keepalive_timeout=session_config['keepalive'],
+            ttl_dns_cache=300,
+        )
+        session = aiohttp.ClientSession(
+            connector=connector,
+            timeout=aiohttp.ClientTimeout(
+                total=session_config['timeout'],
+                sock_connect=session_config['connect_timeout'],
+            ),
+            headers={'Accept': 'application/vnd.api+json'},
+        )
+    return session
+
+
+async def faf_start():
+    """
+    Start the background work of the FAF client - currently just keeping the
+    access token fresh.  Call this once the event loop is running.
+    """
+    if token_manager is not None:
+        token_manager.start()
+
+
+async def faf_close():
+    """
+    Close the shared session, if we have one, and finish writing the
+    archive.  Call this on shutdown.
+    """
+    if token_manager is not None:
+        await token_manager.stop()
+    for task in list(refresh_tasks):
+        task.cancel()
+    global session
+    if session is not None and not session.closed:
+        await session.close()
+    session = None
+    if archive is not None:
+        await asyncio.to_thread(archive.close)
+
+
+async def faf_api_request_async(path, timeout=None):
+    """
+    Make one request for the given path, taking at most timeout seconds if
+    given as well as the session's timeouts.  Returns a tuple of the HTTP
+    status, the response body as text and the seconds the response asked us
+    to wait before retrying, if it did.  If the request times out, fails to
+    connect or we can't get a token, the status is None.
+
+    If FAF refuses our token, it's thrown away and the request is made once
+    more with a new one.
+    """
+    # The paths we build are already quoted, so stop yarl quoting them again.
+    url = yarl.URL(api_root + path, encoded=True)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    for attempt in range(2):
+        try:
+            token = await token_manager.get_token()
+        except Exception as e:
+            # Counted as a failed request, so the circuit breaker sees it
+            metrics_lib.incr('faf_api_responses', status='token_error')
+            logging.warning("Could not get a FAF API token for %s: %r", path, e)
+            return None, '', None
+        headers = {'Authorization': f"Bearer {token}"}
+        kwargs = dict()
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            if timeout < session_config['timeout']:
+                kwargs['timeout'] = aiohttp.ClientTimeout(
+                    total=timeout, sock_connect=min(timeout, session_config['connect_timeout'])
+                )
+        start = time.monotonic()
+        try:
+            sess = await faf_session()
+            async with sess.get(url, headers=headers, **kwargs) as resp:
+                body = await resp.text()
+                metrics_lib.incr('faf_api_responses', status=resp.status)
+                if resp.status == 401 and not attempt:
+                    token_manager.invalidate(token)
+                    continue
+                try:
+                    retry_after = float(resp.headers.get('Retry-After', ''))
+                except ValueError:
+                    retry_after = None
+                return resp.status, body, retry_after
+        except asyncio.TimeoutError:
+            metrics_lib.incr('faf_api_responses', status='timeout')
+            logging.warning("Timed out getting %s from FAF API", path)
+        except aiohttp.ClientError as e:
+            metrics_lib.incr('faf_api_responses', status='error')
+            logging.warning("Error getting %s from FAF API: %s", path, e)
+        finally:
+            metrics_lib.observe('faf_api_seconds', time.monotonic() - start)
+        break
+    return None, '', None
+
+
+async def faf_api_get_async(path):
+    """
+    Get the given path from the FAF API without blocking the event loop.
+
+    Requests that time out, fail to connect or get a status in
+    RETRY_STATUSES are retried up to 'retries' times, after an exponentially
+    increasing delay with jitter - or the time FAF asked for - of at most
+    'retry_max_delay' seconds.  While FAF keeps failing the circuit breaker
+    opens and we don't ask at all, so no time is spent waiting on it.
+    Under a command's deadline, each request only has the time left, and we
+    don't retry if there isn't time to.
+
+    Returns a tuple of the HTTP status and the response body as text.  If the
+    request times out, fails to connect or isn't made, the status is None.
+    """
+    status, body = None, ''
+    for attempt in range(session_config['retries'] + 1):
+        left = deadline_lib.remaining()
+        if left is not None and left <= 0:
+            break
+        if not breaker.allow():
+            logging.warning("Not asking FAF API for %s - it's been failing", path)
+            break
+        status, body, retry_after = await faf_api_request_async(path, left)
+        if status == 401:
+            # Even a new token was refused, so trying again won't help
+            logging.error("FAF API refused our token for %s", path)
+            breaker.failure()
+            return status, body
+        if status is not None and status not in RETRY_STATUSES:
+            breaker.success()
+            return status, body
+        breaker.failure()
+        if attempt == session_config['retries']:
+            break
+        delay = min(
+            retry_after if retry_after is not None
+            else session_config['retry_delay'] * 2 ** attempt * random.uniform(0.5, 1.5),
+            session_config['retry_max_delay']
+        )
+        left = deadline_lib.remaining()
+        if left is not None and left <= delay:
+            logging.info("No time left to retry %s after %s", path, status)
+            break
+        metrics_lib.incr('faf_api_retries')
+        logging.info("Retrying %s in %.1fs after %s", path, delay, status)
+        await asyncio.sleep(delay)
+    return status, body
+
+
+def faf_decode(body, what):
+    """
+    Decode a response body as JSON, or return None - with a warning about
+    what it was meant to be - if it isn't JSON.
+    """
+    try:
+        return json.loads(body)
+    except ValueError:
+        logging.warning("Could not decode %s: %s", what, body)
         return None
-    # data.data[0].id
-    # {"data":[{"type":"player","id":"129182",...], ...}
-    player = resp.json()
+
+
+def faf_refresh_in_background(key, func, *args):
+    """
+    Start func(*args) in the background to refresh a stale cache entry,
+    unless it's already being refreshed.
+    """
+    if key in refresh_flights:
+        return
+
+    async def refresh():
+        try:
+            await refresh_flights.run(key, func, *args)
+        except Exception as e:
+            logging.warning("Refreshing %s failed: %r", key, e)
+
+    with deadline_lib.no_deadline():
+        task = asyncio.create_task(refresh())
+    refresh_tasks.add(task)
+    task.add_done_callback(refresh_tasks.discard)
+
+
+def faf_player_paths(faf_username):
+    """
+    The API paths used to look a player up: first by their current login,
+    then by their previous names in case they have renamed themselves.
+    """
+    name = requests.utils.quote(faf_username)
+    return (
+        f"player?filter=login=={name}&page[size]=1&include=names",
+        f"player?filter=names.name=={name}&page[size]=1&include=names",
+    )
+
+
+def faf_player_from_data(player):
+    """
+    Check the decoded response of a player lookup and return the first player
+    in it.  Returns None if the player wasn't found, or False if the
+    response didn't look like player data at all.
+    """
     if 'data' not in player:
         # Data format error
         logging.error("Returned data had no 'data': %s", player)
-        return None
+        return False
     if len(player['data']) == 0:
         # Not found
-        # Try looking for a name change...
-        path = f"player?filter=names.name=={name}&page[size]=1&include=names"
-        resp = api.get(path)
-        if resp.status_code != 200:
-            logging.warn("Received %s on get a name of %s: %s", resp.status_code, name, resp.content.decode())
-            return None
-        player = resp.json()
-        if 'data' not in player:
-            logging.error("Returned JSON had no 'data': %s", player)
-            return None
-        if len(player['data']) == 0:
-            logging.error("Returned data had no listed data: %s", player)
-            return None
+        return None
     if 'type' in player['data'][0] and player['data'][0]['type'] == 'player':
         return player['data'][0]
     else:
         logging.error("Returned data didn't seem to be of type 'player': %s", player)
         # Data format error
+        return False
+
+
+def faf_get_player_for_user(faf_username):
+    """
+    Get the player details of a user given their username.
+    """
+    global api
+    logging.info("got to faf_get_player_for_user(%s)", faf_username)
+    # If they're not found by login, try looking for a name change...
+    for path in faf_player_paths(faf_username):
+        resp = api.get(path)
+        # logging.info("Received %s on get ID of %s: %s", resp.status_code, name, resp.content.decode())
+        if resp.status_code != 200:
+            logging.warning("Received %s on get player %s: %s", resp.status_code, faf_username, resp.text)
+            return None
+        # data.data[0].id
+        # {"data":[{"type":"player","id":"129182",...], ...}
+        player = faf_player_from_data(resp.json())
+        if player is not None:
+            return player or None
+    logging.error("No player found for %s", faf_username)
+    return None
+
+
+def faf_cache_key(faf_username):
+    """
+    FAF logins don't depend on case, so neither do our cache keys.
+    """
+    return faf_username.strip().casefold()
+
+
+async def faf_get_player_for_user_async(faf_username, bypass_cache=False):
+    """
+    Get the player details of a user given their username, without blocking
+    the event loop.
+
+    Results - including not finding the player - are cached; set bypass_cache
+    to always ask the API (the answer is still cached).  Errors talking to
+    the API are never cached.  An expired player is returned straight away
+    while it's refreshed in the background.
+    """
+    key = faf_cache_key(faf_username)
+    if not bypass_cache:
+        found, player, stale = player_cache.lookup_stale(key)
+        if found:
+            if stale:
+                faf_refresh_in_background(('player', key), faf_fetch_player_for_user_async, faf_username)
+            return player
+    return await faf_fetch_player_for_user_async(faf_username)
+
+
+async def faf_fetch_player_for_user_async(faf_username):
+    """
+    Ask the API for the player details of a user, and cache them.  If the
+    API can't be asked, we make do with an expired player if we have one.
+    """
+    key = faf_cache_key(faf_username)
+    logging.info("Getting FAF player %s", faf_username)
+    for path in faf_player_paths(faf_username):
+        status, body = await faf_api_get_async(path)
+        if status != 200:
+            logging.warning("Received %s on get player %s: %s", status, faf_username, body)
+            return player_cache.stale(key)[1]
+        player_data = faf_decode(body, f"player {faf_username}")
+        if player_data is None:
+            return player_cache.stale(key)[1]
+        player = faf_player_from_data(player_data)
+        if player is False:
+            return None
+        if player is not None:
+            player_cache.set(key, player)
+            # Only a match on the current login also answers an ID lookup.
+            if faf_cache_key(player.get('attributes', {}).get('login', '')) == key:
+                id_cache.set(key, player['id'])
+            return player
+    logging.error("No player found for %s", faf_username)
+    player_cache.set(key, None)
+    return None
+
+
+def faf_id_path(faf_username):
+    """
+    The API path to look up just the ID of a player by their login.
+    """
+    name = requests.utils.quote(faf_username)
+    return f"player?filter=login=={name}&page[size]=1"
+
+
+def faf_id_from_data(player_data):
+    """
+    Get the player ID out of the decoded response of an ID lookup, or None.
+    """
+    logging.debug("Got player data %s", player_data)
+    if not player_data:
+        return None
+    try:
+        return int(player_data['data'][0]['id'])
+    except (IndexError, KeyError, ValueError):
+        logging.warning("Data format error - can't find [data][0][id] in %s", player_data)
         return None
 
 
@@ -83,136 +459,198 @@ def faf_get_id_for_user(faf_username):
     """
     Just use the get_player_for_username and get the ID alone.
     """
-    logging.info(f"got to faf_get_id_for_user({faf_username=})")
+    logging.info("Getting the FAF ID of %s", faf_username)
     # player = faf_get_player_for_username(faf_username)
-    name = requests.utils.quote(faf_username)
-    path = f"player?filter=login=={name}&page[size]=1"
     global api
-    resp = api.get(path)
+    resp = api.get(faf_id_path(faf_username))
     if resp.status_code != 200:
-        logging.warn("Received %s on get ID of %s: %s", resp.status_code, name, resp.content.decode())
-        return None
-    player_data = resp.json()
-    logging.info(f"... got {player_data=} back")
-    if not player_data:
-        return None
-    try:
-        return player_data['data'][0]['id']
-    except (IndexError, KeyError):
-        logging.warn("Data format error - can't find [data][0][id] in %s", player_data)
+        logging.warning("Received %s on get ID of %s: %s", resp.status_code, faf_username, resp.text)
         return None
+    return faf_id_from_data(resp.json())
 
 
-def faf_game_data_get_host_name(faf_data):
+async def faf_get_id_for_user_async(faf_username, bypass_cache=False):
     """
-    Try to get the name of the host, from the game's relationships and
-    included data.
+    Get the ID of a player by their login, without blocking the event loop.
+    Cached in the same way as faf_get_player_for_user_async.
+    """
+    key = faf_cache_key(faf_username)
+    if not bypass_cache:
+        found, faf_id, stale = id_cache.lookup_stale(key)
+        if found:
+            if stale:
+                faf_refresh_in_background(('id', key), faf_fetch_id_for_user_async, faf_username)
+            return faf_id
+    return await faf_fetch_id_for_user_async(faf_username)
 
-    gamedata['relationships']['host']['data']['id'] -> host_id
-    data['included'][]['type'] == 'player':
-      ['id'] == host_id:
-        ['attributes']['login'] -> host_name
 
-    If this fails, return 'someone'.
+async def faf_fetch_id_for_user_async(faf_username):
     """
-    host_name = 'someone'
-    try:
-        host_id = faf_data['data'][0]['relationships']['host']['data']['id']
-        for inc in faf_data['included']:
-            if inc['type'] == 'player' and inc['id'] == host_id:
-                host_name = inc['attributes']['login']
-    except:
-        pass
-    # We don't know here if the person who issued the f/sort is the person who
-    # created the game, so we can't change this to 'you' if that's the case.
-    return host_name
+    Ask the API for the ID of a player, and cache it - or make do with an
+    expired one if the API can't be asked.
+    """
+    key = faf_cache_key(faf_username)
+    logging.info("Getting the FAF ID of %s", faf_username)
+    status, body = await faf_api_get_async(faf_id_path(faf_username))
+    if status != 200:
+        logging.warning("Received %s on get ID of %s: %s", status, faf_username, body)
+        return id_cache.stale(key)[1]
+    player_data = faf_decode(body, f"ID of {faf_username}")
+    if player_data is None:
+        return id_cache.stale(key)[1]
+    faf_id = faf_id_from_data(player_data)
+    # An empty list means they don't exist; anything else odd isn't cached.
+    if faf_id is not None or player_data.get('data') == []:
+        id_cache.set(key, faf_id)
+    return faf_id
 
 
 def faf_data_to_game_data(faf_data):
     """
-    Data received is pretty big - an example is in faf_get_last_game_for_faf_id.json.
-    The mapping of fields is:
+    Convert the document returned for a player's last game into a Game (see
+    game_lib), or None if it doesn't hold one.  The fields we use are:
     gamedata = data['data'][0]
     gamedata['type'] == 'game'
-    gamedata['id'] -> game['id']
-    gamedata['attributes']['name'] -> game['name']
-    gamedata['attributes']['endTime'] -> game['end_time']
-    gamedata['relationships']['host']['data']['id'] -> int() -> game['host_faf_id']
-    data['included'][]['type'] == 'gamePlayerStats':
-      ['attributes']['team'] -> players[][id][team]
-      ['relationships']['player']['data']['id'] -> players[][id]
-    data['included'][]['type'] == 'player':
-      ['id'] -> id
-      ['attributes']['login'] -> players[][id]['name']
-
-    Data returned is of this form:
-    game = {
-        'name': 'ANZ FAF MapGen',
-        'end_time': "2023-11-28T05:31:36Z",
-        'map': {
-        },
-        'teams': 2,
-        'players': {  # indexed by faf_id for fast database lookup
-            129182: {
-                'name': 'PaulWay', 'team': 1
-            },
-            203724: {
-                'name': 'crenn6977', 'team': 2
-            }
-        }
-    }
+    gamedata['id'] -> int() -> game.id
+    gamedata['attributes']['name'] -> game.name
+    gamedata['attributes']['endTime'] -> game.end_time
+    gamedata['relationships']['host']['data']['id'] -> int() -> game.host_faf_id
+    gamedata['relationships']['playerStats']['data'][]['id'] -> stats ids
+    data['included'][]['type'] == 'gamePlayerStats', by stats id:
+      ['attributes']['team'] -> game.players[faf_id].team
+      ['relationships']['player']['data']['id'] -> int() -> faf_id
+    data['included'][]['type'] == 'player', by player id:
+      ['attributes']['login'] -> game.players[faf_id].name
+      (and the host's login -> game.host_faf_name)
 
     We also subtract 1 from the FAF team number because 1=FFA.
+
+    The included objects are indexed by (type, id) in one pass, and the game
+    is then built by following its relationships - see faf_data_to_games().
     """
     if 'data' not in faf_data:
-        logging.warn("'data' not in %s", repr(faf_data))
-        return {}
+        logging.warning("'data' not in %s", faf_data)
+        return None
     if len(faf_data['data']) == 0:
-        logging.warn("'data' list empty in %s", repr(faf_data))
-        return {}
+        logging.warning("'data' list empty in %s", faf_data)
+        return None
     gamedata = faf_data['data'][0]
     if ('type' not in gamedata) or (gamedata['type'] != 'game'):
-        logging.warn("data doesn't look like a game in %s", repr(game_data))
-        return {}
-    game = {
-        'name': gamedata['attributes']['name'],
-        'id': gamedata['id'],
-        'end_time': gamedata['attributes'].get('endTime'),
-        'start_time': gamedata['attributes']['startTime'],
-        'host_faf_id': gamedata['relationships']['host']['data']['id'],
-        # 'host_faf_name': gamedata['relationships']['host']['data'].get('name', 'name?'),
-        # host's ID is given, need to look at the players and try to get their name.
-        'host_faf_name': faf_game_data_get_host_name(faf_data)
-    }
-    players = dict()
-    max_team = 0
-    for include in faf_data['included']:
-        key = ''
-        # Get data in two different ways, both indexed on faf_id
-        if include['type'] == 'player':
-           faf_id = include['id']
-           key = 'name'
-           value = include['attributes']['login']
-        elif include['type'] == 'gamePlayerStats':
-           faf_id = include['relationships']['player']['data']['id']
-           key = 'team'
-           value = include['attributes']['team'] - 1  # team 1 = FFA
-           if value > max_team:
-               max_team = value
-        # Player data from name or team keys - others set directly?
-        if key in ('name', 'team'):
-            if faf_id not in players:
-               players[faf_id] = dict()
-            players[faf_id][key] = value
-    game['players'] = players
-    game['teams'] = max_team
+        logging.warning("data doesn't look like a game in %s", gamedata)
+        return None
+    try:
+        game = faf_game_from_data(gamedata, faf_index_included(faf_data))
+    except (KeyError, TypeError, ValueError) as e:
+        logging.warning("Could not understand game %s: %s", gamedata.get('id'), e)
+        return None
     logging.info(
-        "FAF says last game for %s (id %s) has players %s",
-        players[faf_id]['name'], faf_id, players
+        "FAF says game %s has players %s", game.id, game.players
     )
     return game
 
 
+def faf_index_included(faf_data):
+    """
+    Index the document's included objects by (type, id).
+    """
+    return {
+        (inc['type'], inc['id']): inc
+        for inc in faf_data.get('included', [])
+    }
+
+
+def faf_game_from_data(gamedata, included):
+    """
+    Build one Game from a game object and the document's included objects
+    indexed by (type, id).  The players are found through the game's own
+    playerStats relationship, so this works when the document holds more
+    than one game.
+    """
+    relationships = gamedata['relationships']
+    attributes = gamedata['attributes']
+    host_id = relationships['host']['data']['id']
+    host = included.get(('player', host_id))
+    players = dict()
+    for stats_ref in relationships['playerStats']['data']:
+        stats = included.get(('gamePlayerStats', stats_ref['id']))
+        if stats is None:
+            continue
+        player_id = stats['relationships']['player']['data']['id']
+        player = included.get(('player', player_id))
+        faf_id = int(player_id)
+        players[faf_id] = GamePlayer(
+            faf_id,
+            name=player['attributes']['login'] if player else None,
+            team=stats['attributes']['team'] - 1,  # team 1 = FFA
+        )
+    return Game(
+        int(gamedata['id']),
+        attributes['name'],
+        attributes['startTime'],
+        attributes.get('endTime'),
+        int(host_id),
+        host['attributes']['login'] if host else 'someone',
+        players=players,
+    )
+
+
+def faf_data_to_games(faf_data):
+    """
+    Convert a document holding any number of games into a list of games, in
+    the order FAF gave them.  Games that can't be understood are skipped.
+    """
+    included = faf_index_included(faf_data)
+    games = []
+    for gamedata in faf_data.get('data', []):
+        if gamedata.get('type') != 'game':
+            continue
+        try:
+            games.append(faf_game_from_data(gamedata, included))
+        except (KeyError, TypeError, ValueError) as e:
+            logging.warning("Could not understand game %s: %s", gamedata.get('id'), e)
+    return games
+
+
+def faf_game_query():
+    """
+    The query parameters that ask for just the parts of a game that
+    faf_game_from_data() uses, as JSON:API sparse fieldsets.  The full game
+    documents, with every attribute and relationship of every player, are
+    many times larger.
+    """
+    fields = '&'.join(
+        f"fields[{obj_type}]={obj_fields}"
+        for obj_type, obj_fields in GAME_FIELDS.items()
+    )
+    return f"{fields}&include={GAME_INCLUDES}"
+
+
+def faf_last_game_path(faf_id):
+    """
+    The API path to get the last game a player was in.
+    """
+    # faf_id here comes from the API - it's an integer.
+    return (
+        f"game?filter=playerStats.player.id=={faf_id}&sort=-id&page[size]=1&" +
+        faf_game_query()
+    )
+
+
+def faf_archive_game_data(jsondata, content):
+    """
+    Save the raw game response in the archive, if there is one, for looking
+    at later.  The archive writes it in the background.
+    """
+    if archive is None:
+        return
+    game_ids = [
+        int(gamedata['id']) for gamedata in jsondata.get('data', [])
+        if gamedata.get('type') == 'game' and 'id' in gamedata
+    ]
+    if game_ids:
+        archive.append(game_ids, content)
+
+
 def faf_get_last_game_for_faf_id(faf_id):
     """
     Get the last game data for a given player's FAF ID.
@@ -220,20 +658,190 @@ def faf_get_last_game_for_faf_id(faf_id):
     See the faf_data_to_game_data() function for the return value.
     """
     # quid = requests.utils.quote(str(faf_id))
-    # faf_id here comes from the API - it's an integer.
-    path = (
-        f"game?filter=playerStats.player.id=={faf_id}&sort=-id&page[size]=1&" +
-        f"include=host,playerStats.player,mapVersion,mapVersion.map"
-    )
     global api
-    resp = api.get(path)
+    resp = api.get(faf_last_game_path(faf_id))
     if resp.status_code != 200:
-        logging.warn("Received %s on game for %s: %s", resp.status_code, faf_id, resp.content.decode())
-    # logging.info("Game data for FAF id %s = %s", faf_id, resp.json())
-    jsondata = resp.json()
-    if 'data' in jsondata and len(jsondata['data']) > 0 and 'id' in jsondata['data'][0]:
-        game_id = jsondata['data'][0]['id']
-        with open(f"/tmp/game_{game_id}.json", 'w') as fh:
-            fh.write(resp.content.decode())
-            fh.write('\n')
+        logging.warning("Received %s on game for %s: %s", resp.status_code, faf_id, resp.text)
+        return None
+    try:
+        jsondata = resp.json()
+    except ValueError:
+        logging.warning("Could not decode game for %s: %s", faf_id, resp.text)
+        return None
+    faf_archive_game_data(jsondata, resp.content.decode())
     return faf_data_to_game_data(jsondata)
+
+
+async def faf_store_games(games):
+    """
+    Save the games in the game cache.  The cache is only an optimisation, so
+    if that fails we log it and carry on.
+    """
+    try:
+        await db_store_games_async(games)
+    except Exception as e:
+        logging.error("Could not cache %d games: %r", len(games), e)
+
+
+async def faf_fetch_last_game_for_faf_id_async(faf_id):
+    """
+    Fetch the last game data for a given player's FAF ID - from the game
+    cache in the database if they're in a running game fetched in the last
+    'last_game_ttl' seconds, or else from the API.
+    """
+    game = await db_get_active_game_for_player_async(
+        int(faf_id), time.time() - session_config['last_game_ttl']
+    )
+    if game is None:
+        status, body = await faf_api_get_async(faf_last_game_path(faf_id))
+        if status != 200:
+            logging.warning("Received %s on game for %s: %s", status, faf_id, body)
+            return None
+        jsondata = faf_decode(body, f"game for {faf_id}")
+        if jsondata is None:
+            return None
+        faf_archive_game_data(jsondata, body)
+        game = faf_data_to_game_data(jsondata)
+        if game:
+            await faf_store_games([game])
+    if game and not game.end_time:
+        # Keep our own copy, as callers resolve the players in theirs.
+        cached_game = game.copy()
+        for player_id in game.players:
+            last_game_cache.set(player_id, cached_game)
+    return game
+
+
+async def faf_get_last_game_for_faf_id_async(faf_id):
+    """
+    Get the last game data for a given player's FAF ID, without blocking the
+    event loop.  If a lookup for this player is already in progress we wait
+    for its answer, and if another player in the same running game has just
+    looked it up we use that, rather than asking FAF again.
+
+    See the faf_data_to_game_data() function for the return value.
+    """
+    found, game = last_game_cache.lookup(int(faf_id))
+    if found:
+        return game.copy()
+    # The lookup is shared, so isn't cut short by the first caller's deadline.
+    with deadline_lib.no_deadline():
+        leader, game = await last_game_flights.run(
+            int(faf_id), faf_fetch_last_game_for_faf_id_async, faf_id
+        )
+    # The caller may resolve the players, so everyone gets their own copy.
+    return game if (leader or game is None) else game.copy()
+
+
+def faf_game_path(game_id):
+    """
+    The API path to get a game by its ID.
+    """
+    return f"game?filter=id=={int(game_id)}&" + faf_game_query()
+
+
+async def faf_get_game_async(game_id):
+    """
+    Get a game by its ID.  Games that have ended never change, so once we
+    have one it comes from the game cache in the database; running games
+    are fetched again if we've had them for more than 'last_game_ttl'
+    seconds.  If FAF can't be asked we make do with the one we have.
+    Returns None if FAF doesn't know the game.
+    """
+    game, fetched_at = await db_get_game_async(int(game_id))
+    if game is not None and (
+        game.end_time or fetched_at >= time.time() - session_config['last_game_ttl']
+    ):
+        return game
+    status, body = await faf_api_get_async(faf_game_path(game_id))
+    if status != 200:
+        logging.warning("Received %s on game %s: %s", status, game_id, body)
+        return game
+    jsondata = faf_decode(body, f"game {game_id}")
+    if jsondata is None:
+        return game
+    faf_archive_game_data(jsondata, body)
+    game = faf_data_to_game_data(jsondata)
+    if game:
+        await faf_store_games([game])
+    return game
+
+
+def faf_last_games_path(faf_ids, page_size, page):
+    """
+    The API path to get a page of the most recent games any of these players
+    were in, newest first.
+    """
+    ids = ','.join(str(faf_id) for faf_id in sorted(faf_ids))
+    rsql = f"playerStats.player.id=in=({ids})"
+    return (
+        f"game?filter={rsql}&sort=-id&page[size]={page_size}&page[number]={page}&" +
+        faf_game_query()
+    )
+
+
+async def faf_get_last_games_for_faf_ids_async(faf_ids, max_pages=3):
+    """
+    Get the last game of each of a set of players, asking FAF for all of them
+    at once rather than one request per player.
+
+    Returns a dict of FAF ID to their Game.  Players whose last game isn't
+    found in the first max_pages pages are left out.  Players in the same
+    game share the one Game.  Large sets of players are split into chunks
+    that are requested concurrently, to keep the URLs a sane length.
+    """
+    wanted = sorted({int(faf_id) for faf_id in faf_ids})
+    chunks = [
+        wanted[start:start + BATCH_CHUNK_SIZE]
+        for start in range(0, len(wanted), BATCH_CHUNK_SIZE)
+    ]
+    game_of_player = dict()
+    for chunk_games in await asyncio.gather(*[
+        faf_get_last_games_for_chunk_async(chunk, max_pages)
+        for chunk in chunks
+    ]):
+        game_of_player.update(chunk_games)
+    return game_of_player
+
+
+async def faf_get_last_games_for_chunk_async(faf_ids, max_pages):
+    """
+    Page through the games of one chunk of players, newest first, until
+    we've seen a game for each of them.  The first game we see a player in
+    is their last one.
+    """
+    missing = set(faf_ids)
+    game_of_player = dict()
+    # Most players will be in the same few games, but if they aren't we'll
+    # need at least one game per player.
+    page_size = min(max(len(faf_ids), 10), 100)
+    for page in range(1, max_pages + 1):
+        status, body = await faf_api_get_async(
+            faf_last_games_path(faf_ids, page_size, page)
+        )
+        if status != 200:
+            logging.warning("Received %s on games for %d players: %s", status, len(faf_ids), body)
+            break
+        jsondata = faf_decode(body, f"games for {len(faf_ids)} players")
+        if jsondata is None:
+            break
+        faf_archive_game_data(jsondata, body)
+        games = faf_data_to_games(jsondata)
+        if games:
+            await faf_store_games(games)
+        for game in games:
+            if not game.end_time:
+                cached_game = game.copy()
+            for player_id in game.players:
+                if player_id in missing:
+                    missing.discard(player_id)
+                    game_of_player[player_id] = game
+                    if not game.end_time:
+                        last_game_cache.set(player_id, cached_game)
+        if not missing or len(jsondata.get('data', [])) < page_size:
+            break
+    logging.info(
+        "Found last games for %d of %d players in %d pages",
+        len(game_of_player), len(faf_ids), page
+    )
+    return game_of_player
@@ -0,0 +1,64 @@
+from dataclasses import dataclass, field
+from typing import Optional
+
+
+@dataclass(slots=True)
+class GamePlayer:
+    """
+    A player in a game.  The team is the FAF team number less one, so 0 is
+    'no team' (FFA); discord_id is filled in when we resolve who they are.
+    """
+    faf_id: int
+    name: Optional[str] = None
+    team: Optional[int] = None
+    discord_id: Optional[int] = None
+
+
+@dataclass(slots=True)
+class Game:
+    """
+    The parts of a FAF game that we use.  Players are indexed by FAF ID, and
+    also grouped by team number (from 1) in team_players, which is worked out
+    when the game is made.  Players with no team aren't in any group.
+    """
+    id: int
+    name: str
+    start_time: Optional[str]
+    end_time: Optional[str]
+    host_faf_id: int
+    host_faf_name: str
+    players: dict = field(default_factory=dict)  # faf_id: GamePlayer
+    teams: int = 0
+    team_players: dict = field(default_factory=dict)  # team: [GamePlayer]
+
+    def __post_init__(self):
+        if not self.team_players:
+            for player in self.players.values():
+                if player.team:
+                    self.team_players.setdefault(player.team, []).append(player)
+        if not self.teams and self.team_players:
+            self.teams = max(self.team_players)
+
+    def copy(self):
+        """
+        Return a copy with its own players, so that resolving the players of
+        one copy doesn't change any other.
+        """
+        return Game(
+            self.id, self.name, self.start_time, self.end_time,
+            self.host_faf_id, self.host_faf_name,
+            players={
+                faf_id: GamePlayer(player.faf_id, player.name, player.team, player.discord_id)
+                for faf_id, player in self.players.items()
+            },
+            teams=self.teams,
+        )
+
+    def unresolved_players(self):
+        """
+        The players we don't have a Discord ID for.
+        """
+        return [
+            player for player in self.players.values()
+            if player.discord_id is None
+        ]
@@ -0,0 +1,192 @@
+import atexit
+from collections.abc import Mapping
+from contextlib import contextmanager
+import contextvars
+import copy
+from datetime import datetime, timezone
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import reprlib
+
+# Logging that keeps its work off the event loop.  Records are put on a
+# queue as they are - no formatting - and a listener thread formats and
+# writes them, so a log call on the loop costs little more than the check
+# of its level.  Each record carries the fields of the context it was
+# logged in - the guild, game and command being worked on - and is written
+# as a line of JSON, or as text with the fields appended.  Long arguments
+# and messages are cut down to max_length, and only debug_sample of the
+# DEBUG records are kept.
+#
+# As the arguments are formatted later, in the listener thread, don't log
+# objects you're about to change if the log needs to show them as they were.
+
+log_config = {
+    'level': 'INFO',
+    'format': 'json',  # or 'text'
+    'file': None,  # stderr if not set
+    'max_length': 2000,
+    'debug_sample': 1.0,
+}
+
+log_fields = contextvars.ContextVar('log_fields', default=None)
+_listener = None
+
+
+def set_log_fields(**fields):
+    """
+    Add these fields to the records logged from now on in this task (and
+    the tasks it starts).
+    """
+    log_fields.set({**(log_fields.get() or {}), **fields})
+
+
+@contextmanager
+def log_context(**fields):
+    """
+    Add these fields to the records logged in the body of a with statement.
+    """
+    token = log_fields.set({**(log_fields.get() or {}), **fields})
+    try:
+        yield
+    finally:
+        log_fields.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """
+    Attach the context's fields to each record, and drop all but a sample
+    of the DEBUG records.  This runs where the record is logged.
+    """
+    def filter(self, record):
+        if record.levelno <= logging.DEBUG and random.random() >= log_config['debug_sample']:
+            return False
+        record.fields = log_fields.get() or {}
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue records without formatting them, unlike QueueHandler.
+    """
+    def prepare(self, record):
+        return copy.copy(record)
+
+
+def shorten(value, max_length):
+    """
+    Cut a log argument down to size: strings to max_length, containers to a
+    bounded repr.  Numbers are left alone so %d and the like still work.
+    """
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    if isinstance(value, (dict, list, tuple, set)):
+        short = reprlib.Repr()
+        short.maxstring = short.maxother = max_length // 10
+        short.maxdict = short.maxlist = short.maxtuple = short.maxset = 20
+        short.maxlevel = 4
+        text = short.repr(value)
+    else:
+        text = str(value)
+    return truncate(text, max_length)
+
+
+def truncate(text, max_length):
+    if len(text) <= max_length:
+        return text
+    return f"{text[:max_length]}...({len(text) - max_length} more chars)"
+
+
+def record_message(record):
+    """
+    The record's message, formatted from shortened arguments and truncated.
+    """
+    max_length = log_config['max_length']
+    message = str(record.msg)
+    args = record.args
+    if args:
+        if isinstance(args, Mapping) and '%(' in message:
+            args = {key: shorten(value, max_length) for key, value in args.items()}
+        elif isinstance(args, Mapping):
+            # A single dict argument
+            args = (shorten(args, max_length),)
+        else:
+            args = tuple(shorten(arg, max_length) for arg in args)
+        try:
+            message = message % args
+        except (TypeError, ValueError) as e:
+            message = f"{message} % {args!r} ({e})"
+    return truncate(message, max_length)
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record_message(record),
+            **getattr(record, 'fields', {}),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+
+    def formatMessage(self, record):
+        text = super().formatMessage(record)
+        fields = getattr(record, 'fields', {})
+        if fields:
+            text += ' [' + ' '.join(f"{key}={value}" for key, value in fields.items()) + ']'
+        return text
+
+    def format(self, record):
+        record.message = record_message(record)
+        if self.usesTime():
+            record.asctime = self.formatTime(record, self.datefmt)
+        text = self.formatMessage(record)
+        if record.exc_info:
+            text += '\n' + self.formatException(record.exc_info)
+        return text
+
+
+def log_init(full_config):
+    """
+    Send all logging through the queue to the listener thread, configured
+    from the 'logging' section of the config.
+    """
+    global _listener
+    log_config.update(full_config.get('logging') or {})
+    if log_config['file']:
+        handler = logging.handlers.WatchedFileHandler(log_config['file'], encoding='utf-8')
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(JSONFormatter() if log_config['format'] == 'json' else TextFormatter())
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+    root = logging.getLogger()
+    for old_handler in list(root.handlers):
+        root.removeHandler(old_handler)
+    root.addHandler(queue_handler)
+    root.setLevel(log_config['level'])
+    log_close()
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(log_close)
+
+
+def log_close():
+    """
+    Write out the records still queued and stop the listener thread.
+    """
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,220 @@
+from collections import deque
+from contextlib import contextmanager
+import logging
+import threading
+import time
+
+from aiohttp import web
+
+# Simple in-process metrics.  Counters are just running totals; timings keep
+# the count and total of every observation, how many fell in each histogram
+# bucket, and a window of the most recent ones, so we can look at the
+# distribution without keeping everything.  Either can have labels, e.g.
+# incr('faf_api_responses', status=200), each set of labels being counted
+# separately.  They can be served in Prometheus's text format by
+# start_server().  They're updated from the database writer and other worker
+# threads as well as the event loop, so all access is under _lock, and
+# readers work on a copy.
+
+TIMING_WINDOW = 1000
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+PREFIX = 'brackman_'
+
+counters = dict()  # (name, labels): total
+timings = dict()  # (name, labels): timing dict
+_lock = threading.Lock()
+_runner = None
+
+
+def metric_key(name, labels):
+    """
+    The key of a metric with these labels: its name and the labels as a
+    sorted tuple of (label, value) strings.
+    """
+    return name, tuple(sorted((label, str(value)) for label, value in labels.items()))
+
+
+def incr(name, amount=1, **labels):
+    """
+    Add to the named counter, creating it if necessary.
+    """
+    key = metric_key(name, labels)
+    with _lock:
+        counters[key] = counters.get(key, 0) + amount
+
+
+def counter_items():
+    """
+    Return a copy of the counters, as a list of ((name, labels), total).
+    """
+    with _lock:
+        return list(counters.items())
+
+
+def timing_items():
+    """
+    Return a copy of the timings, as a list of ((name, labels), timing).
+    """
+    with _lock:
+        return [
+            (key, dict(timing, buckets=list(timing['buckets']), recent=list(timing['recent'])))
+            for key, timing in timings.items()
+        ]
+
+
+def counter_total(name, **labels):
+    """
+    Return the sum of the named counter over every set of labels that
+    includes these.
+    """
+    wanted = set(metric_key(name, labels)[1])
+    return sum(
+        value for (counter_name, counter_labels), value in counter_items()
+        if counter_name == name and wanted <= set(counter_labels)
+    )
+
+
+def observe(name, seconds, **labels):
+    """
+    Record a duration, in seconds, against the named timing.
+    """
+    key = metric_key(name, labels)
+    with _lock:
+        if key not in timings:
+            timings[key] = {
+                'count': 0, 'total': 0.0, 'buckets': [0] * len(BUCKETS),
+                'recent': deque(maxlen=TIMING_WINDOW)
+            }
+        timing = timings[key]
+        timing['count'] += 1
+        timing['total'] += seconds
+        for pos, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                timing['buckets'][pos] += 1
+                break
+        timing['recent'].append(seconds)
+
+
+@contextmanager
+def timed(name, **labels):
+    """
+    Time the body of a with statement and record it against the named timing.
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def percentile(ordered, fraction):
+    """
+    The value at this fraction of the way through an ordered list, by the
+    nearest rank.
+    """
+    return ordered[min(len(ordered) - 1, max(0, round(fraction * len(ordered)) - 1))]
+
+
+def summarise(timing):
+    recent = sorted(timing['recent'])
+    return {
+        'count': timing['count'],
+        'mean': timing['total'] / timing['count'],
+        'last': timing['recent'][-1],
+        'p50': percentile(recent, 0.5),
+        'p99': percentile(recent, 0.99),
+    }
+
+
+def timing_summary(name, **labels):
+    """
+    Return a dict with the count, mean and most recent observation of the
+    named timing, and the median and 99th percentile of the recent ones, or
+    None if nothing has been recorded.
+    """
+    key = metric_key(name, labels)
+    with _lock:
+        timing = timings.get(key)
+        if timing is None:
+            return None
+        timing = dict(timing, recent=list(timing['recent']))
+    return summarise(timing)
+
+
+def timing_summaries(name):
+    """
+    Return a list of (labels, summary) for each set of labels the named
+    timing has been recorded with, sorted by the labels.
+    """
+    return [
+        (dict(labels), summarise(timing))
+        for (timing_name, labels), timing in sorted(timing_items(), key=lambda item: item[0])
+        if timing_name == name
+    ]
+
+
+def format_labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(
+            label, value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        )
+        for label, value in labels
+    ) + '}'
+
+
+def render():
+    """
+    Return all the metrics in Prometheus's text exposition format: counters
+    as <name>_total, timings as histograms.
+    """
+    lines = []
+    last_name = None
+    for (name, labels), value in sorted(counter_items()):
+        if name != last_name:
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            last_name = name
+        lines.append(f"{PREFIX}{name}_total{format_labels(labels)} {value}")
+    last_name = None
+    for (name, labels), timing in sorted(timing_items(), key=lambda item: item[0]):
+        if name != last_name:
+            lines.append(f"# TYPE {PREFIX}{name} histogram")
+            last_name = name
+        cumulative = 0
+        for bound, count in zip(BUCKETS, timing['buckets']):
+            cumulative += count
+            lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, [('le', str(bound))])} {cumulative}")
+        lines.append(f"{PREFIX}{name}_bucket{format_labels(labels, [('le', '+Inf')])} {timing['count']}")
+        lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {timing['total']}")
+        lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {timing['count']}")
+    return '\n'.join(lines) + '\n'
+
+
+async def metrics_handler(request):
+    return web.Response(text=render(), content_type='text/plain', charset='utf-8')
+
+
+async def start_server(host='127.0.0.1', port=9108):
+    """
+    Serve the metrics at /metrics on this address.  Must be called from
+    within the running event loop.
+    """
+    global _runner
+    if _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    _runner = web.AppRunner(app, access_log=None)
+    await _runner.setup()
+    await web.TCPSite(_runner, host, port).start()
+    logging.info("Serving metrics on http://%s:%s/metrics", host, port)
+
+
+async def stop_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
@@ -0,0 +1,230 @@
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+
+import metrics_lib
+
+# Don't hand out a token that has less than this many seconds left on it.
+TOKEN_LEEWAY = 30
+
+
+class TokenManager:
+    """
+    Look after the OAuth2 client credentials token for the FAF API.
+
+    The token is fetched once and then refreshed in the background some time
+    before it expires, so no user's command has to wait for the token
+    endpoint.  It's also saved, with its expiry time, to a cache file so a
+    restarted bot - or another process using the same file - can pick it up
+    rather than fetching a new one.  A lock file stops two processes from
+    refreshing at the same time.  The cache file records which client and
+    token endpoint the token is for, and a token cached for any other is
+    ignored.
+
+    Async callers that need a refresh all share the one in-flight request.
+    """
+    def __init__(self, client, cache_file=None, refresh_margin=300,
+                 client_id=None, token_url=None):
+        self.client = client
+        self.cache_file = cache_file
+        self.client_id = client_id
+        self.token_url = token_url
+        self.refresh_margin = refresh_margin
+        self.access_token = None
+        self.expires_at = 0.0  # seconds since the epoch
+        self.rejected = None  # the last token the API refused
+        self._lock = threading.Lock()
+        self._refreshing = None  # future of the in-flight refresh
+        self._task = None  # the background refresh task
+
+    def valid_for(self, seconds):
+        """
+        Is the token we hold going to be valid for at least this long?
+        """
+        return self.access_token is not None and time.time() + seconds < self.expires_at
+
+    def invalidate(self, token):
+        """
+        Stop using this token - the API has refused it - so the next caller
+        gets a new one.  Does nothing if we've already moved on from it.
+        """
+        self.rejected = token
+        if self.access_token == token:
+            logging.warning("FAF API refused our token - getting a new one")
+            self.access_token = None
+            self.expires_at = 0.0
+
+    def load_cache(self):
+        """
+        Read the token from the cache file, if there is one, it's for our
+        client and token endpoint, it's newer than the one we have and it
+        isn't one the API has refused.
+        """
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file, 'r') as fh:
+                cached = json.load(fh)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning("Could not read token cache %s: %s", self.cache_file, e)
+            return
+        if (cached.get('client_id') != self.client_id
+                or cached.get('token_url') != self.token_url):
+            logging.info("Ignoring token cache %s - it's for another client", self.cache_file)
+            return
+        if cached.get('access_token') == self.rejected:
+            return
+        if cached.get('expires_at', 0) > self.expires_at:
+            self.access_token = cached['access_token']
+            self.expires_at = cached['expires_at']
+
+    def save_cache(self):
+        """
+        Write the token to the cache file, atomically so that another process
+        never reads half of it.
+        """
+        if not self.cache_file:
+            return
+        tmp_file = f"{self.cache_file}.{os.getpid()}.tmp"
+        try:
+            fd = os.open(tmp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'w') as fh:
+                json.dump({
+                    'client_id': self.client_id,
+                    'token_url': self.token_url,
+                    'access_token': self.access_token,
+                    'expires_at': self.expires_at,
+                }, fh)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logging.warning("Could not write token cache %s: %s", self.cache_file, e)
+
+    def _fetch(self):
+        """
+        Get a new token from the token endpoint and record how long it took.
+        """
+        start = time.monotonic()
+        try:
+            token = self.client.client_credentials()
+        except Exception:
+            metrics_lib.incr('faf_token_refresh_errors')
+            raise
+        elapsed = time.monotonic() - start
+        metrics_lib.observe('faf_token_refresh_seconds', elapsed)
+        logging.info("Refreshed FAF API token in %.3f seconds", elapsed)
+        self.access_token = token.access_token
+        if token.expires_at:
+            self.expires_at = token.expires_at.timestamp()
+        else:
+            # No expiry given - assume an hour, and refresh before then.
+            self.expires_at = time.time() + 3600
+
+    def refresh_blocking(self):
+        """
+        Make sure we have a token that won't expire within the refresh
+        margin, fetching a new one if neither we nor the cache file have one.
+        Returns the access token.
+        """
+        with self._lock:
+            if self.valid_for(self.refresh_margin):
+                return self.access_token
+            lock_fh = None
+            if self.cache_file:
+                lock_fh = open(f"{self.cache_file}.lock", 'w')
+                fcntl.flock(lock_fh, fcntl.LOCK_EX)
+            try:
+                # Another process may have refreshed it while we waited.
+                self.load_cache()
+                if not self.valid_for(self.refresh_margin):
+                    self._fetch()
+                    self.save_cache()
+            finally:
+                if lock_fh:
+                    fcntl.flock(lock_fh, fcntl.LOCK_UN)
+                    lock_fh.close()
+            return self.access_token
+
+    def get_token_blocking(self):
+        """
+        Get a usable access token, for code outside the event loop.
+        """
+        if self.valid_for(TOKEN_LEEWAY):
+            return self.access_token
+        return self.refresh_blocking()
+
+    async def refresh(self):
+        """
+        Refresh the token in a worker thread.  If a refresh is already in
+        progress, wait for that one instead of starting another.
+        """
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(
+                asyncio.to_thread(self.refresh_blocking)
+            )
+            self._refreshing.add_done_callback(self._refresh_done)
+        return await asyncio.shield(self._refreshing)
+
+    def _refresh_done(self, future):
+        self._refreshing = None
+
+    async def get_token(self):
+        """
+        Get a usable access token without blocking the event loop.
+        """
+        if self.valid_for(TOKEN_LEEWAY):
+            return self.access_token
+        return await self.refresh()
+
+    async def _refresh_loop(self):
+        while True:
+            if self.access_token is not None:
+                # Don't spin if the token's lifetime is shorter than the margin.
+                await asyncio.sleep(max(
+                    self.expires_at - self.refresh_margin - time.time(), 10
+                ))
+            try:
+                await self.refresh()
+            except Exception as e:
+                logging.error("Could not refresh FAF API token: %s", e)
+                await asyncio.sleep(30)
+
+    def start(self):
+        """
+        Start refreshing the token in the background.  Must be called from
+        within the running event loop.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        """
+        Stop the background refresh.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class TokenManagerAuth(requests.auth.AuthBase):
+    """
+    A requests auth handler that takes its bearer token from a TokenManager,
+    so the blocking calls share the token with the async ones.
+    """
+    def __init__(self, token_manager):
+        self.token_manager = token_manager
+
+    def __call__(self, request):
+        request.headers['Authorization'] = f"Bearer {self.token_manager.get_token_blocking()}"
+        return request
@@ -0,0 +1,159 @@
+from collections import OrderedDict
+import logging
+import time
+
+from cache_lib import SingleFlight
+from db_lib import db_get_guild_users_async, db_set_users_async
+from deadline_lib import no_deadline
+import metrics_lib
+
+
+class GuildRoster:
+    """
+    Who's who in one guild: the players table's rows for the guild, indexed
+    both ways between FAF ID and Discord ID and by FAF login, casefolded.
+    Members are looked up by display name in the channels they're in when
+    they're needed - without the members intent we aren't told when they
+    change their names.
+
+    If two Discord users in a guild claim the same FAF ID, the one written
+    last wins, as it did when resolving from the database.
+    """
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.discord_of_faf = dict()  # faf_id: discord_id
+        self.player_of_discord = dict()  # discord_id: (faf_id, faf_username)
+        self.faf_of_login = dict()  # casefolded faf_username: faf_id
+        self.last_used = time.monotonic()
+
+    def set_player(self, faf_id, faf_username, discord_id):
+        old = self.player_of_discord.get(discord_id)
+        if old is not None:
+            old_faf_id, old_faf_username = old
+            if self.discord_of_faf.get(old_faf_id) == discord_id:
+                del self.discord_of_faf[old_faf_id]
+            if old_faf_username and self.faf_of_login.get(old_faf_username.casefold()) == old_faf_id:
+                del self.faf_of_login[old_faf_username.casefold()]
+        self.player_of_discord[discord_id] = (faf_id, faf_username)
+        self.discord_of_faf[faf_id] = discord_id
+        if faf_username:
+            self.faf_of_login[faf_username.casefold()] = faf_id
+
+    def faf_username_of(self, name):
+        """
+        Return the FAF username of the player with this FAF login, or None if
+        we don't know them.
+        """
+        faf_id = self.faf_of_login.get(name.casefold())
+        player = self.player_of_discord.get(self.discord_of_faf.get(faf_id))
+        return player[1] if player else None
+
+    def faf_ids_of_discord_ids(self, discord_ids):
+        """
+        Return a dict of discord_id: faf_id for the ones we know.
+        """
+        return {
+            discord_id: self.player_of_discord[discord_id][0]
+            for discord_id in discord_ids
+            if discord_id in self.player_of_discord
+        }
+
+    def __len__(self):
+        return len(self.player_of_discord)
+
+
+class RosterIndex:
+    """
+    The rosters of the guilds the bot has been used in, loaded from the
+    database the first time each is needed and kept up to date from then on:
+    writes go through set_users(), which saves them and then updates the
+    roster.
+
+    Rosters that haven't been used for idle_ttl seconds are dropped, as are
+    the least recently used ones beyond max_guilds; they're loaded again if
+    they're needed.
+    """
+    def __init__(self, max_guilds=100, idle_ttl=3600):
+        self.max_guilds = max_guilds
+        self.idle_ttl = idle_ttl
+        self._rosters = OrderedDict()  # guild_id: GuildRoster
+        self._loads = SingleFlight()
+        self._pending = dict()  # guild_id: [users written while loading]
+
+    def configure(self, max_guilds=None, idle_ttl=None):
+        if max_guilds is not None:
+            self.max_guilds = max_guilds
+        if idle_ttl is not None:
+            self.idle_ttl = idle_ttl
+        self._evict()
+
+    def __len__(self):
+        return len(self._rosters)
+
+    async def get(self, guild):
+        """
+        Return the roster for this guild, loading it if necessary.
+        """
+        roster = self._rosters.get(guild.id)
+        if roster is None:
+            metrics_lib.incr('roster_misses')
+            # The load is shared, so isn't cut short by the first caller's
+            # deadline.
+            with no_deadline():
+                _, roster = await self._loads.run(guild.id, self._load, guild)
+        else:
+            metrics_lib.incr('roster_hits')
+        roster.last_used = time.monotonic()
+        self._rosters[guild.id] = roster
+        self._rosters.move_to_end(guild.id)
+        self._evict()
+        return roster
+
+    async def _load(self, guild):
+        roster = GuildRoster(guild.id)
+        pending = self._pending[guild.id] = []
+        try:
+            for faf_id, faf_username, discord_id in await db_get_guild_users_async(guild.id):
+                roster.set_player(faf_id, faf_username, discord_id)
+        finally:
+            del self._pending[guild.id]
+        # Users saved while we were reading may or may not be in what we
+        # read, so apply them again on top.
+        for faf_id, faf_username, discord_id in pending:
+            roster.set_player(faf_id, faf_username, discord_id)
+        logging.info("Loaded roster of %d players for guild %s", len(roster), guild.id)
+        self._rosters[guild.id] = roster
+        return roster
+
+    async def set_users(self, users):
+        """
+        Save the users - (faf_id, faf_username, guild_id, discord_id,
+        discord_username) tuples, as for db_set_users() - and then update the
+        rosters of their guilds.  Returns the rows.
+        """
+        users = list(users)
+        rows = await db_set_users_async(users)
+        for faf_id, faf_username, guild_id, discord_id, _ in users:
+            roster = self._rosters.get(guild_id)
+            if roster is not None:
+                roster.set_player(faf_id, faf_username, discord_id)
+            elif guild_id in self._pending:
+                self._pending[guild_id].append((faf_id, faf_username, discord_id))
+        return rows
+
+    async def set_user(self, faf_id, faf_username, guild_id, discord_id, discord_username):
+        return (await self.set_users([
+            (faf_id, faf_username, guild_id, discord_id, discord_username)
+        ]))[0]
+
+    def _evict(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._rosters:
+            guild_id, roster = next(iter(self._rosters.items()))
+            if len(self._rosters) <= self.max_guilds and roster.last_used >= cutoff:
+                break
+            del self._rosters[guild_id]
+            logging.info("Dropped roster for guild %s", guild_id)
+
+
+rosters = RosterIndex()
@@ -0,0 +1,247 @@
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+import logging
+import time
+from typing import Optional
+
+import metrics_lib
+
+# The states of a sort job, in the order they go through them.  A job is
+# queued until it starts, which waits for any earlier sort of the same game
+# in the guild to finish.
+JOB_STATES = ('queued', 'resolving', 'creating', 'moving', 'done', 'failed')
+FINISHED_STATES = ('done', 'failed')
+
+# What each state looks like to someone asking how the sort is going
+STATE_DESCRIPTIONS = {
+    'queued': "just about to start",
+    'resolving': "working out who's who",
+    'creating': "making the team channels",
+    'moving': "moving everyone into them",
+    'done': "all done",
+    'failed': "it didn't work out",
+}
+
+
+@dataclass(slots=True)
+class SortJob:
+    """
+    One sort of a game in a guild, and how far it's got: its state, and how
+    many of the steps of that state - channels made, players moved - are
+    done.
+    """
+    guild_id: int
+    game_id: int
+    issuer: str
+    name: Optional[str] = None
+    state: str = 'queued'
+    total: int = 0  # steps in this state
+    steps: int = 0  # of them done
+    error: Optional[str] = None
+    started_at: float = field(default_factory=time.monotonic)
+    updated_at: float = field(default_factory=time.monotonic)
+    task: Optional[asyncio.Future] = None
+    players: list = field(default_factory=list)  # FAF IDs in the game
+
+    @property
+    def key(self):
+        return self.guild_id, self.game_id
+
+    @property
+    def active(self):
+        return self.state not in FINISHED_STATES
+
+    def advance(self, state, total=0):
+        """
+        Move on to the next state, which has total steps to do.
+        """
+        logging.debug("Sort of game %s: %s -> %s", self.game_id, self.state, state)
+        self.state = state
+        self.total = total
+        self.steps = 0
+        self.updated_at = time.monotonic()
+
+    def step(self, *_):
+        """
+        Count one step of this state done.  Takes and ignores any arguments,
+        so it can be a task's done callback.
+        """
+        self.steps += 1
+        self.updated_at = time.monotonic()
+
+    def progress(self):
+        """
+        How the sort is going, in words.
+        """
+        description = STATE_DESCRIPTIONS[self.state]
+        if self.active and self.total:
+            description += f" ({self.steps} of {self.total})"
+        return description
+
+    async def wait(self):
+        """
+        Wait for the sort to finish and return its result, or raise its
+        exception.  Whoever's waiting can be cancelled without stopping it.
+        """
+        return await asyncio.shield(self.task)
+
+
+class SortJobRegistry:
+    """
+    The sorts going on in each guild, one job per game.  Starting a sort of
+    a game that's already being sorted in the guild returns the job that's
+    running, so the caller can say how it's going and wait for it.  Each
+    game in each guild has its own lock, held while its job runs, so guilds
+    - and games - never wait on each other's sorts.
+
+    Finished jobs are kept for ttl seconds so their outcome - and the game
+    their players were in - can be asked about.  A job that hasn't moved on
+    for abandon_after seconds is taken to be stuck: it's cancelled, which
+    releases its lock, and marked failed.
+    """
+    def __init__(self, ttl=600, abandon_after=300):
+        self.ttl = ttl
+        self.abandon_after = abandon_after
+        self.jobs = dict()  # (guild_id, game_id): SortJob
+        self._locks = dict()  # (guild_id, game_id): [lock, number of holders and waiters]
+        self._job_of_player = dict()  # (guild_id, faf_id): SortJob
+
+    def configure(self, ttl=None, abandon_after=None):
+        if ttl is not None:
+            self.ttl = ttl
+        if abandon_after is not None:
+            self.abandon_after = abandon_after
+
+    def __len__(self):
+        return len(self.jobs)
+
+    @asynccontextmanager
+    async def lock(self, key):
+        """
+        Hold the lock for this key, which only exists while someone holds
+        or is waiting for it.
+        """
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    def active(self, guild_id, game_id):
+        """
+        Return the job sorting this game in this guild, or None if it isn't
+        being sorted.
+        """
+        self.expire()
+        job = self.jobs.get((guild_id, game_id))
+        return job if job is not None and job.active else None
+
+    def game_of_player(self, guild_id, faf_id):
+        """
+        Return the ID of the game being sorted in this guild that this player
+        is in, or None.  Stuck jobs are given up on first, as start() would.
+        """
+        self.expire()
+        job = self._job_of_player.get((guild_id, faf_id))
+        return job.game_id if job is not None and job.active else None
+
+    def recent_game_of_player(self, guild_id, faf_id):
+        """
+        Return the ID of the game this player was in that was last sorted in
+        this guild, if that was within ttl seconds, or None.
+        """
+        self.expire()
+        job = self._job_of_player.get((guild_id, faf_id))
+        return job.game_id if job is not None else None
+
+    def status(self, guild_id):
+        """
+        Return the guild's jobs - running and recently finished - oldest
+        first.
+        """
+        self.expire()
+        return sorted(
+            (job for job in self.jobs.values() if job.guild_id == guild_id),
+            key=lambda job: job.started_at
+        )
+
+    def start(self, guild_id, game_id, issuer, func, *args):
+        """
+        Start func(job, *args) as the job sorting this game in this guild,
+        unless it's already being sorted.  There must be no await between
+        checking what's being sorted and calling this.  Returns a tuple of
+        the job and whether this call started it.
+        """
+        job = self.active(guild_id, game_id)
+        if job is not None:
+            return job, False
+        job = SortJob(guild_id, game_id, issuer)
+        self.jobs[job.key] = job
+        job.task = asyncio.ensure_future(self._run(job, func, args))
+        return job, True
+
+    def track_players(self, job, name, faf_ids):
+        """
+        Record the game's name and players once the job knows them, so other
+        players' sorts can find the game without asking FAF.
+        """
+        job.name = name
+        job.players = list(faf_ids)
+        for faf_id in job.players:
+            self._job_of_player[(job.guild_id, faf_id)] = job
+
+    async def _run(self, job, func, args):
+        result = None
+        try:
+            async with self.lock(job.key):
+                if job.active:  # it could have been abandoned while queued
+                    result = await func(job, *args)
+        except asyncio.CancelledError:
+            if job.error == 'abandoned':
+                # Those waiting for it just get no result
+                return None
+            self._finish(job, 'failed', 'cancelled')
+            raise
+        except Exception as e:
+            self._finish(job, 'failed', repr(e))
+            raise
+        self._finish(job, 'done' if result else 'failed')
+        return result
+
+    def _finish(self, job, state, error=None):
+        if not job.active:
+            return
+        job.advance(state)
+        job.error = error
+        metrics_lib.incr('sort_jobs', state=state)
+        metrics_lib.observe('sort_job_seconds', job.updated_at - job.started_at, state=state)
+
+    def expire(self):
+        """
+        Give up on stuck jobs and forget ones that finished over ttl seconds
+        ago.
+        """
+        now = time.monotonic()
+        for key, job in list(self.jobs.items()):
+            if job.active and now - job.updated_at > self.abandon_after:
+                logging.warning(
+                    "Sort of game %s in guild %s stuck %s for %.0fs - giving up on it",
+                    job.game_id, job.guild_id, job.state, now - job.updated_at
+                )
+                self._finish(job, 'failed', 'abandoned')
+                job.task.cancel()
+            elif not job.active and now - job.updated_at > self.ttl:
+                del self.jobs[key]
+                for faf_id in job.players:
+                    if self._job_of_player.get((job.guild_id, faf_id)) is job:
+                        del self._job_of_player[(job.guild_id, faf_id)]
+
+
+sort_jobs = SortJobRegistry()
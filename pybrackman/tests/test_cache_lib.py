@@ -0,0 +1,16 @@
+from cache_lib import TTLCache
+
+
+def test_expired_values_are_used_stale():
+    cache = TTLCache('test', ttl=-1, stale_ttl=60)
+    cache.set('found', 1)
+    assert cache.lookup_stale('found') == (True, 1, True)
+    assert cache.stale('found') == (True, 1)
+
+
+def test_expired_not_found_is_not_used_stale():
+    cache = TTLCache('test', negative_ttl=-1, stale_ttl=60)
+    cache.set('missing', None)
+    assert cache.stale('missing') == (False, None)
+    assert cache.lookup_stale('missing') == (False, None, False)
+    assert len(cache) == 0
@@ -0,0 +1,42 @@
+import sqlite3
+
+import db_lib
+
+
+def test_queries_use_indexes():
+    assert db_lib.db_check_query_plans() == []
+
+
+def test_full_table_queries_scan():
+    plans = {' '.join(sql.split()): plan for sql, plan in db_lib.db_query_plans()}
+    for sql in db_lib.FULL_TABLE_QUERIES:
+        assert sql in plans, f"{sql} wasn't run"
+        assert any(detail.startswith('SCAN') for detail in plans[sql])
+
+
+def test_lookups_use_indexes():
+    plans = db_lib.db_query_plans()
+    lookups = [
+        (sql, plan) for sql, plan in plans
+        if sql.lstrip().upper().startswith('SELECT') and ' WHERE ' in ' '.join(sql.split()).upper()
+    ]
+    assert lookups
+    for sql, plan in lookups:
+        assert any('USING' in detail for detail in plan), sql
+
+
+def test_import_skips_rows_without_keys(tmp_path, monkeypatch, caplog):
+    con = sqlite3.connect(':memory:', detect_types=sqlite3.PARSE_DECLTYPES, isolation_level=None)
+    db_lib.db_migrate(con)
+    monkeypatch.setattr(db_lib._local, 'con', con, raising=False)
+    csv_file = tmp_path / 'players.csv'
+    csv_file.write_text(
+        "faf_id,faf_username,guild_id,discord_id,discord_username\n"
+        "1,One,2,3,Member\n"
+        "4,Four,2,,NoDiscord\n"
+        "5,Five,,6,NoGuild\n"
+    )
+    for _ in range(2):
+        assert db_lib.db_import_csv(str(csv_file)) == 1
+    assert con.execute("SELECT COUNT(*) FROM players").fetchone()[0] == 1
+    assert "lines 3, 4" in caplog.text